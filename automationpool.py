@@ -0,0 +1,122 @@
+# automationpool.py
+#
+# Runs several robots at once. Each worker is its own process with its own screen: either a separate X display
+# (e.g. an Xvfb started with its own Chrome and the extension logged in) or a region of the one screen holding a
+# dedicated Chrome window. Workers claim prompts from the job store one at a time, so a slow booking on one screen
+# never holds up the others, and most of the time per booking is spent waiting for the robot, not for us.
+
+import os
+import time
+import queue
+import signal
+import multiprocessing
+from dotenv import load_dotenv
+
+# One worker per display, e.g. ":101,:102,:103". Chrome has to be running and logged in on each of them
+ROBOT_WORKER_DISPLAYS = os.getenv('ROBOT_WORKER_DISPLAYS', '')
+# Or one worker per window on this screen, as left,top,width,height per window: "0,0,960,1080;960,0,960,1080"
+ROBOT_WORKER_REGIONS = os.getenv('ROBOT_WORKER_REGIONS', '')
+
+
+def load_worker_slots(displays: str = None, regions: str = None) -> list:
+    """
+    Returns one {'name', 'display', 'region'} per configured worker, or [] when the pool isn't configured.
+    Displays win if both are set.
+    """
+    displays = ROBOT_WORKER_DISPLAYS if displays is None else displays
+    regions = ROBOT_WORKER_REGIONS if regions is None else regions
+
+    slots = []
+    for display in [display.strip() for display in displays.split(',') if display.strip()]:
+        slots.append({'name': f"display {display}", 'display': display, 'region': None})
+    if slots:
+        return slots
+
+    for region in [region.strip() for region in regions.split(';') if region.strip()]:
+        left, top, width, height = (int(value) for value in region.split(','))
+        slots.append({'name': f"region {left},{top}", 'display': None, 'region': (left, top, width, height)})
+    return slots
+
+
+def _automation_worker(slot: dict, input_lock, shared_display: bool, results, stop=None):
+    # Runs in a fresh process. DISPLAY has to be set before pyautogui is imported, which happens on first use
+    if stop is not None:
+        # Ctrl+C reaches the whole process group. The parent decides when to stop, so the booking in hand finishes
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if slot['display']:
+        os.environ['DISPLAY'] = slot['display']
+    load_dotenv()
+
+    from jobstore import get_job_store, STATE_PROMPTED, STATE_AUTOMATING
+    import robot_desktop_automator as robot
+
+    robot.set_input_lock(input_lock, shared_display)
+    if slot['region']:
+        robot.set_screen_region(slot['region'])
+
+    store = get_job_store()
+    processed_count = 0
+    failed_count = 0
+    while not (stop is not None and stop.is_set()):
+        jobs = store.claim_jobs(STATE_PROMPTED, STATE_AUTOMATING, limit=1)
+        if not jobs:
+            break
+        print(f"[{slot['name']}] Automating job {jobs[0]['id']}.")
+        if robot.automate_job(store, jobs[0]):
+            processed_count += 1
+        else:
+            failed_count += 1
+    results.put((slot['name'], processed_count, failed_count))
+
+
+def run_automation_pool(slots: list = None, stop_event=None) -> tuple:
+    """
+    Drains the prompted jobs with one worker process per slot (see load_worker_slots). Workers on a shared screen
+    take turns for the clicks and the paste, workers on their own displays only for the paste.
+    Once stop_event (a threading.Event) is set the workers finish the booking they're on and claim nothing new.
+    Returns (processed, failed) over all workers, like process_all_pending_robot_prompts.
+    """
+    slots = slots if slots is not None else load_worker_slots()
+    # spawn, not fork: every worker needs its own SQLite connections and a pyautogui bound to its own display
+    context = multiprocessing.get_context('spawn')
+    input_lock = context.RLock()
+    results = context.Queue()
+    shared_display = not any(slot['display'] for slot in slots)
+    # A threading.Event doesn't cross into spawned processes, it's mirrored onto this one while we wait
+    stop = context.Event() if stop_event is not None else None
+
+    started = time.perf_counter()
+    print(f"Starting {len(slots)} automation worker(s): {', '.join(slot['name'] for slot in slots)}")
+    workers = [
+        context.Process(target=_automation_worker, args=(slot, input_lock, shared_display, results, stop),
+                        name=f"robot-{index}", daemon=True)
+        for index, slot in enumerate(slots)
+    ]
+    for worker in workers:
+        worker.start()
+
+    processed_count = 0
+    failed_count = 0
+    reported = 0
+    while reported < len(workers):
+        if stop is not None and stop_event.is_set():
+            stop.set()
+        try:
+            name, processed, failed = results.get(timeout=1)
+        except queue.Empty:
+            # Make sure nobody died without reporting, a job it had claimed stays in automating for a human to check
+            if not any(worker.is_alive() for worker in workers) and results.empty():
+                print("  Warning: an automation worker exited without reporting back.")
+                break
+            continue
+        reported += 1
+        processed_count += processed
+        failed_count += failed
+        print(f"  [{name}] finished: {processed} automated, {failed} failed.")
+
+    for worker in workers:
+        worker.join()
+
+    seconds = time.perf_counter() - started
+    print(f"\nAutomation pool complete in {seconds:.1f}s. Successfully processed: {processed_count}, Failed: {failed_count}")
+    return processed_count, failed_count
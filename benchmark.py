@@ -0,0 +1,577 @@
+# benchmark.py
+#
+# Offline microbenchmarks for the hot paths of the pipeline. Nothing here touches a real mailbox, the Gemini API or the screen.
+# Usage: python benchmark.py [routing] [imports] [mime] [pipeline] [--n 100000] [--import-runs 5]
+
+import os
+import re
+import sys
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import threading
+import contextlib
+import statistics
+import subprocess
+import tracemalloc
+
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from email.parser import BytesParser
+
+from emailrouter import EmailRouter
+from bodyextract import extract_body
+
+
+def _synthetic_routing_rules(agency_count: int) -> list:
+    rules = []
+    for i in range(agency_count):
+        rules.append(('subject', rf"(?:Booking|Reservation) confirmation #AG{i:03d}-\d+", f"agency{i}"))
+    # A couple of sender based rules, like the ones in EMAIL_HEADER_RULES
+    rules.append(('from', r".*@bookings\.partner-agency\.com", "partner"))
+    rules.append(('list-id', r".*<confirmations\.tours\.example>", "listagency"))
+    return rules
+
+
+def _synthetic_headers(n: int, agency_count: int, seed: int = 42) -> list:
+    """
+    Builds (subject, from, list-id) triples. Like the real inbox, most of them match nothing.
+    """
+    rng = random.Random(seed)
+    noise_subjects = ["Re: invoice", "Newsletter - summer deals", "Your password expires soon", "Meeting notes", "FW: rates 2025"]
+    headers = []
+    for _ in range(n):
+        roll = rng.random()
+        if roll < 0.15:
+            agency = rng.randrange(agency_count)
+            headers.append((f"Booking confirmation #AG{agency:03d}-{rng.randrange(10**6)}", "noreply@agency.example", ""))
+        elif roll < 0.18:
+            headers.append(("New reservation", "desk@bookings.partner-agency.com", ""))
+        elif roll < 0.20:
+            headers.append(("Daily digest", "list@tours.example", "Tours <confirmations.tours.example>"))
+        else:
+            headers.append((rng.choice(noise_subjects), f"someone{rng.randrange(500)}@example.com", ""))
+    return headers
+
+
+def _legacy_route(subject_patterns: dict, subject: str):
+    # What fetch_emails used to do: uncompiled re.match per rule, subject only
+    for pattern, sender_type in subject_patterns.items():
+        if re.match(pattern, subject):
+            return sender_type
+    return None
+
+
+def bench_routing(n: int = 100_000, agency_count: int = 20):
+    print(f"\n--- Routing benchmark: {n} synthetic headers, {agency_count} subject rules + 2 header rules ---")
+    rules = _synthetic_routing_rules(agency_count)
+    headers = _synthetic_headers(n, agency_count)
+    subject_patterns = {pattern: sender_type for field, pattern, sender_type in rules if field == 'subject'}
+
+    start = time.perf_counter()
+    legacy_matches = sum(1 for subject, _, _ in headers if _legacy_route(subject_patterns, subject))
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    router = EmailRouter(rules)
+    compile_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    router_matches = sum(1 for subject, from_header, list_id in headers if router.route(subject, from_header, list_id)[0])
+    router_seconds = time.perf_counter() - start
+
+    print(f"Legacy loop (subject only): {legacy_seconds:.3f}s, {n / legacy_seconds:,.0f} headers/s, {legacy_matches} matched")
+    print(f"EmailRouter:                {router_seconds:.3f}s, {n / router_seconds:,.0f} headers/s, {router_matches} matched (compiled in {compile_seconds * 1000:.1f} ms)")
+    print(f"Speed-up: {legacy_seconds / router_seconds:.1f}x")
+
+
+_BOOKING_LINES = ["Tour date: 14.06.2026", "Product: Old town walking tour (English)", "Participants: 3",
+                  "Lead traveller: Maria Example", "Pickup: Hotel Central, 08:45", "Booking reference: AG-{ref}"]
+
+
+def _booking_html(ref: int) -> str:
+    rows = "".join(f"<tr><td style=\"padding:4px;font-family:Arial\"><b>{line.split(': ')[0]}:</b></td>"
+                   f"<td style=\"padding:4px\">{line.split(': ')[1].format(ref=ref)}</td></tr>" for line in _BOOKING_LINES)
+    return (f"<html><head><style>td {{ color: #333; }} .footer {{ font-size: 10px; }}</style></head><body>"
+            f"<div><p>Dear partner,</p><p>we have a new booking for you:</p><table>{rows}</table>"
+            f"<p class=\"footer\">This email was sent automatically. &copy; Agency&nbsp;GmbH</p>"
+            f"<img src=\"https://tracking.example/pixel.gif\" width=\"1\" height=\"1\"></div></body></html>")
+
+
+def _synthetic_mime_corpus(n: int, seed: int = 7, attachment_size: int = 150_000) -> list:
+    """
+    Raw messages shaped like what the agencies send: plain text, plain+html alternatives, html only, a text body
+    with PDF vouchers attached, latin-1 quoted-printable and forwarded confirmations.
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(n):
+        ref = rng.randrange(10**6)
+        plain = "Dear partner,\n\n" + "\n".join(line.format(ref=ref) for line in _BOOKING_LINES) + "\n\nKind regards\n"
+        message = EmailMessage()
+        message['Subject'] = f"Booking confirmation #AG001-{ref}"
+        message['From'] = "noreply@agency.example"
+        # Unique per mail, like real ones. The refs alone collide now and then and the ledger would skip those
+        message['Message-ID'] = f"<{seed}.{i}.{ref}@agency.example>"
+        kind = i % 6
+        if kind == 0:
+            message.set_content(plain)
+        elif kind == 1:
+            message.set_content(plain)
+            message.add_alternative(_booking_html(ref), subtype='html')
+        elif kind == 2:
+            message.set_content(_booking_html(ref), subtype='html')
+        elif kind == 3:
+            message.set_content(plain)
+            for voucher in range(2):
+                message.add_attachment(rng.randbytes(attachment_size), maintype='application', subtype='pdf',
+                                       filename=f"voucher_{voucher}.pdf")
+        elif kind == 4:
+            message.set_content(plain.replace("Maria Example", "María Jürgensen"), charset='latin-1',
+                                cte='quoted-printable')
+        else:
+            forwarded = EmailMessage()
+            forwarded['Subject'] = "Booking confirmation"
+            forwarded.set_content(_booking_html(ref), subtype='html')
+            message.set_content(forwarded)
+        corpus.append(message.as_bytes())
+    return corpus
+
+
+def _legacy_extract_body(raw_email_bytes: bytes) -> str:
+    # What fetch_emails used to do: full parse, walk every part, HTML passed through as markup
+    full_msg = BytesParser().parsebytes(raw_email_bytes)
+    body_content = ''
+    for part in full_msg.walk():
+        ctype = part.get_content_type()
+        cdisp = part.get('Content-Disposition')
+        if cdisp is None or not cdisp.startswith('attachment'):
+            if ctype == 'text/plain':
+                try:
+                    body_content = part.get_payload(decode=True).decode(part.get_content_charset() or 'utf-8')
+                    break
+                except (UnicodeDecodeError, AttributeError):
+                    body_content = part.get_payload(decode=True).decode('latin-1', errors='ignore')
+                    break
+            elif ctype == 'text/html' and not body_content:
+                try:
+                    body_content = part.get_payload(decode=True).decode(part.get_content_charset() or 'utf-8')
+                except (UnicodeDecodeError, AttributeError):
+                    body_content = part.get_payload(decode=True).decode('latin-1', errors='ignore')
+    return body_content
+
+
+def bench_mime(n: int = 3000):
+    print(f"\n--- MIME body extraction benchmark: {n} synthetic messages ---")
+    corpus = _synthetic_mime_corpus(n)
+    megabytes = sum(len(raw) for raw in corpus) / 1024 / 1024
+
+    start = time.perf_counter()
+    legacy_bodies = [_legacy_extract_body(raw) for raw in corpus]
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new_bodies = [extract_body(raw) for raw in corpus]
+    new_seconds = time.perf_counter() - start
+
+    # ~4 characters per token, same estimate promptwriter budgets with
+    legacy_tokens = sum(len(body) for body in legacy_bodies) // 4
+    new_tokens = sum(len(body) for body in new_bodies) // 4
+    missing = sum(1 for body in new_bodies if "Participants: 3" not in body)
+
+    print(f"Corpus: {megabytes:.1f} MB")
+    print(f"Full parse (old):   {legacy_seconds:.3f}s, {n / legacy_seconds:,.0f} msgs/s, ~{legacy_tokens:,} body tokens")
+    print(f"bodyextract:        {new_seconds:.3f}s, {n / new_seconds:,.0f} msgs/s, ~{new_tokens:,} body tokens")
+    print(f"Speed-up: {legacy_seconds / new_seconds:.1f}x, tokens saved: {1 - new_tokens / legacy_tokens:.0%}, "
+          f"bookings missing from the extracted text: {missing}")
+
+
+# Modules that are slow to import or need a display/network. Nothing on the fetch path should pull them in
+HEAVY_MODULES = ('imapclient', 'google.generativeai', 'pyautogui', 'pyperclip')
+
+# What each stage imports when started on its own, checked in a fresh interpreter every time
+IMPORT_TARGETS = {
+    'cli': "import cli",
+    'cli fetch path': "import cli, mailfetcher",
+    'promptwriter': "import promptwriter",
+    'robot_desktop_automator': "import robot_desktop_automator",
+}
+
+
+def _time_import(code: str, n: int) -> tuple:
+    probe = f"{code}\nimport sys\nprint(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    timings = []
+    loaded = ''
+    for _ in range(n):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        timings.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            return None, result.stderr.strip().splitlines()[-1]
+        loaded = result.stdout.strip()
+    return statistics.median(timings), loaded
+
+
+def bench_imports(n: int = 5):
+    """
+    Cold start cost of each entry point, as the median of n fresh interpreters minus a bare interpreter start.
+    The fetch path and the CLI itself must not load any of HEAVY_MODULES.
+    """
+    print(f"\n--- Import time benchmark: median of {n} fresh interpreters ---")
+    interpreter_seconds, _ = _time_import("pass", n)
+    print(f"Bare interpreter start: {interpreter_seconds * 1000:.0f} ms (subtracted below)")
+
+    for name, code in IMPORT_TARGETS.items():
+        seconds, loaded = _time_import(code, n)
+        if seconds is None:
+            print(f"{name:<26} failed to import: {loaded}")
+            continue
+        flag = "  <-- should not be loaded here" if loaded and name.startswith('cli') else ""
+        print(f"{name:<26} {(seconds - interpreter_seconds) * 1000:7.0f} ms   heavy modules loaded: {loaded or 'none'}{flag}")
+
+
+# End to end run of the three stages against stand-ins. Latency of the fake services is set with these
+BENCH_IMAP_LATENCY = float(os.getenv('BENCH_IMAP_LATENCY', 0.0))
+BENCH_GEMINI_LATENCY = float(os.getenv('BENCH_GEMINI_LATENCY', 0.05))
+BENCH_GEMINI_ERROR_RATE = float(os.getenv('BENCH_GEMINI_ERROR_RATE', 0.0))
+# tracemalloc makes the fetch stage about 3x slower. Set to 0 for clean emails/s numbers without the memory column
+BENCH_TRACE_MEMORY = os.getenv('BENCH_TRACE_MEMORY', '1') != '0'
+PIPELINE_SIZES = (10, 1000, 10000)
+
+# Spans from tracing.py shown per run, in pipeline order
+PIPELINE_REPORT_SPANS = ('imap.fetch_headers', 'imap.fetch_bodies', 'email.save', 'prompt.build', 'llm.call',
+                         'robot.click', 'robot.paste', 'robot.automate')
+
+
+def _imap_bodystructure(part):
+    # Same shape IMAPClient hands back: a list of children for multiparts, a flat tuple for leaf parts
+    if part.get_content_type() != 'message/rfc822' and part.is_multipart():
+        return ([_imap_bodystructure(child) for child in part.get_payload()], part.get_content_subtype().encode())
+    params = tuple(item.encode() for key, value in (part.get_params() or [])[1:] for item in (key, value)) or None
+    encoding = (part.get('Content-Transfer-Encoding') or '7bit').lower().encode()
+    payload = part.get_payload() if not part.is_multipart() else ''
+    leaf = (part.get_content_maintype().encode(), part.get_content_subtype().encode(), params, None, None, encoding,
+            len(payload))
+    if part.get_content_maintype() == 'text':
+        leaf += (payload.count('\n'),)
+    disposition = (part.get('Content-Disposition') or '').split(';')[0].strip().lower()
+    return leaf + (None, (disposition.encode(), None) if disposition else None, None)
+
+
+def _imap_part_payloads(part, part_spec: str = '') -> dict:
+    # What BODY[<spec>] returns for each leaf: the part's body, still transfer-encoded
+    if part.get_content_type() != 'message/rfc822' and part.is_multipart():
+        payloads = {}
+        for index, child in enumerate(part.get_payload(), start=1):
+            payloads.update(_imap_part_payloads(child, f"{part_spec}.{index}" if part_spec else str(index)))
+        return payloads
+    if part.is_multipart():
+        return {}
+    return {part_spec or '1': part.get_payload().encode('ascii', 'surrogateescape')}
+
+
+class FakeIMAPClient:
+    """
+    In-process stand-in for an IMAPClient logged into one folder holding raw_messages. Covers what mailfetcher
+    uses: select_folder, search (UNSEEN/ALL), fetch of header fields, INTERNALDATE, BODYSTRUCTURE and BODY.PEEK[...],
+    and set_flags. Every command sleeps latency seconds to stand in for the network round trip.
+    """
+
+    def __init__(self, raw_messages: list, latency: float = 0.0):
+        self.latency = latency
+        self.messages = dict(enumerate(raw_messages, start=1))
+        self.seen = set()
+        self.commands = 0
+        self._parsed = {}
+        self._received = datetime(2026, 1, 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.logout()
+
+    def _round_trip(self):
+        self.commands += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _parse(self, uid: int) -> tuple:
+        parsed = self._parsed.get(uid)
+        if parsed is None:
+            message = BytesParser().parsebytes(self.messages[uid])
+            parsed = self._parsed[uid] = (message, _imap_bodystructure(message), _imap_part_payloads(message))
+        return parsed
+
+    def select_folder(self, folder: str) -> dict:
+        self._round_trip()
+        return {b'EXISTS': len(self.messages), b'UIDVALIDITY': 1, b'UIDNEXT': len(self.messages) + 1}
+
+    def search(self, criteria: list) -> list:
+        self._round_trip()
+        if 'UNSEEN' in criteria:
+            return [uid for uid in self.messages if uid not in self.seen]
+        return list(self.messages)
+
+    def fetch(self, uids: list, items: list) -> dict:
+        self._round_trip()
+        response = {}
+        for uid in uids:
+            message, structure, payloads = self._parse(uid)
+            data = {}
+            for item in items:
+                if item == 'INTERNALDATE':
+                    data[b'INTERNALDATE'] = self._received + timedelta(seconds=uid)
+                elif item == 'BODYSTRUCTURE':
+                    data[b'BODYSTRUCTURE'] = structure
+                elif item.startswith('BODY.PEEK[HEADER.FIELDS'):
+                    fields = item[item.index('(') + 1:item.index(')')].split()
+                    lines = [f"{field.title()}: {message[field]}\r\n" for field in fields if message[field] is not None]
+                    data[item.replace('.PEEK', '').encode()] = ''.join(lines).encode('utf-8') + b'\r\n'
+                elif item == 'BODY.PEEK[]':
+                    data[b'BODY[]'] = self.messages[uid]
+                elif item.startswith('BODY.PEEK['):
+                    part_spec = item[len('BODY.PEEK['):-1]
+                    if part_spec in payloads:
+                        data[f'BODY[{part_spec}]'.encode()] = payloads[part_spec]
+            response[uid] = data
+        return response
+
+    def set_flags(self, uids, flags: list):
+        self._round_trip()
+        if '\\Seen' in flags:
+            self.seen.update(uids if isinstance(uids, (list, tuple)) else [uids])
+
+    def noop(self):
+        self._round_trip()
+
+    def logout(self):
+        pass
+
+
+class ScreenShim:
+    """
+    Takes pyautogui's place for the robot (see robot_desktop_automator.set_gui_backend): screenshots come from a
+    recorded screen image, clicks and hotkeys are only counted. Also stands in for pyperclip.
+    """
+
+    class PyAutoGUIException(Exception):
+        pass
+
+    def __init__(self, screenshot_path: str):
+        from screenlocator import screenshot_from_file
+
+        self.screenshot = screenshot_from_file(screenshot_path)
+        self.clicks = 0
+        self.hotkeys = 0
+        self._clipboard = ''
+
+    def click(self, x: int, y: int):
+        self.clicks += 1
+
+    def hotkey(self, *keys):
+        self.hotkeys += 1
+
+    def size(self) -> tuple:
+        return self.screenshot().size
+
+    def copy(self, text: str):
+        self._clipboard = text
+
+    def paste(self) -> str:
+        return self._clipboard
+
+
+# Name, box and colour of every element the robot looks for on the recorded screen
+_SCREEN_ELEMENTS = {
+    'new_chat': ((40, 40, 220, 90), (52, 120, 246), "New chat"),
+    'input_area': ((300, 900, 1500, 980), (255, 255, 255), "Ask anything..."),
+    'submit': ((1540, 910, 1640, 970), (20, 160, 90), "Send"),
+    'confirmation': ((760, 420, 1160, 520), (250, 200, 40), "Booking confirmed"),
+}
+
+
+def _record_synthetic_screen(directory: str) -> tuple:
+    """
+    Draws a 1920x1080 screen with the robot's buttons on it and saves it plus one template per button, the same
+    files a real recording would give. Returns (screenshot path, {element name: template path}).
+    """
+    from PIL import Image, ImageDraw
+
+    screen = Image.new('RGB', (1920, 1080), (236, 238, 241))
+    draw = ImageDraw.Draw(screen)
+    for index, (box, colour, label) in enumerate(_SCREEN_ELEMENTS.values()):
+        draw.rectangle(box, fill=colour, outline=(90, 90, 90), width=2)
+        draw.text((box[0] + 12 + index * 3, box[1] + 12), label, fill=(0, 0, 0))
+
+    screenshot_path = os.path.join(directory, 'screen.png')
+    screen.save(screenshot_path)
+    templates = {}
+    for name, (box, _, _) in _SCREEN_ELEMENTS.items():
+        templates[name] = os.path.join(directory, f"{name}.png")
+        screen.crop(box).save(templates[name])
+    return screenshot_path, templates
+
+
+def _synthetic_mailbox(n: int, seed: int) -> list:
+    # n booking mails plus one unrelated mail for every four, like a shared inbox
+    bookings = _synthetic_mime_corpus(n, seed=seed, attachment_size=20_000)
+    rng = random.Random(seed)
+    mailbox = []
+    for i, raw in enumerate(bookings):
+        mailbox.append(raw)
+        if i % 4 == 3:
+            noise = EmailMessage()
+            noise['Subject'] = rng.choice(["Re: invoice", "Newsletter - summer deals", "Meeting notes"])
+            noise['From'] = f"someone{rng.randrange(500)}@example.com"
+            noise.set_content("Nothing to book here.\n" * 20)
+            mailbox.append(noise.as_bytes())
+    return mailbox
+
+
+def _run_stage(function, *args, **kwargs) -> tuple:
+    # Stage output is thousands of lines at these sizes, so it goes nowhere. Returns (result, seconds, peak MB or None)
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        result = function(*args, **kwargs)
+    seconds = time.perf_counter() - started
+    peak_mb = tracemalloc.get_traced_memory()[1] / 1024 / 1024 if tracemalloc.is_tracing() else None
+    return result, seconds, peak_mb
+
+
+def _bench_pipeline_once(n: int, workdir: str, gemini_endpoint: str, screenshot_path: str, templates: dict):
+    import mailfetcher
+    import promptwriter
+    import robot_desktop_automator
+    from llmcache import ResponseCache
+    from ratelimit import TokenBucket
+    from jobstore import get_job_store
+    from tracing import tracer
+
+    mails_dir = os.path.join(workdir, 'mails')
+    os.environ.update({
+        'JOB_DB_PATH': os.path.join(workdir, 'jobs.sqlite3'),
+        'SEQUENCE_DB_PATH': os.path.join(workdir, 'sequences.sqlite3'),
+        'SAVED_MAILS_DIR': mails_dir,
+        'SAVED_PROMPTS_DIR': os.path.join(workdir, 'prompts'),
+        'COMPLETED_PROMPTS_DIR': os.path.join(workdir, 'complete'),
+    })
+    os.makedirs(mails_dir, exist_ok=True)
+    # Opened up front so the first saved mail isn't also picked up as a leftover from the old file handoff
+    get_job_store()
+
+    # Fetch: the fake mailbox replaces the login, routing uses the benchmark's agency rules
+    client = FakeIMAPClient(_synthetic_mailbox(n, seed=n), BENCH_IMAP_LATENCY)
+    mailfetcher.connect_imap = lambda host, port, username, password: client
+    mailfetcher.EMAIL_ROUTER = EmailRouter(_synthetic_routing_rules(20))
+
+    # Prompt: the fake endpoint, a fresh cache and no per-minute budget, which would only measure our API tier
+    promptwriter.GEMINI_API_ENDPOINT = gemini_endpoint
+    promptwriter.model = None
+    promptwriter.response_cache = ResponseCache(os.path.join(workdir, 'llm_cache.sqlite3'), 50 * 1024 * 1024, 86400)
+    promptwriter._request_bucket = TokenBucket(0)
+    promptwriter._token_bucket = TokenBucket(0)
+
+    # Automate: recorded screen, no display needed
+    shim = ScreenShim(screenshot_path)
+    robot_desktop_automator.set_gui_backend(shim, shim)
+    robot_desktop_automator.ROBOT_NEW_CHAT_BUTTON_IMAGE = templates['new_chat']
+    robot_desktop_automator.ROBOT_ACTUAL_INPUT_AREA_IMAGE = templates['input_area']
+    robot_desktop_automator.ROBOT_SUBMIT_BUTTON_IMAGE = templates['submit']
+    robot_desktop_automator.BOOKING_CONFIRMATION_IMAGE = templates['confirmation']
+
+    tracer.reset()
+    tracer.log_path = os.path.join(workdir, 'traces.jsonl')
+
+    saved, fetch_seconds, fetch_mb = _run_stage(mailfetcher.fetch_emails, 'bench', 993, 'bench', '', mails_dir,
+                                                mark_as_read=True)
+    (prompted, prompt_failed), prompt_seconds, prompt_mb = _run_stage(promptwriter.process_all_emails_for_prompts)
+    (automated, automate_failed), automate_seconds, automate_mb = _run_stage(
+        robot_desktop_automator.process_all_pending_robot_prompts)
+
+    total_seconds = fetch_seconds + prompt_seconds + automate_seconds
+    print(f"\nN = {n}: {len(client.messages)} mails in the mailbox, {client.commands} IMAP commands")
+    print(f"  {'stage':<10} {'done':>6} {'failed':>6} {'seconds':>9} {'emails/s':>10} {'peak MB':>9}")
+    for stage, done, failed, seconds, peak_mb in (('fetch', len(saved), n - len(saved), fetch_seconds, fetch_mb),
+                                                  ('prompt', prompted, prompt_failed, prompt_seconds, prompt_mb),
+                                                  ('automate', automated, automate_failed, automate_seconds, automate_mb)):
+        peak = f"{peak_mb:>9.1f}" if peak_mb is not None else f"{'-':>9}"
+        print(f"  {stage:<10} {done:>6} {failed:>6} {seconds:>9.2f} {done / seconds if seconds else 0:>10,.0f} {peak}")
+    print(f"  end to end: {automated / total_seconds:,.1f} bookings/s over {total_seconds:.2f}s")
+
+    spans, counters = tracer.snapshot()
+    print(f"  {'span':<20} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name in PIPELINE_REPORT_SPANS:
+        if name in spans:
+            count, _, p50, p95, p99 = spans[name]
+            print(f"  {name:<20} {count:>6} {p50 * 1000:>9.2f} {p95 * 1000:>9.2f} {p99 * 1000:>9.2f}")
+    print(f"  LLM retries: {counters.get('llm_retries', 0)}, screen searches: {counters.get('locate_attempts', 0)}")
+
+
+def bench_pipeline(n: int = None):
+    """
+    fetch_emails -> process_all_emails_for_prompts -> process_all_pending_robot_prompts on n synthetic agency
+    mails (10, 1k and 10k by default), with FakeIMAPClient for the mailbox, fake_gemini.py for the API and a
+    recorded screen behind ScreenShim for the robot. Reports emails/s, peak traced memory per stage and span
+    percentiles. Timings include tracemalloc's overhead unless BENCH_TRACE_MEMORY=0. The robot's screen searches
+    are real, so the 10k run takes the better part of an hour; use --n for a single size.
+    """
+    from fake_gemini import start_fake_gemini_server
+
+    sizes = [n] if n else PIPELINE_SIZES
+    print(f"\n--- End to end pipeline benchmark: N = {', '.join(str(size) for size in sizes)} ---")
+    print(f"Fake Gemini latency {BENCH_GEMINI_LATENCY}s, 429 rate {BENCH_GEMINI_ERROR_RATE:.0%}, "
+          f"IMAP latency {BENCH_IMAP_LATENCY}s per command")
+
+    server = start_fake_gemini_server(0, BENCH_GEMINI_LATENCY, BENCH_GEMINI_ERROR_RATE)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    gemini_endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+    if BENCH_TRACE_MEMORY:
+        tracemalloc.start()
+    try:
+        for size in sizes:
+            workdir = tempfile.mkdtemp(prefix=f"bench_pipeline_{size}_")
+            try:
+                screenshot_path, templates = _record_synthetic_screen(workdir)
+                _bench_pipeline_once(size, workdir, gemini_endpoint, screenshot_path, templates)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+    finally:
+        tracemalloc.stop()
+        server.shutdown()
+        server.server_close()
+
+
+BENCHMARKS = {
+    'routing': bench_routing,
+    'imports': bench_imports,
+    'mime': bench_mime,
+    'pipeline': bench_pipeline,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the booking pipeline.")
+    parser.add_argument('benchmarks', nargs='*', help=f"Which benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument('--n', type=int, default=None,
+                        help="Override the corpus size of routing, mime and pipeline")
+    parser.add_argument('--import-runs', type=int, default=None,
+                        help="Fresh interpreters per target for the imports benchmark")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"Unknown benchmark(s): {', '.join(unknown)}")
+
+    for name in args.benchmarks or BENCHMARKS:
+        # n is a process count for imports, a corpus sized --n would start that many interpreters
+        n = args.import_runs if name == 'imports' else args.n
+        if n:
+            BENCHMARKS[name](n=n)
+        else:
+            BENCHMARKS[name]()
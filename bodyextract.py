@@ -0,0 +1,223 @@
+# bodyextract.py
+#
+# Gets the text the prompt needs out of a raw email without the cost of a full parse. Only headers are parsed with
+# the email package. Multipart bodies are cut up on their boundaries with bytes operations, attachments are skipped
+# without decoding them, and the search stops at the first usable text/plain part. HTML-only mails are turned into
+# compact text so markup never reaches Gemini.
+
+import re
+import base64
+import quopri
+from html.parser import HTMLParser
+from email.parser import BytesParser
+
+_HEADER_END = re.compile(rb"\r?\n\r?\n")
+
+# Tags that end a line of text, and tags whose content is never visible
+_BLOCK_TAGS = {'address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt', 'footer', 'form', 'h1', 'h2',
+               'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'ol', 'p', 'pre', 'section', 'table', 'tr', 'ul'}
+_HIDDEN_TAGS = {'head', 'noscript', 'script', 'style', 'template', 'title'}
+# Block tags that also start a new paragraph, i.e. get a blank line around them like paragraphs in a plain text mail
+_PARAGRAPH_TAGS = {'article', 'blockquote', 'div', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ol', 'p', 'section', 'table', 'ul'}
+# Stands in for a paragraph break until the whitespace is cleaned up
+_PARAGRAPH_BREAK = '\ue000'
+
+# Multipart nesting deeper than this is junk or an attack, not a booking
+_MAX_DEPTH = 10
+
+
+class _HTMLTextExtractor(HTMLParser):
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.pieces = []
+        self._hidden_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _HIDDEN_TAGS:
+            self._hidden_depth += 1
+        elif tag in _PARAGRAPH_TAGS:
+            self.pieces.append(f'\n{_PARAGRAPH_BREAK}\n')
+        elif tag in _BLOCK_TAGS:
+            self.pieces.append('\n')
+            if tag == 'li':
+                self.pieces.append('- ')
+        elif tag in ('td', 'th'):
+            # Keeps "Date:" and the date from the next cell on one line, which is what the extractors expect
+            self.pieces.append(' ')
+
+    def handle_endtag(self, tag):
+        if tag in _HIDDEN_TAGS:
+            self._hidden_depth = max(0, self._hidden_depth - 1)
+        elif tag in _PARAGRAPH_TAGS:
+            self.pieces.append(f'\n{_PARAGRAPH_BREAK}\n')
+        elif tag in _BLOCK_TAGS:
+            self.pieces.append('\n')
+
+    def handle_data(self, data):
+        if not self._hidden_depth:
+            self.pieces.append(data)
+
+
+def html_to_text(html: str) -> str:
+    """
+    Converts an HTML body to compact plain text: visible text only, one line per block element and a single blank
+    line between paragraphs (p, div, table and the like), so the text is split up like a plain text mail.
+    """
+    parser = _HTMLTextExtractor()
+    parser.feed(html)
+    parser.close()
+
+    lines = []
+    for line in ''.join(parser.pieces).splitlines():
+        line = re.sub(r"[ \t\xa0]+", " ", line).strip()
+        if line == _PARAGRAPH_BREAK:
+            if lines and lines[-1]:
+                lines.append('')
+        # Other blank lines only come from nested block tags, they carry no meaning and cost tokens
+        elif line:
+            lines.append(line)
+    return "\n".join(lines).strip()
+
+
+def decode_part_payload(payload: bytes, encoding: str, charset: str) -> str:
+    if encoding == 'base64':
+        payload = base64.b64decode(payload)
+    elif encoding == 'quoted-printable':
+        payload = quopri.decodestring(payload)
+    try:
+        return payload.decode(charset or 'utf-8')
+    except (UnicodeDecodeError, LookupError):
+        return payload.decode('latin-1', errors='ignore')
+
+
+def decode_text_part(payload: bytes, subtype: str, encoding: str, charset: str) -> str:
+    """
+    Decodes one downloaded text part, converting it to plain text if it's HTML.
+    """
+    text = decode_part_payload(payload, encoding, charset)
+    return html_to_text(text) if subtype == 'html' else text
+
+
+def _split_headers(raw: bytes) -> tuple:
+    # A part that starts with an empty line has no headers at all (text/plain by default)
+    if raw.startswith(b'\r\n') or raw.startswith(b'\n'):
+        return BytesParser().parsebytes(b'', headersonly=True), raw.lstrip(b'\r\n')
+    match = _HEADER_END.search(raw)
+    if match is None:
+        return BytesParser().parsebytes(raw, headersonly=True), b''
+    return BytesParser().parsebytes(raw[:match.start()], headersonly=True), raw[match.end():]
+
+
+def _split_multipart(body: bytes, boundary: str) -> list:
+    # bytes.find instead of a regex, the attachments make these bodies big and the scan has to stay in C
+    marker = b'--' + boundary.encode('latin-1')
+    parts = []
+    start = None
+    position = 0
+    while True:
+        index = body.find(marker, position)
+        if index == -1:
+            break
+        position = index + len(marker)
+        # A delimiter only counts at the start of a line, with nothing but "--" or whitespace after it
+        if index and body[index - 1:index] != b'\n':
+            continue
+        line_end = body.find(b'\n', position)
+        line_end = len(body) if line_end == -1 else line_end + 1
+        rest = body[position:line_end].strip()
+        if rest not in (b'', b'--'):
+            continue
+
+        if start is not None:
+            # The line break before the delimiter belongs to the delimiter
+            end = index - 1 if index else index
+            if end and body[end - 1:end] == b'\r':
+                end -= 1
+            parts.append(body[start:max(start, end)])
+        if rest == b'--':
+            return parts
+        start = line_end
+    if start is not None:
+        # No closing delimiter, take what's there
+        parts.append(body[start:])
+    return parts
+
+
+def _find_text(headers, body: bytes, found: dict, depth: int = 0):
+    """
+    Walks the part tree depth first. Stops at the first non-empty text/plain part, keeps the first html part in
+    found['html'] in case no plain text turns up.
+    """
+    if depth > _MAX_DEPTH:
+        return
+    disposition = (headers.get('Content-Disposition') or '').strip().lower()
+    if disposition.startswith('attachment'):
+        return
+
+    content_type = headers.get_content_type()
+    if content_type.startswith('multipart/'):
+        boundary = headers.get_param('boundary')
+        if not boundary:
+            return
+        for part in _split_multipart(body, boundary):
+            part_headers, part_body = _split_headers(part)
+            _find_text(part_headers, part_body, found, depth + 1)
+            if 'plain' in found:
+                return
+    elif content_type == 'message/rfc822':
+        # Forwarded booking, the text we want is inside
+        inner_headers, inner_body = _split_headers(body)
+        _find_text(inner_headers, inner_body, found, depth + 1)
+    elif content_type in ('text/plain', 'text/html'):
+        subtype = content_type.split('/')[1]
+        if subtype == 'html' and 'html' in found:
+            return
+        encoding = (headers.get('Content-Transfer-Encoding') or '').strip().lower()
+        text = decode_part_payload(body, encoding, headers.get_content_charset())
+        if subtype == 'plain':
+            if text.strip():
+                found['plain'] = text
+        else:
+            found['html'] = text
+
+
+def _extract_body_full_parse(raw_email_bytes: bytes) -> str:
+    # The email package's way, for anything the fast path can't make sense of
+    full_msg = BytesParser().parsebytes(raw_email_bytes)
+    html = None
+    for part in full_msg.walk():
+        if (part.get('Content-Disposition') or '').strip().lower().startswith('attachment'):
+            continue
+        ctype = part.get_content_type()
+        if ctype not in ('text/plain', 'text/html'):
+            continue
+        payload = part.get_payload(decode=True) or b''
+        try:
+            text = payload.decode(part.get_content_charset() or 'utf-8')
+        except (UnicodeDecodeError, LookupError):
+            text = payload.decode('latin-1', errors='ignore')
+        if ctype == 'text/plain' and text.strip():
+            return text
+        if ctype == 'text/html' and html is None:
+            html = text
+    return html_to_text(html) if html else ''
+
+
+def extract_body(raw_email_bytes: bytes) -> str:
+    """
+    Returns the body text of a raw RFC 822 message: the first non-empty text/plain part, otherwise the first
+    text/html part converted to text. Attachments are never decoded. Returns '' if there's no text at all.
+    """
+    try:
+        headers, body = _split_headers(raw_email_bytes)
+        found = {}
+        _find_text(headers, body, found)
+    except Exception:
+        return _extract_body_full_parse(raw_email_bytes)
+
+    if 'plain' in found:
+        return found['plain']
+    if 'html' in found:
+        return html_to_text(found['html'])
+    return ''
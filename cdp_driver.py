@@ -0,0 +1,225 @@
+# cdp_driver.py
+#
+# Drives the robot extension's page over the Chrome DevTools protocol instead of the mouse, the clipboard and
+# screenshots. Start Chrome with --remote-debugging-port=9222 (or set CDP_CHROME_PATH and it's started for you),
+# open the extension's chat page and point the selectors below at its input, submit button and confirmation.
+# Needs the websocket-client package. Selected with ROBOT_DRIVER=cdp in robot_desktop_automator.py.
+
+import os
+import json
+import time
+import subprocess
+import urllib.request
+from tracing import tracer
+
+CDP_URL = os.getenv('CDP_URL', 'http://127.0.0.1:9222')
+# Part of the URL of the tab/panel to drive, e.g. "chrome-extension://<extension id>/"
+CDP_TARGET_URL_MATCH = os.getenv('CDP_TARGET_URL_MATCH', 'chrome-extension://')
+CDP_NEW_CHAT_SELECTOR = os.getenv('CDP_NEW_CHAT_SELECTOR', '')
+CDP_INPUT_SELECTOR = os.getenv('CDP_INPUT_SELECTOR', 'textarea')
+# Empty presses Enter in the input instead of clicking a button
+CDP_SUBMIT_SELECTOR = os.getenv('CDP_SUBMIT_SELECTOR', '')
+# What shows up once the robot has booked: an element matching the selector, or the text anywhere on the page
+CDP_CONFIRMATION_SELECTOR = os.getenv('CDP_CONFIRMATION_SELECTOR', '')
+CDP_CONFIRMATION_TEXT = os.getenv('CDP_CONFIRMATION_TEXT', '')
+CDP_POLL_INTERVAL = float(os.getenv('CDP_POLL_INTERVAL', 0.05))
+# The extension's MV3 service worker and friends match the URL too, but have no DOM to type into
+_WORKER_TARGET_TYPES = ('service_worker', 'shared_worker', 'worker', 'background_page')
+
+# Optional: start Chrome ourselves when nothing listens on CDP_URL. The profile must have the extension set up
+CDP_CHROME_PATH = os.getenv('CDP_CHROME_PATH', '')
+CDP_USER_DATA_DIR = os.getenv('CDP_USER_DATA_DIR', '')
+
+
+class CDPUnavailable(Exception):
+    """
+    Raised when nothing has been sent to the robot yet (no browser, no page, no input), so the GUI path can take over.
+    """
+
+
+class CDPDriver:
+    """
+    One DevTools websocket to the extension page. submit_command() focuses the input, inserts the text the way
+    an IME would (works for plain textareas, React inputs and contenteditable alike) and submits;
+    wait_for_confirmation() polls the page for the confirmation. Everything happens inside the page, so nothing
+    depends on window focus, screen resolution or the clipboard.
+    """
+
+    def __init__(self, cdp_url: str = None, target_url_match: str = None):
+        self.cdp_url = (cdp_url or CDP_URL).rstrip('/')
+        self.target_url_match = target_url_match if target_url_match is not None else CDP_TARGET_URL_MATCH
+        self._socket = None
+        self._next_id = 0
+
+    def _targets(self) -> list:
+        with urllib.request.urlopen(f"{self.cdp_url}/json/list", timeout=5) as response:
+            return json.load(response)
+
+    def _launch_browser(self):
+        port = self.cdp_url.rsplit(':', 1)[-1]
+        command = [CDP_CHROME_PATH, f"--remote-debugging-port={port}", "--remote-allow-origins=*"]
+        if CDP_USER_DATA_DIR:
+            command.append(f"--user-data-dir={CDP_USER_DATA_DIR}")
+        print(f"Starting Chrome for the DevTools driver: {' '.join(command)}")
+        subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def connect(self):
+        if self._socket is not None:
+            return
+        try:
+            import websocket
+        except ImportError:
+            raise CDPUnavailable("websocket-client isn't installed (pip install websocket-client)")
+
+        try:
+            targets = self._targets()
+        except OSError as e:
+            if not CDP_CHROME_PATH:
+                raise CDPUnavailable(f"No browser listening on {self.cdp_url}: {e}")
+            self._launch_browser()
+            targets = self._wait_for_targets()
+
+        matching = [target for target in targets
+                    if target.get('webSocketDebuggerUrl') and self.target_url_match in target.get('url', '')
+                    and target.get('type') not in _WORKER_TARGET_TYPES]
+        if not matching:
+            raise CDPUnavailable(f"No page matching '{self.target_url_match}' is open on {self.cdp_url}")
+        # Tabs first, then side panels and popups. Several can be open (options page, a second tab), take the first
+        # one that actually has the input
+        matching.sort(key=lambda target: target.get('type') != 'page')
+
+        for target in matching:
+            self._open(websocket, target)
+            try:
+                has_input = self.evaluate(f"!!document.querySelector({json.dumps(CDP_INPUT_SELECTOR)})")
+            except Exception:
+                has_input = False
+            if has_input:
+                break
+            self.close()
+        else:
+            # Nothing shows the input yet, probably still loading. submit_command waits for it on the first one
+            target = matching[0]
+            self._open(websocket, target)
+        print(f"Connected to '{target.get('title') or target['url']}' over DevTools.")
+
+    def _open(self, websocket, target: dict):
+        try:
+            # suppress_origin: newer Chrome refuses DevTools websockets that send an Origin it wasn't told to allow
+            self._socket = websocket.create_connection(target['webSocketDebuggerUrl'], timeout=10, suppress_origin=True)
+        except Exception as e:
+            raise CDPUnavailable(f"Couldn't open the DevTools websocket: {e}")
+
+    def _wait_for_targets(self, timeout: float = 20) -> list:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self._targets()
+            except OSError as e:
+                if time.monotonic() >= deadline:
+                    raise CDPUnavailable(f"Chrome didn't open {self.cdp_url} within {timeout}s: {e}")
+                time.sleep(0.5)
+
+    def close(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            finally:
+                self._socket = None
+
+    def _send(self, method: str, params: dict = None) -> dict:
+        self._next_id += 1
+        message_id = self._next_id
+        self._socket.send(json.dumps({'id': message_id, 'method': method, 'params': params or {}}))
+        while True:
+            # Events we didn't subscribe to can still arrive, skip everything that isn't our answer
+            message = json.loads(self._socket.recv())
+            if message.get('id') != message_id:
+                continue
+            if 'error' in message:
+                raise RuntimeError(f"{method} failed: {message['error'].get('message')}")
+            return message.get('result', {})
+
+    def evaluate(self, expression: str):
+        result = self._send('Runtime.evaluate', {'expression': expression, 'returnByValue': True, 'awaitPromise': True})
+        if 'exceptionDetails' in result:
+            raise RuntimeError(f"Page script failed: {result['exceptionDetails'].get('text')}")
+        return result.get('result', {}).get('value')
+
+    def _wait_for(self, expression: str, timeout: float):
+        deadline = time.monotonic() + timeout
+        while True:
+            value = self.evaluate(expression)
+            if value:
+                return value
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(CDP_POLL_INTERVAL)
+
+    def can_confirm(self) -> bool:
+        return bool(CDP_CONFIRMATION_SELECTOR or CDP_CONFIRMATION_TEXT)
+
+    def _confirmation_expression(self) -> str:
+        # How many confirmations the page shows right now
+        if CDP_CONFIRMATION_SELECTOR:
+            return f"document.querySelectorAll({json.dumps(CDP_CONFIRMATION_SELECTOR)}).length"
+        return f"document.body.innerText.split({json.dumps(CDP_CONFIRMATION_TEXT)}).length - 1"
+
+    def submit_command(self, text: str, timeout: float) -> int:
+        """
+        Clears the chat, puts text in the input and submits it. Returns the number of confirmations already on the
+        page, for wait_for_confirmation. Raises CDPUnavailable if the page isn't usable, before anything is sent.
+        """
+        try:
+            self.connect()
+            if CDP_NEW_CHAT_SELECTOR:
+                self.evaluate(f"(el => el && el.click())(document.querySelector({json.dumps(CDP_NEW_CHAT_SELECTOR)}))")
+
+            focused = self._wait_for(
+                # Selecting what's there first makes the insert replace any half typed leftovers
+                f"(el => {{ if (!el) return false; el.focus(); if (el.select) el.select(); "
+                f"else document.execCommand('selectAll'); return document.activeElement === el; }})"
+                f"(document.querySelector({json.dumps(CDP_INPUT_SELECTOR)}))", timeout)
+            if not focused:
+                raise CDPUnavailable(f"Input '{CDP_INPUT_SELECTOR}' not found on the page")
+            confirmations_before = self.evaluate(self._confirmation_expression()) if self.can_confirm() else 0
+        except CDPUnavailable:
+            self.close()
+            raise
+        except Exception as e:
+            # Dropped websocket, browser restarted, page navigated away: nothing was typed yet
+            self.close()
+            raise CDPUnavailable(str(e))
+
+        with tracer.span('cdp.submit', chars=len(text)):
+            self._send('Input.insertText', {'text': text})
+            if CDP_SUBMIT_SELECTOR:
+                clicked = self._wait_for(
+                    f"(el => {{ if (!el || el.disabled) return false; el.click(); return true; }})"
+                    f"(document.querySelector({json.dumps(CDP_SUBMIT_SELECTOR)}))", timeout)
+                if not clicked:
+                    raise RuntimeError(f"Submit button '{CDP_SUBMIT_SELECTOR}' never became clickable")
+            else:
+                for event_type in ('keyDown', 'keyUp'):
+                    self._send('Input.dispatchKeyEvent', {'type': event_type, 'key': 'Enter', 'code': 'Enter',
+                                                          'windowsVirtualKeyCode': 13, 'nativeVirtualKeyCode': 13})
+        return confirmations_before
+
+    def wait_for_confirmation(self, confirmations_before: int, timeout: float) -> bool:
+        """
+        Waits until the page shows more confirmations than before the submit. Needs can_confirm().
+        """
+        with tracer.span('cdp.confirmation_wait') as span_attrs:
+            confirmed = self._wait_for(f"({self._confirmation_expression()}) > {int(confirmations_before)}", timeout)
+            span_attrs['confirmed'] = bool(confirmed)
+        return bool(confirmed)
+
+
+_driver = None
+
+
+def get_cdp_driver() -> CDPDriver:
+    global _driver
+    if _driver is None:
+        _driver = CDPDriver()
+    return _driver
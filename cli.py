@@ -0,0 +1,144 @@
+# cli.py
+#
+# One entry point for every stage. Each subcommand only imports the modules it needs, so a fetch-only cron job
+# never loads pyautogui or the Gemini SDK and runs fine on a headless host.
+# Usage: python cli.py fetch | prompt | automate | run [--pipeline | --watch] | service | dead [--requeue [id ...]]
+
+import os
+import sys
+import argparse
+from dotenv import load_dotenv
+
+
+def _imap_settings() -> dict:
+    output_dir = os.getenv('EMAIL_OUTPUT_BASE_DIR')
+    return {
+        'host': os.getenv('EMAIL_HOST'),
+        'port': int(os.getenv('EMAIL_PORT', 993)),
+        'username': os.getenv('EMAIL_USER'),
+        'password': os.getenv('EMAIL_PASS'),
+        'output_base_dir': output_dir,
+        'sync_state_file': os.getenv('IMAP_SYNC_STATE_FILE') or os.path.join(output_dir or '', '.imap_sync_state.json')
+    }
+
+
+def cmd_fetch(args) -> int:
+    settings = _imap_settings()
+    if os.getenv('IMAP_ACCOUNTS_FILE'):
+        from fetchcoordinator import load_mailbox_specs, fetch_all_mailboxes
+
+        saved = fetch_all_mailboxes(load_mailbox_specs(), settings['output_base_dir'], mark_as_read=True,
+                                    sync_state_file=settings['sync_state_file'])
+        print(f"Email retrieval completed. Found and processed {len(saved)} new emails.")
+        return 0
+
+    from mailfetcher import fetch_emails
+
+    if not all([settings['host'], settings['username'], settings['password'], settings['output_base_dir']]):
+        print("Error: Please ensure EMAIL_HOST, EMAIL_USER, EMAIL_PASS, and EMAIL_OUTPUT_BASE_DIR are all set in your .env file.")
+        return 1
+    saved = fetch_emails(folder=args.folder, mark_as_read=True, **settings)
+    print(f"Email retrieval completed. Found and processed {len(saved)} new emails.")
+    return 0
+
+
+def cmd_prompt(args) -> int:
+    from promptwriter import process_all_emails_for_prompts
+
+    processed, failed = process_all_emails_for_prompts()
+    return 1 if failed and not processed else 0
+
+
+def cmd_automate(args) -> int:
+    from automationpool import load_worker_slots, run_automation_pool
+
+    worker_slots = load_worker_slots()
+    if worker_slots:
+        processed, failed = run_automation_pool(worker_slots)
+        return 1 if failed and not processed else 0
+
+    from robot_desktop_automator import activate_chrome_window, process_all_pending_robot_prompts
+
+    if not activate_chrome_window():
+        return 1
+    processed, failed = process_all_pending_robot_prompts()
+    return 1 if failed and not processed else 0
+
+
+def cmd_run(args) -> int:
+    import main_workflow
+
+    if args.watch:
+        main_workflow.run_watch_mode()
+    elif args.pipeline:
+        main_workflow.run_pipelined_workflow()
+    else:
+        main_workflow.run_full_workflow()
+    return 0
+
+
+def cmd_service(args) -> int:
+    from service import WorkflowService
+
+    WorkflowService(folder=args.folder).run()
+    return 0
+
+
+def cmd_dead(args) -> int:
+    from jobstore import get_job_store
+
+    store = get_job_store()
+    if args.requeue is not None:
+        requeued = store.requeue_dead(args.requeue)
+        print(f"Re-queued {requeued} dead job(s) with a fresh set of attempts.")
+        return 0
+
+    dead = store.dead_jobs()
+    for job in dead:
+        print(f"  {job['id']:>6}  {job['updated_at'][:19]}  attempts {job['attempts']}  {job['email_path']}\n"
+              f"          {job['last_error']}")
+    print(f"{len(dead)} dead job(s).")
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Booking email to robot pipeline.")
+    subcommands = parser.add_subparsers(dest='command', required=True)
+
+    fetch = subcommands.add_parser('fetch', help="Save new booking emails and queue them")
+    fetch.add_argument('--folder', default='INBOX')
+    fetch.set_defaults(handler=cmd_fetch)
+
+    prompt = subcommands.add_parser('prompt', help="Turn queued emails into robot commands")
+    prompt.set_defaults(handler=cmd_prompt)
+
+    automate = subcommands.add_parser('automate', help="Feed pending robot commands to the browser extension "
+                                                       "(one worker per ROBOT_WORKER_DISPLAYS/REGIONS entry if set)")
+    automate.set_defaults(handler=cmd_automate)
+
+    run = subcommands.add_parser('run', help="Fetch, prompt and automate in one go")
+    mode = run.add_mutually_exclusive_group()
+    mode.add_argument('--pipeline', action='store_true', help="Overlap the stages instead of running them one after another")
+    mode.add_argument('--watch', action='store_true', help="Stay connected and run whenever new mail arrives")
+    run.set_defaults(handler=cmd_run)
+
+    service = subcommands.add_parser('service', help="Long-running service with a health file/endpoint")
+    service.add_argument('--folder', default='INBOX')
+    service.set_defaults(handler=cmd_service)
+
+    dead = subcommands.add_parser('dead', help="List the jobs that ran out of attempts")
+    dead.add_argument('--requeue', nargs='*', type=int, metavar='JOB_ID',
+                      help="Give these dead jobs (all of them if no ids are given) another set of attempts")
+    dead.set_defaults(handler=cmd_dead)
+    return parser
+
+
+def main(argv: list = None) -> int:
+    args = build_parser().parse_args(argv)
+    # The only load_dotenv that matters: it runs before any stage module reads its settings
+    load_dotenv()
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
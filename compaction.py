@@ -0,0 +1,212 @@
+# compaction.py
+
+import re
+import threading
+
+# Everything from the first line matching one of these on is reply history, a signature or a phone footer.
+# Booking details usually come first, so cutting there loses nothing. A cut that would take every booking line
+# with it (a forwarded booking under "On ... wrote:", details after a "--") is skipped, see KEEP_LINE_PATTERNS
+CUT_AFTER_PATTERNS = [
+    r"^-{2,}\s*Original Message\s*-{2,}",
+    r"^-{2,}\s*Ursprüngliche Nachricht\s*-{2,}",
+    r"^On .{5,200} wrote:\s*$",
+    r"^Am .{5,200} schrieb .{1,200}:\s*$",
+    r"^-- ?$",
+    r"^Sent from my \w+",
+    r"^Von meinem \w+ gesendet",
+]
+
+# Single lines dropped wherever they are. Quoted lines that look like booking data are unquoted instead
+DROP_LINE_PATTERNS = [
+    r"^\s*>",
+]
+
+# A sentence containing one of these is legal or marketing boilerplate and goes (case-insensitive). Only the
+# sentence: HTML mails often end up with the booking and the footer in one paragraph
+BOILERPLATE_PATTERNS = [
+    r"this (e-?mail|message)( and any attachments)? (is|are|may be|contains?) (strictly )?(confidential|privileged)",
+    r"if you (have )?received this (e-?mail|message) in error",
+    r"please consider the environment before printing",
+    r"diese e-?mail (enthält|kann) vertrauliche",
+    r"\bunsubscribe\b",
+]
+
+# Lines that look like booking data are never dropped, whatever else they contain. Checked with any ">" quoting
+# stripped
+KEEP_LINE_PATTERNS = [
+    r"^[-*]?\s*[^\W\d_][^:]{0,40}:\s*\S",
+    r"\b\d{1,2}[./-]\d{1,2}[./-]\d{2,4}\b",
+]
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_QUOTE_PREFIX = re.compile(r"^[\s>]+")
+
+# Extra patterns per agency, same keys as CONTENT_MARKERS in mailfetcher.py. Fill these in when an agency's
+# mails carry their own footer or disclaimer, e.g. "cut_after": [r"^Terms and conditions"]. An optional "keep"
+# list protects more booking lines from the boilerplate rules
+COMPACTION_RULES = {
+    "tag": {
+        "cut_after": [],
+        "drop_lines": [],
+        "boilerplate": []
+    },
+    "tag2": {
+        "cut_after": [],
+        "drop_lines": [],
+        "boilerplate": []
+    }
+}
+
+TRUNCATION_NOTE = "[rest of email cut]"
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token, the same rough estimate promptwriter budgets the API with
+    return (len(text) + 3) // 4
+
+
+def _combine(patterns: list, flags: int = 0):
+    patterns = [pattern for pattern in patterns if pattern]
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{pattern})" for pattern in patterns), flags)
+
+
+class ContentCompactor:
+    """
+    Shrinks an email to what the model needs before it's sent: reply history, signatures, quoted lines and
+    boilerplate sentences are removed (generic rules plus COMPACTION_RULES for the agency), whitespace is squeezed,
+    and the result is cut to max_tokens. Keeps running token totals for the end of run report.
+    """
+
+    def __init__(self, max_tokens: int, rules: dict = None):
+        self.max_tokens = max_tokens
+        rules = COMPACTION_RULES if rules is None else rules
+        self._compiled = {sender_type: self._compile(rule) for sender_type, rule in rules.items()}
+        self._default = self._compile({})
+        self.emails = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self._stats_lock = threading.Lock()
+
+    def _compile(self, rule: dict) -> tuple:
+        return (
+            _combine(CUT_AFTER_PATTERNS + rule.get("cut_after", []), re.MULTILINE),
+            _combine(DROP_LINE_PATTERNS + rule.get("drop_lines", [])),
+            _combine(BOILERPLATE_PATTERNS + rule.get("boilerplate", []), re.IGNORECASE),
+            _combine(KEEP_LINE_PATTERNS + rule.get("keep", []))
+        )
+
+    def _is_booking_line(self, line: str, keep) -> bool:
+        return bool(keep and keep.search(_QUOTE_PREFIX.sub("", line)))
+
+    def _has_booking_line(self, text: str, keep) -> bool:
+        return any(self._is_booking_line(line, keep) for line in text.split("\n"))
+
+    def _cut(self, text: str, cut_after, keep) -> str:
+        # Cut at the first marker that leaves a booking line above it, or has none below it
+        for match in cut_after.finditer(text):
+            head = text[:match.start()]
+            if self._has_booking_line(head, keep) or not self._has_booking_line(text[match.end():], keep):
+                return head
+        return text
+
+    def _drop_boilerplate(self, line: str, boilerplate, keep) -> str:
+        if not boilerplate.search(line) or (keep and keep.search(line)):
+            return line
+        return " ".join(sentence for sentence in _SENTENCE_END.split(line) if not boilerplate.search(sentence))
+
+    def _truncate(self, text: str) -> str:
+        if not self.max_tokens or estimate_tokens(text) <= self.max_tokens:
+            return text
+        budget = self.max_tokens * 4 - len(TRUNCATION_NOTE) - 1
+        kept = []
+        used = 0
+        for line in text.split("\n"):
+            if used + len(line) + 1 > budget:
+                if not kept:
+                    # One huge line, cut inside it
+                    kept.append(line[:max(0, budget)])
+                break
+            kept.append(line)
+            used += len(line) + 1
+        return "\n".join(kept).rstrip() + "\n" + TRUNCATION_NOTE
+
+    def compact(self, content: str, sender_type: str = None) -> tuple:
+        """
+        Returns (compacted text, tokens before, tokens after).
+        """
+        cut_after, drop_line, boilerplate, keep = self._compiled.get(sender_type, self._default)
+        text = content.replace('\r\n', '\n').replace('\r', '\n')
+
+        if cut_after:
+            text = self._cut(text, cut_after, keep)
+
+        lines = []
+        for line in text.split("\n"):
+            if drop_line and drop_line.match(line):
+                if not self._is_booking_line(line, keep):
+                    continue
+                line = _QUOTE_PREFIX.sub("", line)
+            line = re.sub(r"[ \t\xa0]+", " ", line).strip()
+            if boilerplate and line:
+                line = self._drop_boilerplate(line, boilerplate, keep)
+                if not line:
+                    continue
+            lines.append(line)
+        text = re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+        text = self._truncate(text)
+
+        tokens_before = estimate_tokens(content)
+        tokens_after = estimate_tokens(text)
+        with self._stats_lock:
+            self.emails += 1
+            self.tokens_before += tokens_before
+            self.tokens_after += tokens_after
+        return text, tokens_before, tokens_after
+
+    def stats(self) -> tuple:
+        with self._stats_lock:
+            return self.emails, self.tokens_before, self.tokens_after
+
+
+if __name__ == "__main__":
+    # Quick self-check of the cases that used to lose the booking: python compaction.py
+    compactor = ContentCompactor(max_tokens=0)
+
+    forwarded = (
+        "Hi, see the booking below.\n\n"
+        "On Mon, 1 Jun 2026 at 10:00, Anna Agent <anna@example.com> wrote:\n"
+        "> Tour: Old town walk\n"
+        "> Date: 14.06.2026\n"
+        "> Participants: 3\n"
+    )
+    text, _, _ = compactor.compact(forwarded)
+    assert "Tour: Old town walk" in text and "Date: 14.06.2026" in text, text
+
+    reply = (
+        "Tour: Old town walk\n"
+        "Date: 14.06.2026\n\n"
+        "On Mon, 1 Jun 2026 at 10:00, Anna Agent <anna@example.com> wrote:\n"
+        "> Tour: Harbour tour\n"
+    )
+    text, _, _ = compactor.compact(reply)
+    assert "Old town walk" in text and "Harbour tour" not in text, text
+
+    separator = (
+        "Hello,\n"
+        "-- \n"
+        "Tour: Old town walk\n"
+        "Date: 14.06.2026\n"
+        "-- \n"
+        "Anna Agent\n"
+    )
+    text, _, _ = compactor.compact(separator)
+    assert "Date: 14.06.2026" in text and "Anna Agent" not in text, text
+
+    signature = "Tour: Old town walk\nDate: 14.06.2026\n-- \nAnna Agent\nPhone: +49 30 123456\n"
+    text, _, _ = compactor.compact(signature)
+    assert "Phone" not in text, text
+
+    print("compaction self-check passed")
@@ -0,0 +1,65 @@
+# emailrouter.py
+
+import re
+
+# Header fields a routing rule can look at
+ROUTED_FIELDS = ('subject', 'from', 'list-id')
+
+
+class EmailRouter:
+    """
+    Compiles the routing rules once into one alternation regex per header field, with one named group per rule,
+    so classifying an email is at most one regex call per field no matter how many agencies we add.
+
+    rules is a list of (field, pattern, sender_type) tuples in priority order. Each pattern is applied with
+    re.match semantics to its header field alone, exactly like the old loop over EMAIL_SUBJECT_PATTERNS did.
+    Patterns must not use numbered backreferences or global inline flags like (?i) -- use (?i:...) instead.
+    """
+
+    def __init__(self, rules: list, content_markers: dict = None):
+        self.content_markers = content_markers or {}
+        self.rule_count = len(rules)
+        self._group_rules = {}
+
+        alternatives = {field: [] for field in ROUTED_FIELDS}
+        for index, (field, pattern, sender_type) in enumerate(rules):
+            field = field.lower()
+            if field not in ROUTED_FIELDS:
+                raise ValueError(f"Unsupported routing field '{field}'. Use one of: {', '.join(ROUTED_FIELDS)}")
+            group_name = f"rule{index}"
+            alternatives[field].append(f"(?P<{group_name}>{pattern})")
+            self._group_rules[group_name] = (index, sender_type)
+
+        # Alternatives are tried left to right, so within a field the first hit is the rule that comes first.
+        # Each field gets its own regex so a pattern can never run on into the next header
+        self._regexes = [
+            (ROUTED_FIELDS.index(field), re.compile("|".join(field_alternatives)))
+            for field, field_alternatives in alternatives.items() if field_alternatives
+        ]
+
+    def route(self, subject: str = '', from_header: str = '', list_id: str = '') -> tuple:
+        """
+        Returns (sender_type, content_markers) for the first matching rule, or (None, None).
+        """
+        values = (subject, from_header, list_id)
+        best = None
+        for field_index, regex in self._regexes:
+            match = regex.match(_single_line(values[field_index]))
+            if not match:
+                continue
+            # The rule's own group closes last, so lastgroup is ours even if the pattern has groups of its own
+            rule = self._group_rules[match.lastgroup]
+            if best is None or rule[0] < best[0]:
+                best = rule
+        if best is None:
+            return None, None
+
+        sender_type = best[1]
+        return sender_type, self.content_markers.get(sender_type)
+
+
+def _single_line(value: str) -> str:
+    # Folded headers can carry line breaks, which a '.' in a pattern wouldn't step over
+    if not value:
+        return ''
+    return value.replace('\r', ' ').replace('\n', ' ')
@@ -0,0 +1,107 @@
+# fake_gemini.py
+#
+# A local stand-in for the Gemini REST API so prompt generation can be exercised without a key or a bill.
+# Usage: python fake_gemini.py --port 8089 --latency 0.5 --error-rate 0.1
+# Then run the pipeline with GEMINI_API_ENDPOINT=http://localhost:8089
+
+import re
+import json
+import time
+import random
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def fake_robot_command(prompt_text: str) -> str:
+    # Deterministic, so repeated runs are comparable
+    return f"(fake robot command for a {len(prompt_text)} character prompt)"
+
+
+def fake_batch_response(prompt_text: str) -> str:
+    # Answers a batched request the way promptwriter asks for it: one {"id", "command"} object per "Email id:" line
+    email_ids = re.findall(r"^\s*Email id: (\S+)\s*$", prompt_text, re.MULTILINE)
+    return json.dumps([{"id": email_id, "command": f"(fake robot command for email {email_id})"} for email_id in email_ids])
+
+
+def make_handler(latency: float, error_rate: float):
+
+    class FakeGeminiHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status: int, payload: dict):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                request = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                self._send_json(400, {"error": {"code": 400, "message": "Invalid JSON", "status": "INVALID_ARGUMENT"}})
+                return
+
+            if not self.path.split('?')[0].endswith(':generateContent'):
+                self._send_json(404, {"error": {"code": 404, "message": f"Unknown method {self.path}", "status": "NOT_FOUND"}})
+                return
+
+            time.sleep(latency)
+
+            if random.random() < error_rate:
+                self._send_json(429, {"error": {"code": 429, "message": "Resource has been exhausted (e.g. check quota).",
+                                                "status": "RESOURCE_EXHAUSTED"}})
+                return
+
+            prompt_text = "".join(
+                part.get('text', '')
+                for content in request.get('contents', [])
+                for part in content.get('parts', [])
+            )
+            generation_config = request.get('generationConfig', request.get('generation_config', {}))
+            mime_type = generation_config.get('responseMimeType', generation_config.get('response_mime_type'))
+            if mime_type == 'application/json':
+                answer = fake_batch_response(prompt_text)
+            else:
+                answer = fake_robot_command(prompt_text)
+
+            self._send_json(200, {
+                "candidates": [{
+                    "content": {"parts": [{"text": answer}], "role": "model"},
+                    "finishReason": "STOP",
+                    "index": 0
+                }],
+                "usageMetadata": {"promptTokenCount": len(prompt_text) // 4, "candidatesTokenCount": 20}
+            })
+
+        def log_message(self, format, *args):
+            # Keep the console readable when hammering it with hundreds of requests
+            pass
+
+    return FakeGeminiHandler
+
+
+def start_fake_gemini_server(port: int = 0, latency: float = 0.0, error_rate: float = 0.0) -> ThreadingHTTPServer:
+    """
+    Creates the fake server on localhost. Port 0 picks a free port, read it back from server.server_address.
+    Call serve_forever() on the result (in a thread if needed) and shutdown() when done.
+    """
+    return ThreadingHTTPServer(('127.0.0.1', port), make_handler(latency, error_rate))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local fake Gemini generateContent endpoint.")
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.5, help="Seconds to wait before answering")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests answered with a 429")
+    args = parser.parse_args()
+
+    server = start_fake_gemini_server(args.port, args.latency, args.error_rate)
+    print(f"Fake Gemini listening on http://127.0.0.1:{server.server_address[1]} (latency {args.latency}s, 429 rate {args.error_rate:.0%})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,282 @@
+# fetchcoordinator.py
+#
+# Fetches several mailboxes and folders at the same time. Every (account, folder) pair runs on its own thread with
+# a pooled, already logged in connection, so the whole fetch takes as long as the slowest mailbox instead of the
+# sum of all of them. Saved mails end up in the same output folder and job queue as with fetch_emails.
+
+import os
+import json
+import time
+import queue
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from mailfetcher import connect_imap, open_folder_sync_state, _iter_new_emails
+from jobstore import get_job_store
+
+# Most providers cap simultaneous sessions per login (Gmail at 15), keep well below that
+IMAP_MAX_CONNECTIONS_PER_ACCOUNT = int(os.getenv('IMAP_MAX_CONNECTIONS_PER_ACCOUNT', 2))
+IMAP_FETCH_WORKERS = int(os.getenv('IMAP_FETCH_WORKERS', 8))
+# IDLE only watches one folder per connection, so with several mailboxes watch mode polls them all this often
+IMAP_POLL_INTERVAL = int(os.getenv('IMAP_POLL_INTERVAL', 60))
+
+
+def load_mailbox_specs(accounts_file: str = None) -> list:
+    """
+    Reads the accounts to fetch from IMAP_ACCOUNTS_FILE, a JSON list like
+        [{"host": "imap.example.com", "port": 993, "username": "bookings@example.com",
+          "password_env": "AGENCY1_PASS", "folders": ["INBOX", "Agencies"]}]
+    "password_env" names the env var holding the password, so the file can live next to the code. "password" works too.
+    Without a file the single EMAIL_* account from .env is used with its INBOX.
+    """
+    accounts_file = accounts_file or os.getenv('IMAP_ACCOUNTS_FILE')
+    if not accounts_file:
+        return [{
+            'host': os.getenv('EMAIL_HOST'),
+            'port': int(os.getenv('EMAIL_PORT', 993)),
+            'username': os.getenv('EMAIL_USER'),
+            'password': os.getenv('EMAIL_PASS'),
+            'folders': ['INBOX']
+        }]
+
+    with open(accounts_file, 'r', encoding='utf-8') as f:
+        specs = json.load(f)
+
+    accounts = []
+    for spec in specs:
+        password = spec.get('password')
+        if spec.get('password_env'):
+            password = os.getenv(spec['password_env'])
+        accounts.append({
+            'host': spec['host'],
+            'port': int(spec.get('port', 993)),
+            'username': spec['username'],
+            'password': password,
+            'folders': spec.get('folders') or ['INBOX']
+        })
+    return accounts
+
+
+def _logout_quietly(client):
+    try:
+        client.logout()
+    except Exception:
+        pass
+
+
+class IMAPConnectionPool:
+    """
+    Keeps authenticated IMAPClient connections per account, so the next folder (or the next run in a long-lived
+    process) skips the TLS handshake and LOGIN. Idle connections are checked with a NOOP before they're handed out.
+    At most max_per_account connections per account are open at once, extra callers wait for one to come back.
+    """
+
+    def __init__(self, max_per_account: int = None):
+        self.max_per_account = max_per_account or IMAP_MAX_CONNECTIONS_PER_ACCOUNT
+        self._idle = {}
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def _key(self, account: dict) -> tuple:
+        return account['host'], account['port'], account['username']
+
+    def acquire(self, account: dict):
+        key = self._key(account)
+        with self._lock:
+            slot = self._slots.setdefault(key, threading.BoundedSemaphore(self.max_per_account))
+            idle = self._idle.setdefault(key, [])
+        slot.acquire()
+
+        while True:
+            with self._lock:
+                client = idle.pop() if idle else None
+            if client is None:
+                break
+            try:
+                client.noop()
+                return client
+            except Exception:
+                # The server dropped it while it sat in the pool
+                _logout_quietly(client)
+
+        try:
+            return connect_imap(account['host'], account['port'], account['username'], account['password'])
+        except Exception:
+            slot.release()
+            raise
+
+    def release(self, account: dict, client, broken: bool = False):
+        key = self._key(account)
+        if broken:
+            _logout_quietly(client)
+        else:
+            with self._lock:
+                self._idle[key].append(client)
+        self._slots[key].release()
+
+    @contextmanager
+    def connection(self, account: dict):
+        client = self.acquire(account)
+        try:
+            yield client
+        except Exception:
+            self.release(account, client, broken=True)
+            raise
+        self.release(account, client)
+
+    def close_all(self):
+        with self._lock:
+            clients = [client for idle in self._idle.values() for client in idle]
+            for idle in self._idle.values():
+                idle.clear()
+        for client in clients:
+            _logout_quietly(client)
+
+
+def _fetch_folder(pool: IMAPConnectionPool, account: dict, folder: str, output_base_dir: str, mark_as_read: bool,
+                  search_criteria: list, sync_state_file: str, chunk_size: int, on_saved=None) -> list:
+    # on_saved(received_at, file_path) is called as soon as each mail is saved, for streaming callers
+    label = f"{account['username']}@{account['host']}/{folder}"
+    saved = []
+    try:
+        with pool.connection(account) as client:
+            select_info = client.select_folder(folder)
+            print(f"Selected folder: '{label}'")
+            sync_state = open_folder_sync_state(sync_state_file, account['host'], account['username'], folder, select_info)
+            for received_at, file_path in _iter_new_emails(client, output_base_dir, mark_as_read, search_criteria,
+                                                           sync_state, chunk_size):
+                saved.append((received_at, file_path))
+                if on_saved:
+                    on_saved(received_at, file_path)
+    except Exception as e:
+        # Whatever was saved before the error is kept, the watermark makes the next run pick up the rest
+        print(f"An error occurred while fetching '{label}': {e}")
+    return saved
+
+
+def fetch_all_mailboxes(
+    accounts: list,
+    output_base_dir: str,
+    mark_as_read: bool = True,
+    search_criteria: list = ['UNSEEN'],
+    sync_state_file: str = None,
+    chunk_size: int = None,
+    pool: IMAPConnectionPool = None,
+    max_workers: int = None
+) -> list:
+    """
+    Fetches every folder of every account in accounts (see load_mailbox_specs) concurrently and returns the saved
+    file paths merged in INTERNALDATE order. Pass a long-lived pool to keep the logins between calls, otherwise
+    the connections are closed at the end.
+    """
+    os.makedirs(output_base_dir, exist_ok=True)
+    # Opened here once, before the worker threads race to create it
+    get_job_store()
+
+    own_pool = pool is None
+    pool = pool or IMAPConnectionPool()
+    tasks = [(account, folder) for account in accounts for folder in account['folders']]
+    print(f"Fetching {len(tasks)} folder(s) across {len(accounts)} account(s).")
+
+    saved = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers or IMAP_FETCH_WORKERS) as executor:
+            futures = [
+                executor.submit(_fetch_folder, pool, account, folder, output_base_dir, mark_as_read, search_criteria,
+                                sync_state_file, chunk_size)
+                for account, folder in tasks
+            ]
+            for future in futures:
+                saved.extend(future.result())
+    finally:
+        if own_pool:
+            pool.close_all()
+
+    saved.sort(key=lambda item: item[0])
+    return [file_path for _, file_path in saved]
+
+
+def iter_all_mailboxes(
+    accounts: list,
+    output_base_dir: str,
+    mark_as_read: bool = True,
+    search_criteria: list = ['UNSEEN'],
+    sync_state_file: str = None,
+    chunk_size: int = None,
+    pool: IMAPConnectionPool = None,
+    max_workers: int = None
+):
+    """
+    Streaming version of fetch_all_mailboxes for run_pipeline(email_paths=...): every folder is fetched concurrently
+    and each file path is yielded as soon as its worker has saved it, so the first booking doesn't wait for the
+    slowest mailbox. The trade-off: paths come in the order they were saved, not merged by INTERNALDATE across
+    mailboxes. Within one folder they're still oldest first.
+    """
+    os.makedirs(output_base_dir, exist_ok=True)
+    get_job_store()
+
+    own_pool = pool is None
+    pool = pool or IMAPConnectionPool()
+    tasks = [(account, folder) for account in accounts for folder in account['folders']]
+    print(f"Fetching {len(tasks)} folder(s) across {len(accounts)} account(s).")
+
+    # Unbounded, a worker must never block on a consumer that stopped iterating
+    saved_queue = queue.Queue()
+    folder_done = object()
+
+    def fetch_folder(account: dict, folder: str):
+        try:
+            _fetch_folder(pool, account, folder, output_base_dir, mark_as_read, search_criteria, sync_state_file,
+                          chunk_size, on_saved=lambda received_at, file_path: saved_queue.put(file_path))
+        finally:
+            saved_queue.put(folder_done)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers or IMAP_FETCH_WORKERS)
+    try:
+        for account, folder in tasks:
+            executor.submit(fetch_folder, account, folder)
+        remaining = len(tasks)
+        while remaining:
+            item = saved_queue.get()
+            if item is folder_done:
+                remaining -= 1
+            else:
+                yield item
+    finally:
+        executor.shutdown(wait=True)
+        if own_pool:
+            pool.close_all()
+
+
+def watch_all_mailboxes(
+    accounts: list,
+    output_base_dir: str,
+    on_new_emails,
+    mark_as_read: bool = True,
+    search_criteria: list = ['UNSEEN'],
+    poll_interval: int = None,
+    stop_event=None,
+    sync_state_file: str = None,
+    pool: IMAPConnectionPool = None
+):
+    """
+    watch_mailbox for several mailboxes: fetches all of them every poll_interval seconds and hands each non-empty
+    batch to on_new_emails(paths). The logins stay open in the pool between polls.
+    """
+    poll_interval = poll_interval or IMAP_POLL_INTERVAL
+    own_pool = pool is None
+    pool = pool or IMAPConnectionPool()
+    print(f"Polling {sum(len(account['folders']) for account in accounts)} folder(s) every {poll_interval}s.")
+    try:
+        while not (stop_event and stop_event.is_set()):
+            saved = fetch_all_mailboxes(accounts, output_base_dir, mark_as_read, search_criteria, sync_state_file,
+                                        pool=pool)
+            if saved:
+                on_new_emails(saved)
+            if stop_event:
+                stop_event.wait(poll_interval)
+            else:
+                time.sleep(poll_interval)
+    finally:
+        if own_pool:
+            pool.close_all()
@@ -0,0 +1,400 @@
+# jobstore.py
+
+import os
+import re
+import json
+import sqlite3
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+
+# A booking moves through these states. The *ing states mean a stage has claimed the job and is working on it.
+STATE_FETCHED = 'fetched'
+STATE_PROMPTING = 'prompting'
+STATE_PROMPTED = 'prompted'
+STATE_AUTOMATING = 'automating'
+STATE_COMPLETED = 'completed'
+STATE_FAILED = 'failed'
+# Gave up on it, see DEAD_LETTER_DIR. Only a human puts it back (python cli.py dead --requeue)
+STATE_DEAD = 'dead'
+# Same Message-ID and content as a job that already got this far, see the ledger
+STATE_DUPLICATE = 'duplicate'
+
+# What the idempotency ledger records per booking, in order
+LEDGER_STAGES = ('fetched', 'prompted', 'submitted', 'confirmed')
+
+# A failed job waits JOB_RETRY_BASE_SECONDS before its next try, doubling per failure up to JOB_RETRY_MAX_SECONDS.
+# After JOB_MAX_ATTEMPTS failures in a stage it goes to the dead letters, so a poison email can't burn quota forever
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 5))
+JOB_RETRY_BASE_SECONDS = int(os.getenv('JOB_RETRY_BASE_SECONDS', 60))
+JOB_RETRY_MAX_SECONDS = int(os.getenv('JOB_RETRY_MAX_SECONDS', 6 * 3600))
+DEAD_LETTER_DIR = os.getenv('DEAD_LETTER_DIR', 'deadletter')
+
+# Saved emails look like <sender_type>_<YYYYMMDD>_<seq>.txt, see mailfetcher.py
+_SAVED_EMAIL_PATTERN = re.compile(r"^(?!processed_).+_\d{8}_\d+\.txt$")
+
+
+def make_idempotency_key(message_id: str, content: str) -> str:
+    """
+    Identifies one booking across re-fetches, retries and crashes: the email's Message-ID plus a hash of the
+    content we saved from it. Either part alone isn't enough, some senders reuse Message-IDs and some send the
+    same text twice on purpose.
+    """
+    content_hash = hashlib.sha256((content or '').encode('utf-8')).hexdigest()
+    return f"{(message_id or '').strip()}|{content_hash}"
+
+
+def job_idempotency_key(job: dict) -> str:
+    # Jobs queued before the ledger existed only have their content (or just the prompt, for imported prompt files)
+    return job.get('idempotency_key') or make_idempotency_key(None, job['content'] or job['prompt'])
+
+
+class JobStore:
+    """
+    One row per booking, from the fetched email to the completed robot command, in a single SQLite file.
+    Stages claim work with indexed queries instead of listing directories and encoding state in filenames.
+    WAL mode lets the stages read and write at the same time, and a claim is one short write transaction,
+    so two processes can never pick up the same job.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_uid INTEGER,
+                sender_type TEXT,
+                subject TEXT,
+                email_path TEXT UNIQUE,
+                content TEXT,
+                prompt_path TEXT,
+                prompt TEXT,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                received_at TEXT,
+                claimed_at TEXT,
+                trace_id TEXT,
+                next_attempt_at TEXT,
+                idempotency_key TEXT,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_state_idx ON jobs (state, received_at, id);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            -- One row per booking (see make_idempotency_key) with the first time it reached each stage.
+            -- Outlives the job rows, so a re-fetched or re-queued copy of a booking is recognised
+            CREATE TABLE IF NOT EXISTS ledger (
+                key TEXT PRIMARY KEY,
+                job_id INTEGER,
+                fetched_at TEXT,
+                prompted_at TEXT,
+                submitted_at TEXT,
+                confirmed_at TEXT
+            );
+        """)
+        self._add_missing_columns(conn, {'trace_id': 'TEXT', 'next_attempt_at': 'TEXT', 'idempotency_key': 'TEXT'})
+
+    def _add_missing_columns(self, conn: sqlite3.Connection, columns: dict):
+        # Databases created by an older version get the newer columns added in place
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(jobs)").fetchall()}
+        for column, column_type in columns.items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, sqlite3 connections can't be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            db_dir = os.path.dirname(os.path.abspath(self.db_path))
+            os.makedirs(db_dir, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def add_job(self, email_path: str, content: str, sender_type: str = None, subject: str = None,
+                message_uid: int = None, received_at: datetime = None, state: str = STATE_FETCHED, prompt: str = None,
+                prompt_path: str = None, trace_id: str = None, idempotency_key: str = None) -> int:
+        """
+        Registers a saved email as a new job. Adding the same email_path twice returns the existing job id.
+        With an idempotency_key the booking is also entered in the ledger as fetched.
+        """
+        now = datetime.now().isoformat()
+        received = (received_at or datetime.now()).isoformat()
+        conn = self._connection()
+        cursor = conn.execute("""
+            INSERT OR IGNORE INTO jobs (message_uid, sender_type, subject, email_path, content, prompt_path, prompt,
+                                        state, received_at, trace_id, idempotency_key, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (message_uid, sender_type, subject, email_path, content, prompt_path, prompt, state, received, trace_id,
+              idempotency_key, now, now))
+        if not cursor.rowcount:
+            return conn.execute("SELECT id FROM jobs WHERE email_path = ?", (email_path,)).fetchone()[0]
+        if idempotency_key:
+            self.record_stage(idempotency_key, 'fetched', cursor.lastrowid)
+        return cursor.lastrowid
+
+    def claim_jobs(self, from_state: str, to_state: str, limit: int = None) -> list:
+        """
+        Atomically moves up to limit jobs (oldest email first) from from_state to to_state and returns them as dicts.
+        Jobs waiting for a retry are left alone until their next_attempt_at has passed.
+        """
+        conn = self._connection()
+        now = datetime.now().isoformat()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE state = ? AND (next_attempt_at IS NULL OR next_attempt_at <= ?) "
+                "ORDER BY received_at, id LIMIT ?",
+                (from_state, now, limit if limit else -1)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET state = ?, claimed_at = ?, updated_at = ? WHERE id = ?",
+                [(to_state, now, now, row['id']) for row in rows]
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        jobs = []
+        for row in rows:
+            job = dict(row)
+            job['state'] = to_state
+            job['claimed_at'] = now
+            jobs.append(job)
+        return jobs
+
+    def claim_job(self, job_id: int, from_state: str, to_state: str):
+        """
+        Moves one specific job from from_state to to_state. Returns it as a dict, or None if it was not in from_state
+        (another worker got it first, or it already moved on) or is still waiting for its retry.
+        """
+        conn = self._connection()
+        now = datetime.now().isoformat()
+        cursor = conn.execute(
+            "UPDATE jobs SET state = ?, claimed_at = ?, updated_at = ? "
+            "WHERE id = ? AND state = ? AND (next_attempt_at IS NULL OR next_attempt_at <= ?)",
+            (to_state, now, now, job_id, from_state, now)
+        )
+        if not cursor.rowcount:
+            return None
+        return dict(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def job_ids_in_state(self, state: str) -> list:
+        # Only the ones that are due, a job waiting out its backoff would just fail the claim
+        rows = self._connection().execute(
+            "SELECT id FROM jobs WHERE state = ? AND (next_attempt_at IS NULL OR next_attempt_at <= ?) ORDER BY received_at, id",
+            (state, datetime.now().isoformat())
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def find_job_id(self, email_path: str):
+        row = self._connection().execute("SELECT id FROM jobs WHERE email_path = ?", (email_path,)).fetchone()
+        return row[0] if row else None
+
+    def update_job(self, job_id: int, state: str, **fields):
+        """
+        Moves a job to state and updates any other columns passed as keyword arguments.
+        """
+        fields['state'] = state
+        fields['updated_at'] = datetime.now().isoformat()
+        columns = ", ".join(f"{column} = ?" for column in fields)
+        self._connection().execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def record_failure(self, job_id: int, state: str, error: str, max_attempts: int = None) -> tuple:
+        """
+        Bumps the attempt counter and stores the failure reason. The job goes back to state to be retried once the
+        backoff has passed, or to the dead letters once it has failed max_attempts (JOB_MAX_ATTEMPTS) times.
+        Returns (new state, next_attempt_at or None).
+        """
+        max_attempts = max_attempts or JOB_MAX_ATTEMPTS
+        conn = self._connection()
+        row = conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        attempts = (row[0] if row else 0) + 1
+        if attempts >= max_attempts:
+            self.dead_letter(job_id, f"Gave up after {attempts} attempts. Last error: {error}", attempts=attempts)
+            return STATE_DEAD, None
+
+        now = datetime.now()
+        delay = min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+        next_attempt_at = (now + timedelta(seconds=delay)).isoformat()
+        conn.execute(
+            "UPDATE jobs SET state = ?, attempts = ?, last_error = ?, next_attempt_at = ?, updated_at = ? WHERE id = ?",
+            (state, attempts, error, next_attempt_at, now.isoformat(), job_id)
+        )
+        return state, next_attempt_at
+
+    def dead_letter(self, job_id: int, reason: str, attempts: int = None):
+        """
+        Parks a job for good: state dead with the reason in last_error, plus a JSON copy in DEAD_LETTER_DIR with
+        everything needed to look into it or replay it by hand.
+        """
+        conn = self._connection()
+        now = datetime.now().isoformat()
+        if attempts is None:
+            conn.execute("UPDATE jobs SET state = ?, last_error = ?, next_attempt_at = NULL, updated_at = ? WHERE id = ?",
+                         (STATE_DEAD, reason, now, job_id))
+        else:
+            conn.execute("UPDATE jobs SET state = ?, attempts = ?, last_error = ?, next_attempt_at = NULL, updated_at = ? "
+                         "WHERE id = ?", (STATE_DEAD, attempts, reason, now, job_id))
+        job = dict(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+        if DEAD_LETTER_DIR:
+            os.makedirs(DEAD_LETTER_DIR, exist_ok=True)
+            name = os.path.splitext(os.path.basename(job['email_path'] or f"job_{job_id}"))[0]
+            with open(os.path.join(DEAD_LETTER_DIR, f"dead_{job_id}_{name}.json"), 'w', encoding='utf-8') as f:
+                json.dump(job, f, ensure_ascii=False, indent=2)
+        print(f"  Job {job_id} moved to the dead letters: {reason}")
+
+    def dead_jobs(self) -> list:
+        rows = self._connection().execute(
+            "SELECT id, email_path, attempts, last_error, updated_at FROM jobs WHERE state = ? ORDER BY updated_at", (STATE_DEAD,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def requeue_dead(self, job_ids: list = None) -> int:
+        """
+        Gives dead jobs (all of them, or just job_ids) a fresh set of attempts. Jobs that already have a prompt go
+        back to the robot, the others to prompt generation. A submission the robot never confirmed is forgotten
+        too, re-queueing means someone checked the robot and wants it sent again.
+        """
+        conn = self._connection()
+        query = "SELECT * FROM jobs WHERE state = ?"
+        params = [STATE_DEAD]
+        if job_ids:
+            query += f" AND id IN ({', '.join('?' for _ in job_ids)})"
+            params.extend(job_ids)
+        dead = [dict(row) for row in conn.execute(query, params).fetchall()]
+
+        now = datetime.now().isoformat()
+        for job in dead:
+            conn.execute("UPDATE ledger SET submitted_at = NULL WHERE key = ? AND confirmed_at IS NULL",
+                         (job_idempotency_key(job),))
+            conn.execute("UPDATE jobs SET state = ?, attempts = 0, next_attempt_at = NULL, updated_at = ? "
+                         "WHERE id = ? AND state = ?",
+                         (STATE_FETCHED if job['prompt'] is None else STATE_PROMPTED, now, job['id'], STATE_DEAD))
+        return len(dead)
+
+    def mark_duplicate(self, job_id: int, original_job_id: int):
+        self.update_job(job_id, STATE_DUPLICATE, last_error=f"Same booking as job {original_job_id}", next_attempt_at=None)
+        print(f"  Job {job_id} is the same booking as job {original_job_id}. Skipping it.")
+
+    def ledger_entry(self, key: str):
+        """
+        The ledger row for an idempotency key as a dict, or None if no job with this booking was ever queued.
+        """
+        row = self._connection().execute("SELECT * FROM ledger WHERE key = ?", (key,)).fetchone()
+        return dict(row) if row else None
+
+    def record_stage(self, key: str, stage: str, job_id: int):
+        """
+        Notes that the booking behind key reached stage (one of LEDGER_STAGES). Only the first time counts, the
+        job that got there first stays the ledger's owner.
+        """
+        if stage not in LEDGER_STAGES:
+            raise ValueError(f"Unknown ledger stage '{stage}'")
+        conn = self._connection()
+        now = datetime.now().isoformat()
+        conn.execute("INSERT OR IGNORE INTO ledger (key, job_id) VALUES (?, ?)", (key, job_id))
+        conn.execute(f"UPDATE ledger SET {stage}_at = COALESCE({stage}_at, ?) WHERE key = ?", (now, key))
+
+    def requeue_stale(self, from_state: str, to_state: str, older_than_seconds: int, max_attempts: int = None) -> int:
+        """
+        Hands jobs that were claimed but never finished (the process died) back to the previous state. That counts
+        as a failed attempt, so a mail that kills the process every time ends up in the dead letters instead of
+        being picked up forever. Returns how many went back to to_state.
+        """
+        cutoff = (datetime.now() - timedelta(seconds=older_than_seconds)).isoformat()
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            job_ids = [row[0] for row in conn.execute(
+                "SELECT id FROM jobs WHERE state = ? AND claimed_at < ?", (from_state, cutoff)
+            ).fetchall()]
+            requeued = 0
+            for job_id in job_ids:
+                state, _ = self.record_failure(job_id, to_state, f"Claimed in '{from_state}' but never finished",
+                                               max_attempts)
+                if state == to_state:
+                    requeued += 1
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return requeued
+
+    def count_by_state(self) -> dict:
+        rows = self._connection().execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        return {row[0]: row[1] for row in rows}
+
+    def import_legacy_files(self, saved_mails_dir: str, saved_prompts_dir: str) -> int:
+        """
+        One-time migration from the directory based handoff: unprocessed emails become 'fetched' jobs and
+        prompt files still waiting for the robot become 'prompted' jobs. Runs once per database.
+        """
+        conn = self._connection()
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_imported'").fetchone():
+            return 0
+
+        imported = 0
+        if saved_mails_dir and os.path.isdir(saved_mails_dir):
+            for filename in sorted(os.listdir(saved_mails_dir)):
+                if not _SAVED_EMAIL_PATTERN.match(filename):
+                    continue
+                email_path = os.path.join(saved_mails_dir, filename)
+                with open(email_path, 'r', encoding='utf-8') as f:
+                    content = f.read()
+                self.add_job(email_path, content, sender_type=filename.rsplit('_', 2)[0])
+                imported += 1
+
+        if saved_prompts_dir and os.path.isdir(saved_prompts_dir):
+            for filename in sorted(os.listdir(saved_prompts_dir)):
+                if not (filename.startswith('processed_') and filename.endswith('.txt')):
+                    continue
+                prompt_path = os.path.join(saved_prompts_dir, filename)
+                with open(prompt_path, 'r', encoding='utf-8') as f:
+                    prompt = f.read().strip()
+                # There's no email to point at anymore, so the prompt file itself identifies the job
+                self.add_job(prompt_path, None, state=STATE_PROMPTED, prompt=prompt, prompt_path=prompt_path)
+                imported += 1
+
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_imported', ?)", (datetime.now().isoformat(),))
+        if imported:
+            print(f"Imported {imported} pending file(s) from the old directory handoff into '{self.db_path}'.")
+        return imported
+
+
+_job_stores = {}
+
+
+def get_job_store(db_path: str = None) -> JobStore:
+    """
+    Returns the shared JobStore for JOB_DB_PATH (default 'jobs.sqlite3'). Pending files left behind by the
+    old directory based handoff are imported the first time a database is opened.
+    """
+    db_path = db_path or os.getenv('JOB_DB_PATH', 'jobs.sqlite3')
+    store = _job_stores.get(db_path)
+    if store is None:
+        store = JobStore(db_path)
+        store.import_legacy_files(os.getenv('SAVED_MAILS_DIR', 'savedmails'), os.getenv('SAVED_PROMPTS_DIR', 'savedprompts'))
+        _job_stores[db_path] = store
+    return store
+
+
+if __name__ == "__main__":
+    # Quick look at the backlog: python jobstore.py
+    load_dotenv()
+    store = get_job_store()
+    counts = store.count_by_state()
+    if not counts:
+        print(f"No jobs in '{store.db_path}'.")
+    for state, count in sorted(counts.items()):
+        print(f"{state:>12}: {count}")
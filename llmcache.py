@@ -0,0 +1,118 @@
+# llmcache.py
+
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+def normalize_content(text: str) -> str:
+    """
+    Irons out differences that don't change what the model sees: line endings, trailing spaces and runs of blank lines.
+    An agency re-sending the same confirmation from another mail client still hits the cache.
+    """
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    text = re.sub(r"[ \t]+\n", "\n", text)
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip()
+
+
+def make_cache_key(content: str, template_version: str, model_name: str) -> str:
+    digest = hashlib.sha256()
+    for piece in (model_name, template_version, normalize_content(content)):
+        digest.update(piece.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent content-addressed cache for LLM responses, stored in SQLite.
+    Entries older than max_age_seconds are ignored and dropped, and evict() trims the least recently used
+    entries once the stored responses add up to more than max_bytes. Keeps hit/miss counters for reporting.
+    """
+
+    def __init__(self, db_path: str, max_bytes: int, max_age_seconds: int):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+
+        self._connection().execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used_at REAL NOT NULL
+            )
+        """)
+        self._connection().execute("CREATE INDEX IF NOT EXISTS responses_last_used_idx ON responses (last_used_at)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, the prompt stage calls the cache from its worker pool
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            db_dir = os.path.dirname(os.path.abspath(self.db_path))
+            os.makedirs(db_dir, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _count(self, hit: bool):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key: str):
+        """
+        Returns the cached response for key, or None on a miss.
+        """
+        conn = self._connection()
+        row = conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or now - row[1] > self.max_age_seconds:
+            if row is not None:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._count(hit=False)
+            return None
+
+        conn.execute("UPDATE responses SET last_used_at = ? WHERE key = ?", (now, key))
+        self._count(hit=True)
+        return row[0]
+
+    def put(self, key: str, response: str):
+        now = time.time()
+        self._connection().execute(
+            "INSERT OR REPLACE INTO responses (key, response, size, created_at, last_used_at) VALUES (?, ?, ?, ?, ?)",
+            (key, response, len(response.encode('utf-8')), now, now)
+        )
+
+    def evict(self) -> int:
+        """
+        Drops expired entries, then the least recently used ones until the cache fits in max_bytes.
+        Returns how many entries were removed.
+        """
+        conn = self._connection()
+        removed = conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age_seconds,)).rowcount
+
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total > self.max_bytes:
+            for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_used_at").fetchall():
+                if total <= self.max_bytes:
+                    break
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                total -= size
+                removed += 1
+        return removed
+
+    def stats(self) -> tuple:
+        with self._stats_lock:
+            return self.hits, self.misses
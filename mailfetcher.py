@@ -1,11 +1,24 @@
+from __future__ import annotations
+
 import os
 import ssl
-import re
+import time
+import threading
 from dotenv import load_dotenv
-from imapclient import IMAPClient
 from email.message import EmailMessage
 from email.parser import BytesParser
 from datetime import datetime, date
+from syncstate import FolderSyncState
+from emailrouter import EmailRouter
+from sequencestore import DailySequenceStore
+from jobstore import get_job_store, make_idempotency_key
+from bodyextract import extract_body, decode_text_part
+from tracing import tracer, new_trace_id
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # Only for the annotations, the real import happens in connect_imap so fetch-only runs start fast
+    from imapclient import IMAPClient
 
 # You don't want any email to run the rest of the script. Also since I'm storing emails that come from two sources this tag is a way to identify them
 EMAIL_SUBJECT_PATTERNS = {
@@ -25,31 +38,43 @@ CONTENT_MARKERS = {
     }
 }
 
+# Rules on other headers for agencies whose subjects aren't distinctive enough. Checked after the subject patterns.
+# Each rule is (field, pattern, tag) with field being 'subject', 'from' or 'list-id', e.g. ('from', r".*@agency\.com", "tag")
+EMAIL_HEADER_RULES = []
 
-def get_next_daily_sequence_from_files(output_dir: str, sender_type: str, email_date: datetime) -> int:
+# Compiled once at import. Routing an email is then a single regex call, see emailrouter.py
+EMAIL_ROUTER = EmailRouter(
+    [('subject', pattern, sender_type) for pattern, sender_type in EMAIL_SUBJECT_PATTERNS.items()] + EMAIL_HEADER_RULES,
+    CONTENT_MARKERS
+)
 
-    date_for_filename = email_date.strftime('%Y%m%d')
-    max_sequence = 0
-    
-    filename_prefix = f"{sender_type}_{today_str_for_filename}_"
-    
-    if os.path.exists(output_dir):
-        for filename in os.listdir(output_dir):
-            expected_min_len = len(filename_prefix) + 6 # Assuming there's <100 mails per day (99.txt = 6 letters). If not, just pay to automate dude
+# IDLE settings for watch_mailbox. RFC 2177 says to re-issue IDLE at least every 29 minutes, most servers cut it earlier
+IMAP_IDLE_TIMEOUT = int(os.getenv('IMAP_IDLE_TIMEOUT', 600))
+IMAP_IDLE_CHECK_INTERVAL = 30
+IMAP_RECONNECT_MAX_BACKOFF = int(os.getenv('IMAP_RECONNECT_MAX_BACKOFF', 300))
+
+# First pass only pulls the headers we route on. Bodies are fetched afterwards for matching mails only.
+HEADER_FETCH_ITEM = 'BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE LIST-ID MESSAGE-ID)]'
+# How many UIDs to fetch per round trip. Keeps memory flat when a backlog of thousands of mails piles up
+IMAP_FETCH_CHUNK_SIZE = int(os.getenv('IMAP_FETCH_CHUNK_SIZE', 200))
 
-            if (filename.startswith(filename_prefix) and 
-                filename.endswith(".txt") and 
-                len(filename) == expected_min_len):
-                
-                sequence_part = filename[len(filename_prefix) : len(filename_prefix) + 3]
-                try:
-                    current_sequence = int(sequence_part)
-                    if current_sequence > max_sequence:
-                        max_sequence = current_sequence
-                except ValueError:
-                    continue
-    
-    return max_sequence + 1
+
+_sequence_stores = {}
+_sequence_stores_lock = threading.Lock()
+
+
+def get_next_daily_sequence(output_dir: str, sender_type: str, email_date: datetime) -> int:
+    """
+    Returns the next free sequence number for sender_type on the email's day. Backed by a persistent
+    counter (see sequencestore.py), so this no longer lists and parses the whole output directory per email.
+    """
+    db_path = os.getenv('SEQUENCE_DB_PATH') or os.path.join(output_dir, '.sequences.sqlite3')
+    with _sequence_stores_lock:
+        store = _sequence_stores.get(db_path)
+        if store is None:
+            store = DailySequenceStore(db_path, archive_dir=output_dir)
+            _sequence_stores[db_path] = store
+    return store.next_sequence(sender_type, email_date)
 
 
 def extract_content_between_markers(text: str, start_marker: str, end_marker: str) -> str:
@@ -70,134 +95,490 @@ def extract_content_between_markers(text: str, start_marker: str, end_marker: st
     return text[start_of_content:end_index].strip()
 
 
-def fetch_emails(
-    host: str,
-    port: int,
-    username: str,
-    password: str,
-    output_base_dir: str, 
-    folder: str = 'INBOX',
-    mark_as_read: bool = False,
-    search_criteria: list = ['UNSEEN']
-):
-    saved_email_paths = []
-    
-    os.makedirs(output_base_dir, exist_ok=True)
-    print(f"Ensured output directory '{output_base_dir}' exists.")
+def connect_imap(host: str, port: int, username: str, password: str) -> IMAPClient:
+    """
+    Opens an SSL connection to the IMAP server and logs in. The caller is responsible for logging out.
+    """
+    from imapclient import IMAPClient
 
     ssl_context = ssl.create_default_context()
 
-    try:
-        with IMAPClient(host, port=port, ssl=True, ssl_context=ssl_context) as client:
-            print(f"Connecting to {host}...")
-            client.login(username, password)
-            print("Logged in successfully.")
+    print(f"Connecting to {host}...")
+    with tracer.span('imap.login', host=host):
+        client = IMAPClient(host, port=port, ssl=True, ssl_context=ssl_context)
+        client.login(username, password)
+    print("Logged in successfully.")
+    return client
 
-            client.select_folder(folder)
-            print(f"Selected folder: '{folder}'")
 
-            messages = client.search(search_criteria)
-            print(f"Found {len(messages)} potential emails matching search criteria ('{' '.join(search_criteria)}').")
+def open_folder_sync_state(sync_state_file: str, host: str, username: str, folder: str, select_info: dict):
+    """
+    Builds the FolderSyncState for a freshly selected folder, or returns None when no state file is configured.
+    """
+    if not sync_state_file:
+        return None
+    return FolderSyncState(
+        sync_state_file, host, username, folder,
+        uidvalidity=select_info.get(b'UIDVALIDITY'),
+        uidnext=select_info.get(b'UIDNEXT')
+    )
 
-            if not messages:
-                print("No new emails found matching the initial IMAP criteria.")
-                return []
 
-            response = client.fetch(messages, ['RFC822.HEADER', 'BODY[]', 'INTERNALDATE', 'FLAGS'])
-            
-            sorted_messages = sorted(response.items(), key=lambda item: item[1][b'INTERNALDATE'])
+def _get_header_fields(fetch_data: dict) -> bytes:
+    """
+    Servers echo the HEADER.FIELDS item back with their own quoting/casing, so look it up by prefix.
+    """
+    for key, value in fetch_data.items():
+        if isinstance(key, bytes) and key.upper().startswith(b'BODY[HEADER.FIELDS'):
+            return value or b''
+    return b''
 
 
-            for msg_id, data in sorted_messages:
-                raw_email_bytes_full = data[b'BODY[]']
-                raw_email_headers_bytes = data[b'RFC822.HEADER']
-                
-                msg_headers = BytesParser().parsebytes(raw_email_headers_bytes)
+def _to_str(value) -> str:
+    if isinstance(value, bytes):
+        return value.decode('ascii', errors='ignore')
+    return value or ''
 
-                subject = msg_headers.get('Subject', '').strip()
-                from_header = msg_headers.get('From', '').strip()
-                
-                matched_sender_type = None
-                for pattern, sender_type_prefix in EMAIL_SUBJECT_PATTERNS.items():
-                    if re.match(pattern, subject):
-                        matched_sender_type = sender_type_prefix
-                        break
-                
-                if not matched_sender_type:
+
+def _walk_bodystructure(structure, part_spec: str = ''):
+    """
+    Yields (part_spec, part) for every leaf part of an IMAP BODYSTRUCTURE, numbered the way BODY[<spec>] expects.
+    """
+    if isinstance(structure[0], list):
+        for index, child in enumerate(structure[0], start=1):
+            child_spec = f"{part_spec}.{index}" if part_spec else str(index)
+            yield from _walk_bodystructure(child, child_spec)
+    else:
+        # A single part message still has its body in BODY[1]
+        yield (part_spec or '1'), structure
+
+
+def _is_attachment_part(part) -> bool:
+    # The disposition sits in the extension data, whose position depends on the part type, so just look for it
+    for field in part[7:]:
+        if isinstance(field, tuple) and field and _to_str(field[0]).lower() == 'attachment':
+            return True
+    return False
+
+
+def _part_size(part):
+    # Body size in octets, the 7th field of a non-multipart BODYSTRUCTURE
+    try:
+        return int(part[6])
+    except (IndexError, TypeError, ValueError):
+        return None
+
+
+def find_text_part(structure):
+    """
+    Picks the part to download from a BODYSTRUCTURE: the first non-empty text/plain part, otherwise the first
+    text/html one, like bodyextract does for full messages. Returns (part_spec, subtype, encoding, charset), or None if there is no usable text part.
+    """
+    html_part = None
+    for part_spec, part in _walk_bodystructure(structure):
+        if _to_str(part[0]).lower() != 'text' or _is_attachment_part(part):
+            continue
+
+        subtype = _to_str(part[1]).lower()
+        params = part[2] or ()
+        charset = None
+        for i in range(0, len(params) - 1, 2):
+            if _to_str(params[i]).lower() == 'charset':
+                charset = _to_str(params[i + 1])
+        encoding = _to_str(part[5]).lower()
+
+        if subtype == 'plain':
+            # Some mailers send an empty plain alternative next to the real HTML body
+            if _part_size(part) == 0:
+                continue
+            return part_spec, subtype, encoding, charset
+        if subtype == 'html' and html_part is None:
+            html_part = (part_spec, subtype, encoding, charset)
+    return html_part
+
+
+def fetch_text_bodies(client: IMAPClient, msg_ids: list) -> dict:
+    """
+    Downloads just the text body of each message. BODYSTRUCTURE tells us which part holds the text,
+    so attachments (the PDFs agencies love) never cross the wire. Messages we can't map to a text part,
+    or servers that choke on BODYSTRUCTURE, fall back to a full BODY.PEEK[] fetch.
+    Returns {msg_id: body_text}.
+    """
+    bodies = {}
+    fallback_ids = list(msg_ids)
+
+    try:
+        structures = client.fetch(msg_ids, ['BODYSTRUCTURE'])
+
+        # Group by part spec so every distinct part number costs a single batched FETCH
+        by_part_spec = {}
+        part_info = {}
+        for msg_id in msg_ids:
+            structure = structures.get(msg_id, {}).get(b'BODYSTRUCTURE')
+            text_part = find_text_part(structure) if structure else None
+            if text_part:
+                part_info[msg_id] = text_part
+                by_part_spec.setdefault(text_part[0], []).append(msg_id)
+
+        for part_spec, ids in by_part_spec.items():
+            response = client.fetch(ids, [f'BODY.PEEK[{part_spec}]'])
+            for msg_id in ids:
+                payload = response.get(msg_id, {}).get(f'BODY[{part_spec}]'.encode())
+                if payload is None:
                     continue
+                _, subtype, encoding, charset = part_info[msg_id]
+                bodies[msg_id] = decode_text_part(payload, subtype, encoding, charset)
 
-                print(f"  Processing matched email {msg_id}: From='{from_header}', Subject='{subject}'")
+        fallback_ids = [msg_id for msg_id in msg_ids if msg_id not in bodies]
+    except Exception as e:
+        print(f"  BODYSTRUCTURE fetch failed ({e}). Falling back to full message download.")
+
+    if fallback_ids:
+        response = client.fetch(fallback_ids, ['BODY.PEEK[]'])
+        for msg_id in fallback_ids:
+            raw_email_bytes = response.get(msg_id, {}).get(b'BODY[]')
+            if raw_email_bytes is not None:
+                bodies[msg_id] = extract_body(raw_email_bytes)
+
+    return bodies
+
+
+def _iter_new_emails(
+    client: IMAPClient,
+    output_base_dir: str,
+    mark_as_read: bool = False,
+    search_criteria: list = ['UNSEEN'],
+    sync_state: FolderSyncState = None,
+    chunk_size: int = None
+):
+    """
+    Searches the currently selected folder and saves every email matched by EMAIL_ROUTER,
+    yielding (internal_date, file_path) as soon as each file is written.
+
+    Messages are fetched in UID chunks of chunk_size, so only one chunk worth of headers and bodies is ever
+    held in memory and callers can start working on the first mails while the rest are still on the server.
+    Within a chunk mails are handled in INTERNALDATE order.
 
-                full_msg = BytesParser().parsebytes(raw_email_bytes_full)
+    With a sync_state the search is 'UID n:*' above the stored watermark instead of relying on the \\Seen flag,
+    so mails opened by someone in a mail client aren't skipped and a crash doesn't fetch everything again.
+    The first run (or a UIDVALIDITY change) falls back to search_criteria once to seed the watermark.
+    """
+    chunk_size = chunk_size or IMAP_FETCH_CHUNK_SIZE
+    store = get_job_store()
+
+    incremental = sync_state is not None and sync_state.has_watermark
+    if incremental:
+        search_criteria = ['UID', f'{sync_state.last_uid + 1}:*']
+
+    with tracer.span('imap.search') as span_attrs:
+        messages = client.search(search_criteria)
+        span_attrs['messages'] = len(messages)
+    if incremental:
+        # 'n:*' always matches the newest message, even when its UID is below n
+        messages = [uid for uid in messages if uid > sync_state.last_uid]
+    print(f"Found {len(messages)} potential emails matching search criteria ('{' '.join(search_criteria)}').")
+
+    if not messages:
+        print("No new emails found matching the initial IMAP criteria.")
+        if sync_state is not None and not sync_state.has_watermark and sync_state.uidnext:
+            sync_state.advance(sync_state.uidnext - 1)
+        return
+
+    messages = sorted(messages)
+    all_processed = True
+
+    for chunk_start in range(0, len(messages), chunk_size):
+        chunk = messages[chunk_start:chunk_start + chunk_size]
+        if len(messages) > chunk_size:
+            print(f"Fetching emails {chunk_start + 1}-{chunk_start + len(chunk)} of {len(messages)}...")
+
+        # Phase 1: headers only. BODY.PEEK doesn't set \Seen, so irrelevant mail stays untouched for humans.
+        with tracer.span('imap.fetch_headers', messages=len(chunk)):
+            header_response = client.fetch(chunk, [HEADER_FETCH_ITEM, 'INTERNALDATE'])
+        
+        if incremental:
+            # UIDs are handed out in arrival order, and the watermark can only move forward contiguously
+            sorted_messages = sorted(header_response.items(), key=lambda item: item[0])
+        else:
+            sorted_messages = sorted(header_response.items(), key=lambda item: item[1][b'INTERNALDATE'])
+
+        candidates = []
+        for msg_id, data in sorted_messages:
+            msg_headers = BytesParser().parsebytes(_get_header_fields(data), headersonly=True)
+
+            subject = msg_headers.get('Subject', '').strip()
+            from_header = msg_headers.get('From', '').strip()
+            list_id = msg_headers.get('List-Id', '').strip()
+            
+            matched_sender_type, content_markers = EMAIL_ROUTER.route(subject, from_header, list_id)
+
+            candidates.append((msg_id, matched_sender_type, content_markers, subject, from_header, msg_headers.get('Date'),
+                               data.get(b'INTERNALDATE'), msg_headers.get('Message-ID', '')))
+        del header_response, sorted_messages
+
+        # Phase 2: bodies, but only for the mails we actually care about, in one batched round trip
+        matched_ids = [candidate[0] for candidate in candidates if candidate[1]]
+        tracer.count('emails_seen', len(candidates))
+        tracer.count('emails_matched', len(matched_ids))
+        with tracer.span('imap.fetch_bodies', messages=len(matched_ids)):
+            bodies = fetch_text_bodies(client, matched_ids) if matched_ids else {}
+
+        for msg_id, matched_sender_type, content_markers, subject, from_header, date_str, internal_date, message_id in candidates:
+            if not matched_sender_type:
+                if incremental:
+                    sync_state.advance(msg_id)
+                continue
+
+            print(f"  Processing matched email {msg_id}: From='{from_header}', Subject='{subject}'")
+
+            try:
+                email_date = datetime.strptime(date_str.split(' +')[0].strip(), '%a, %d %b %Y %H:%M:%S')
+            except (ValueError, AttributeError):
+                email_date = datetime.now()
+            
+            date_for_filename = email_date.strftime('%Y%m%d')
+
+
+            body_content = bodies.pop(msg_id, '')
+            
+            relevant_content = body_content
+            if content_markers:
+                start_m = content_markers["start"]
+                end_m = content_markers["end"]
+                relevant_content = extract_content_between_markers(body_content, start_m, end_m)
                 
-                date_str = full_msg.get('Date')
+                if relevant_content == body_content:
+                    print(f"  Warning: Markers not fully found for {matched_sender_type} email {msg_id}. Saving full body.")
+                else:
+                    print(f"  Extracted content between markers for {matched_sender_type} email {msg_id}.")
+
+            email_text = f"Subject: {subject}\nDate: {date_str}\n\n{relevant_content}"
+
+            # Already queued once: the \Seen flag or the watermark didn't stick last time, or the server delivered it twice
+            idempotency_key = make_idempotency_key(message_id, email_text)
+            ledger_entry = store.ledger_entry(idempotency_key)
+            if ledger_entry:
+                print(f"  Email {msg_id} is already queued as job {ledger_entry['job_id']}. Not saving it again.")
+                tracer.count('emails_deduplicated')
                 try:
-                    email_date = datetime.strptime(date_str.split(' +')[0].strip(), '%a, %d %b %Y %H:%M:%S')
-                except (ValueError, AttributeError):
-                    email_date = datetime.now()
-                
-                date_for_filename = email_date.strftime('%Y%m%d')
-
-                sequence_number = get_next_daily_sequence_from_files(output_base_dir, matched_sender_type, email_date)
-
-                body_content = ''
-
-                for part in full_msg.walk():
-                    ctype = part.get_content_type()
-                    cdisp = part.get('Content-Disposition')
-                    
-                    if cdisp is None or not cdisp.startswith('attachment'):
-                        if ctype == 'text/plain':
-                            try:
-                                body_content = part.get_payload(decode=True).decode(part.get_content_charset() or 'utf-8')
-                                break 
-                            except (UnicodeDecodeError, AttributeError):
-                                body_content = part.get_payload(decode=True).decode('latin-1', errors='ignore')
-                                break
-                        elif ctype == 'text/html' and not body_content:
-                            try:
-                                body_content = part.get_payload(decode=True).decode(part.get_content_charset() or 'utf-8')
-                            except (UnicodeDecodeError, AttributeError):
-                                body_content = part.get_payload(decode=True).decode('latin-1', errors='ignore')
-                
-                relevant_content = body_content
-                if matched_sender_type in CONTENT_MARKERS:
-                    start_m = CONTENT_MARKERS[matched_sender_type]["start"]
-                    end_m = CONTENT_MARKERS[matched_sender_type]["end"]
-                    relevant_content = extract_content_between_markers(body_content, start_m, end_m)
-                    
-                    if relevant_content == body_content:
-                        print(f"  Warning: Markers not fully found for {matched_sender_type} email {msg_id}. Saving full body.")
-                    else:
-                        print(f"  Extracted content between markers for {matched_sender_type} email {msg_id}.")
-
+                    if mark_as_read:
+                        client.set_flags(msg_id, ['\\Seen'])
+                except Exception as e:
+                    print(f"  Couldn't mark email {msg_id} as read: {e}")
+                if incremental:
+                    sync_state.advance(msg_id)
+                continue
+
+            # Never overwrite a mail that somehow already sits under the allocated name
+            file_path = None
+            while file_path is None or os.path.exists(file_path):
+                sequence_number = get_next_daily_sequence(output_base_dir, matched_sender_type, email_date)
                 filename = f"{matched_sender_type}_{date_for_filename}_{sequence_number:03d}.txt" 
                 file_path = os.path.join(output_base_dir, filename)
+            saved = False
 
-                try:
+            trace_id = new_trace_id()
+            try:
+                with tracer.trace(trace_id), tracer.span('email.save', uid=msg_id, sender_type=matched_sender_type):
                     with open(file_path, 'w', encoding='utf-8') as f:
-                        f.write(f"Subject: {subject}\n")
-                        f.write(f"Date: {date_str}\n\n")
-                        f.write(relevant_content)
-                    
+                        f.write(email_text)
+                
                     print(f"  Saved email to: {file_path}")
-                    saved_email_paths.append(file_path)
+
+                    # The job store is what the prompt stage picks work up from, the file is kept for humans
+                    store.add_job(file_path, email_text, sender_type=matched_sender_type, subject=subject,
+                                  message_uid=msg_id, received_at=internal_date or email_date,
+                                  trace_id=trace_id, idempotency_key=idempotency_key)
+                    saved = True
 
                     if mark_as_read:
                         client.set_flags(msg_id, ['\\Seen'])
-                except IOError as e:
-                    print(f"  Error saving file {file_path}: {e}")
-                except Exception as e:
-                    print(f"  An unexpected error occurred while processing email {msg_id}: {e}")
+                    if incremental:
+                        sync_state.advance(msg_id)
+            except IOError as e:
+                print(f"  Error saving file {file_path}: {e}")
+                all_processed = False
+            except Exception as e:
+                print(f"  An unexpected error occurred while processing email {msg_id}: {e}")
+                all_processed = False
+
+            if saved:
+                yield internal_date or email_date, file_path
+
+            if incremental and not all_processed:
+                # Stop here so the watermark stays below the failed message and the next run retries it
+                print(f"  Stopping at email {msg_id} so it is retried on the next run.")
+                return
+
+    if sync_state is not None and not incremental and all_processed:
+        # Seeding run: everything up to the current UIDNEXT has now been looked at
+        seed_uid = (sync_state.uidnext - 1) if sync_state.uidnext else max(messages)
+        sync_state.advance(seed_uid)
+
+
+def iter_new_emails(
+    client: IMAPClient,
+    output_base_dir: str,
+    mark_as_read: bool = False,
+    search_criteria: list = ['UNSEEN'],
+    sync_state: FolderSyncState = None,
+    chunk_size: int = None
+):
+    """
+    Generator version of process_new_emails: yields each saved file path as soon as it is written.
+    """
+    for _, file_path in _iter_new_emails(client, output_base_dir, mark_as_read, search_criteria, sync_state, chunk_size):
+        yield file_path
 
 
-    except Exception as e:
-        print(f"An error occurred during IMAP connection or email fetching: {e}")
+def process_new_emails(
+    client: IMAPClient,
+    output_base_dir: str,
+    mark_as_read: bool = False,
+    search_criteria: list = ['UNSEEN'],
+    sync_state: FolderSyncState = None
+) -> list:
+    """
+    Saves every new email matched by EMAIL_ROUTER from the currently selected folder and returns the
+    saved file paths. Works on an already logged in client so it can be reused by the watcher.
+    """
+    return list(iter_new_emails(client, output_base_dir, mark_as_read, search_criteria, sync_state))
+
+
+def stream_emails(
+    host: str,
+    port: int,
+    username: str,
+    password: str,
+    output_base_dir: str,
+    folder: str = 'INBOX',
+    mark_as_read: bool = False,
+    search_criteria: list = ['UNSEEN'],
+    sync_state_file: str = None,
+    chunk_size: int = None
+):
+    """
+    Streaming counterpart of fetch_emails for big backlogs: logs in once, pulls messages in UID chunks and
+    yields every saved file path straight away. Peak memory is bounded by the chunk size, not the backlog.
+    Connection errors are raised to the caller, since some paths may already have been handed out.
+    """
+    os.makedirs(output_base_dir, exist_ok=True)
+    print(f"Ensured output directory '{output_base_dir}' exists.")
+
+    try:
+        with connect_imap(host, port, username, password) as client:
+            select_info = client.select_folder(folder)
+            print(f"Selected folder: '{folder}'")
+
+            sync_state = open_folder_sync_state(sync_state_file, host, username, folder, select_info)
+            yield from iter_new_emails(client, output_base_dir, mark_as_read, search_criteria, sync_state, chunk_size)
     finally:
         print("IMAP client session closed.")
 
+
+def fetch_emails(
+    host: str,
+    port: int,
+    username: str,
+    password: str,
+    output_base_dir: str, 
+    folder: str = 'INBOX',
+    mark_as_read: bool = False,
+    search_criteria: list = ['UNSEEN'],
+    sync_state_file: str = None,
+    chunk_size: int = None
+):
+    saved_email_paths = []
+
+    try:
+        for file_path in stream_emails(host, port, username, password, output_base_dir, folder,
+                                       mark_as_read, search_criteria, sync_state_file, chunk_size):
+            saved_email_paths.append(file_path)
+
+    except Exception as e:
+        print(f"An error occurred during IMAP connection or email fetching: {e}")
+
     return saved_email_paths
 
+
+def _idle_until_new_mail(client: IMAPClient, idle_timeout: int, stop_event=None) -> bool:
+    """
+    Sits in IMAP IDLE until the server reports new mail (EXISTS), the stop event is set or idle_timeout
+    runs out. Returns True if new mail was announced.
+    """
+    client.idle()
+    idle_started = time.monotonic()
+    try:
+        while not (stop_event and stop_event.is_set()):
+            # Short checks so a shutdown request doesn't have to wait for the full IDLE period
+            responses = client.idle_check(timeout=IMAP_IDLE_CHECK_INTERVAL)
+            for response in responses:
+                if isinstance(response, tuple) and len(response) > 1 and response[1] == b'EXISTS':
+                    return True
+            if time.monotonic() - idle_started >= idle_timeout:
+                return False
+        return False
+    finally:
+        client.idle_done()
+
+
+def watch_mailbox(
+    host: str,
+    port: int,
+    username: str,
+    password: str,
+    output_base_dir: str,
+    on_new_emails,
+    folder: str = 'INBOX',
+    mark_as_read: bool = True,
+    search_criteria: list = ['UNSEEN'],
+    idle_timeout: int = None,
+    max_backoff: int = None,
+    stop_event=None,
+    sync_state_file: str = None
+):
+    """
+    Long-running alternative to fetch_emails. Keeps one authenticated session open, waits in IMAP IDLE
+    and hands every batch of saved email paths to on_new_emails(paths) as soon as the server announces
+    new mail. Dropped connections are re-established with exponential backoff.
+    mark_as_read should stay on, otherwise every wake-up would pick up the same UNSEEN mails again.
+    """
+    idle_timeout = idle_timeout or IMAP_IDLE_TIMEOUT
+    max_backoff = max_backoff or IMAP_RECONNECT_MAX_BACKOFF
+
+    os.makedirs(output_base_dir, exist_ok=True)
+    print(f"Ensured output directory '{output_base_dir}' exists.")
+
+    backoff = 1
+    while not (stop_event and stop_event.is_set()):
+        try:
+            with connect_imap(host, port, username, password) as client:
+                select_info = client.select_folder(folder)
+                print(f"Watching folder '{folder}' for new emails (IMAP IDLE)...")
+                backoff = 1
+
+                sync_state = open_folder_sync_state(sync_state_file, host, username, folder, select_info)
+
+                while not (stop_event and stop_event.is_set()):
+                    # Always search before going idle: on the first pass that picks up what arrived while we weren't
+                    # connected, later on what arrived while we were busy. The server announces that mail during our
+                    # own FETCH/STORE round trips, where imaplib swallows the EXISTS, so idle_check never sees it.
+                    # With the UID watermark this is one cheap SEARCH, and it keeps the session alive after a timeout
+                    saved = process_new_emails(client, output_base_dir, mark_as_read, search_criteria, sync_state)
+                    if saved:
+                        on_new_emails(saved)
+                        continue
+                    _idle_until_new_mail(client, idle_timeout, stop_event)
+        except Exception as e:
+            print(f"IMAP watch session dropped: {e}. Reconnecting in {backoff}s...")
+            if stop_event:
+                stop_event.wait(backoff)
+            else:
+                time.sleep(backoff)
+            backoff = min(backoff * 2, max_backoff)
+
+    print("Stopped watching mailbox.")
+
 if __name__ == "__main__":
     load_dotenv()
 
@@ -217,7 +598,8 @@ if __name__ == "__main__":
             username=IMAP_USER,
             password=IMAP_PASS,
             output_base_dir=EMAIL_OUTPUT_BASE_DIR,
-            mark_as_read=True
+            mark_as_read=True,
+            sync_state_file=os.getenv('IMAP_SYNC_STATE_FILE', os.path.join(EMAIL_OUTPUT_BASE_DIR, '.imap_sync_state.json'))
         )
 
         if processed_files:
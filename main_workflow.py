@@ -6,54 +6,43 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-import time
 from datetime import datetime
-import pyautogui
 
 
 project_root = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(project_root)
 
-from mailfetcher import fetch_emails
+from mailfetcher import fetch_emails, watch_mailbox
 from promptwriter import process_all_emails_for_prompts 
-from robot_desktop_automator import process_all_pending_robot_prompts
-
-load_dotenv()
+from robot_desktop_automator import process_all_pending_robot_prompts, activate_chrome_window
+from pipeline import run_pipeline
+from fetchcoordinator import load_mailbox_specs, fetch_all_mailboxes, iter_all_mailboxes, watch_all_mailboxes
+from automationpool import load_worker_slots, run_automation_pool
+from tracing import tracer
 
 # --- Configuration for the Orchestrator ---
 IMAP_HOST = os.getenv('EMAIL_HOST')
-IMAP_PORT = int(os.getenv('EMAIL_PORT'))
+IMAP_PORT = int(os.getenv('EMAIL_PORT', 993))
 IMAP_USER = os.getenv('EMAIL_USER')
 IMAP_PASS = os.getenv('EMAIL_PASS')
 EMAIL_OUTPUT_BASE_DIR = os.getenv('EMAIL_OUTPUT_BASE_DIR')
 ROBOT_PROMPTS_DIR = os.getenv('SAVED_PROMPTS_DIR')
-
-def run_full_workflow():
-    print(f"\n--- Workflow initiated at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
-
-    # 1. Email Retrieval
-    print("\nStarting Email Retrieval...")
-    try:
-
-        saved_emails = fetch_emails(
-            host=IMAP_HOST,
-            port=IMAP_PORT,
-            username=IMAP_USER,
-            password=IMAP_PASS,
-            output_base_dir=EMAIL_OUTPUT_BASE_DIR,
-            mark_as_read=True
-        )
-        print(f"Email retrieval completed. Found and processed {len(saved_emails)} new emails.")
-    except Exception as e:
-        print(f"Error during Email Retrieval: {e}")
-        
-        pass 
-
+# Remembers UIDVALIDITY and the last processed UID per folder so each run only looks at new mail
+IMAP_SYNC_STATE_FILE = os.getenv('IMAP_SYNC_STATE_FILE') or os.path.join(EMAIL_OUTPUT_BASE_DIR or '', '.imap_sync_state.json')
+# Several mailboxes/folders at once: point this at a JSON list of accounts, see fetchcoordinator.py
+IMAP_ACCOUNTS_FILE = os.getenv('IMAP_ACCOUNTS_FILE')
+
+def process_new_bookings():
+    """
+    Runs prompt generation and browser automation on whatever the fetch step has left behind.
+    Returns False if Chrome couldn't be activated.
+    """
     # 2. Prompt Generation
     print("\nStarting Prompt Generation...")
     try:
 
-        processed_for_prompts, failed_for_prompts = process_all_emails_for_prompts()
+        with tracer.span('stage.prompt'):
+            processed_for_prompts, failed_for_prompts = process_all_emails_for_prompts()
         print(f"Prompt generation completed. Generated {processed_for_prompts} prompts.")
         if failed_for_prompts > 0:
             print(f"  WARNING: {failed_for_prompts} emails failed prompt generation.")
@@ -64,35 +53,17 @@ def run_full_workflow():
     # 3. Browser Automation
     print("\nStarting Browser Automation...")
 
-    time.sleep(2) 
-
-    try:
-
-        all_windows = pyautogui.getWindowsWithTitle('')
-        
-        
-        chrome_windows = [
-            win for win in all_windows
-            if "Chrome" in win.title
-        ]
-
-        if chrome_windows:
-
-            chrome_windows[0].activate()
-            print(f"Activated Chrome window: '{chrome_windows[0].title}'")
-            time.sleep(2)
-        else:
-            print("Error: Chrome window not found. Please ensure Chrome is open and active before running the workflow.")
-            sys.exit(1)
-    except Exception as e:
-        print(f"An error occurred while trying to activate Chrome: {e}")
-        sys.exit(1)
-    except Exception as e:
-        print(f"An error occurred while trying to activate Chrome: {e}")
-        sys.exit(1)
+    # Pool workers bring their own Chrome windows (ROBOT_WORKER_DISPLAYS / ROBOT_WORKER_REGIONS)
+    worker_slots = load_worker_slots()
+    if not worker_slots and not activate_chrome_window():
+        return False
 
     try:
-        processed_robot_prompts, failed_robot_prompts = process_all_pending_robot_prompts()
+        with tracer.span('stage.automate'):
+            if worker_slots:
+                processed_robot_prompts, failed_robot_prompts = run_automation_pool(worker_slots)
+            else:
+                processed_robot_prompts, failed_robot_prompts = process_all_pending_robot_prompts()
         print(f"Browser automation completed. Automated {processed_robot_prompts} prompts.")
         if failed_robot_prompts > 0:
             print(f"  WARNING: {failed_robot_prompts} prompts failed automation.")
@@ -100,8 +71,113 @@ def run_full_workflow():
         print(f"Error during Browser Automation: {e}")
         pass
 
+    return True
+
+def run_full_workflow():
+    print(f"\n--- Workflow initiated at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
+
+    # 1. Email Retrieval
+    print("\nStarting Email Retrieval...")
+    try:
+
+        with tracer.span('stage.fetch'):
+            if IMAP_ACCOUNTS_FILE:
+                saved_emails = fetch_all_mailboxes(
+                    load_mailbox_specs(IMAP_ACCOUNTS_FILE),
+                    output_base_dir=EMAIL_OUTPUT_BASE_DIR,
+                    mark_as_read=True,
+                    sync_state_file=IMAP_SYNC_STATE_FILE
+                )
+            else:
+                saved_emails = fetch_emails(
+                    host=IMAP_HOST,
+                    port=IMAP_PORT,
+                    username=IMAP_USER,
+                    password=IMAP_PASS,
+                    output_base_dir=EMAIL_OUTPUT_BASE_DIR,
+                    mark_as_read=True,
+                    sync_state_file=IMAP_SYNC_STATE_FILE
+                )
+        print(f"Email retrieval completed. Found and processed {len(saved_emails)} new emails.")
+    except Exception as e:
+        print(f"Error during Email Retrieval: {e}")
+        
+        pass 
+
+    if not process_new_bookings():
+        sys.exit(1)
+
+    print("\nLatency summary:")
+    print(tracer.summary_report())
+    tracer.write_prometheus()
+
     print(f"\n--- Workflow finished at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
 
+def run_pipelined_workflow():
+    """
+    Same stages as run_full_workflow, but overlapped: each booking goes to the robot as soon as its own prompt is
+    ready instead of after the whole batch has been fetched and prompted.
+    """
+    print(f"\n--- Pipelined workflow initiated at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
+
+    if not activate_chrome_window():
+        sys.exit(1)
+
+    email_paths = None
+    if IMAP_ACCOUNTS_FILE:
+        email_paths = iter_all_mailboxes(load_mailbox_specs(IMAP_ACCOUNTS_FILE), EMAIL_OUTPUT_BASE_DIR,
+                                         mark_as_read=True, sync_state_file=IMAP_SYNC_STATE_FILE)
+
+    run_pipeline(
+        host=IMAP_HOST,
+        port=IMAP_PORT,
+        username=IMAP_USER,
+        password=IMAP_PASS,
+        output_base_dir=EMAIL_OUTPUT_BASE_DIR,
+        mark_as_read=True,
+        sync_state_file=IMAP_SYNC_STATE_FILE,
+        email_paths=email_paths
+    )
+
+    print(f"\n--- Workflow finished at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
+
+def run_watch_mode():
+    """
+    Keeps an IMAP IDLE session open and runs the rest of the pipeline as soon as new bookings land,
+    instead of waiting for the next scheduled run.
+    """
+    print(f"\n--- Watch mode started at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
+
+    def on_new_emails(saved_emails):
+        print(f"\n{len(saved_emails)} new email(s) received at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}.")
+        process_new_bookings()
+
+    if IMAP_ACCOUNTS_FILE:
+        watch_all_mailboxes(
+            load_mailbox_specs(IMAP_ACCOUNTS_FILE),
+            output_base_dir=EMAIL_OUTPUT_BASE_DIR,
+            on_new_emails=on_new_emails,
+            mark_as_read=True,
+            sync_state_file=IMAP_SYNC_STATE_FILE
+        )
+        return
+
+    watch_mailbox(
+        host=IMAP_HOST,
+        port=IMAP_PORT,
+        username=IMAP_USER,
+        password=IMAP_PASS,
+        output_base_dir=EMAIL_OUTPUT_BASE_DIR,
+        on_new_emails=on_new_emails,
+        mark_as_read=True,
+        sync_state_file=IMAP_SYNC_STATE_FILE
+    )
+
 if __name__ == "__main__":
 
-    run_full_workflow()
+    if len(sys.argv) > 1 and sys.argv[1] == 'watch':
+        run_watch_mode()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'pipeline':
+        run_pipelined_workflow()
+    else:
+        run_full_workflow()
@@ -0,0 +1,186 @@
+# pipeline.py
+#
+# Streaming version of run_full_workflow: fetching, prompt generation and the robot all run at the same time,
+# connected by bounded queues of job ids. The first booking is automated as soon as its own email has been
+# fetched and turned into a prompt, instead of after the whole batch.
+
+import os
+import time
+import queue
+import threading
+from mailfetcher import stream_emails
+from promptwriter import generate_prompt_for_job, GEMINI_MAX_CONCURRENCY, PROMPT_CLAIM_TIMEOUT
+from robot_desktop_automator import automate_job, screen_locator
+from tracing import tracer
+from jobstore import get_job_store, STATE_FETCHED, STATE_PROMPTING, STATE_PROMPTED, STATE_AUTOMATING
+
+# How many job ids can wait between two stages. When the robot falls behind the prompt workers block on a full
+# queue instead of running up Gemini calls (and the fetcher in turn stops pulling mail)
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', 20))
+PIPELINE_PROMPT_WORKERS = int(os.getenv('PIPELINE_PROMPT_WORKERS', GEMINI_MAX_CONCURRENCY))
+
+# Put on a queue to tell the consumers there's nothing more coming
+_DONE = object()
+
+
+def _stopping(stop_event) -> bool:
+    return stop_event is not None and stop_event.is_set()
+
+
+def _fetch_stage(store, prompt_queue: queue.Queue, email_paths, stats: dict, stop_event=None):
+    """
+    Feeds the prompt workers: first whatever earlier runs left in the queue, then every email as it's saved.
+    """
+    try:
+        for job_id in store.job_ids_in_state(STATE_FETCHED):
+            prompt_queue.put(job_id)
+
+        for email_path in email_paths:
+            if _stopping(stop_event):
+                # Mail saved from here on stays fetched for the next run
+                break
+            job_id = store.find_job_id(email_path)
+            if job_id is not None:
+                stats['fetched'] += 1
+                prompt_queue.put(job_id)
+    except Exception as e:
+        # Already queued emails still go through the rest of the pipeline
+        print(f"Error during Email Retrieval: {e}")
+
+
+def _prompt_stage(store, prompt_queue: queue.Queue, automation_queue: queue.Queue, stats: dict, stats_lock: threading.Lock,
+                  stop_event=None):
+    while True:
+        job_id = prompt_queue.get()
+        if job_id is _DONE:
+            return
+        if _stopping(stop_event):
+            # Keep draining without claiming so the fetcher never blocks on a full queue
+            continue
+        job = None
+        try:
+            job = store.claim_job(job_id, STATE_FETCHED, STATE_PROMPTING)
+            if job is None:
+                continue
+            ok = generate_prompt_for_job(store, job)
+        except Exception as e:
+            # A dead worker would leave the fetcher blocked on a full queue and the whole run hanging
+            print(f"Error generating the prompt for job {job_id}: {e}")
+            ok = False
+            if job is not None:
+                try:
+                    store.record_failure(job_id, STATE_FETCHED, str(e))
+                except Exception as record_error:
+                    # Stays in prompting, requeue_stale picks it up on a later run
+                    print(f"  Couldn't record the failure of job {job_id}: {record_error}")
+        with stats_lock:
+            stats['prompted' if ok else 'prompt_failed'] += 1
+        if ok:
+            automation_queue.put(job_id)
+
+
+def run_pipeline(
+    host: str,
+    port: int,
+    username: str,
+    password: str,
+    output_base_dir: str,
+    folder: str = 'INBOX',
+    mark_as_read: bool = True,
+    sync_state_file: str = None,
+    prompt_workers: int = None,
+    queue_size: int = None,
+    email_paths=None,
+    stop_event=None
+) -> dict:
+    """
+    Runs fetch -> prompt -> robot as overlapping stages and returns counters for the run.
+    Fetching runs on one thread, prompt generation on prompt_workers threads, and the robot on the calling thread,
+    since there's only one desktop. Chrome should already be in front when this is called.
+    Pass email_paths (e.g. iter_new_emails on an open client) to fetch over an existing session instead of logging in.
+    Once stop_event (a threading.Event) is set no new jobs are claimed: the booking on the robot is finished, the
+    rest stays queued in the job store for the next run.
+    """
+    prompt_workers = max(1, prompt_workers or PIPELINE_PROMPT_WORKERS)
+    queue_size = queue_size or PIPELINE_QUEUE_SIZE
+    store = get_job_store()
+
+    requeued = store.requeue_stale(STATE_PROMPTING, STATE_FETCHED, PROMPT_CLAIM_TIMEOUT)
+    if requeued:
+        print(f"Re-queued {requeued} email(s) left half-done by an interrupted run.")
+
+    prompt_queue = queue.Queue(maxsize=queue_size)
+    automation_queue = queue.Queue(maxsize=queue_size)
+    stats = {'fetched': 0, 'prompted': 0, 'prompt_failed': 0, 'completed': 0, 'automation_failed': 0}
+    stats_lock = threading.Lock()
+    started = time.perf_counter()
+    first_booking_seconds = None
+
+    if email_paths is None:
+        email_paths = stream_emails(host=host, port=port, username=username, password=password, output_base_dir=output_base_dir,
+                                    folder=folder, mark_as_read=mark_as_read, sync_state_file=sync_state_file)
+    fetch_thread = threading.Thread(target=_fetch_stage, args=(store, prompt_queue, email_paths, stats, stop_event),
+                                    name='pipeline-fetch', daemon=True)
+    prompt_threads = [
+        threading.Thread(target=_prompt_stage, args=(store, prompt_queue, automation_queue, stats, stats_lock, stop_event),
+                         name=f'pipeline-prompt-{i}', daemon=True)
+        for i in range(prompt_workers)
+    ]
+
+    def close_stages():
+        # Shut the stages down in order once the fetcher runs dry. The robot loop must get its _DONE whatever happens
+        try:
+            fetch_thread.join()
+            for _ in prompt_threads:
+                prompt_queue.put(_DONE)
+            for thread in prompt_threads:
+                thread.join()
+        finally:
+            automation_queue.put(_DONE)
+
+    fetch_thread.start()
+    for thread in prompt_threads:
+        thread.start()
+    threading.Thread(target=close_stages, name='pipeline-close', daemon=True).start()
+
+    in_flight = store.count_by_state().get(STATE_AUTOMATING, 0)
+    if in_flight:
+        print(f"  Note: {in_flight} job(s) are marked as being automated by another or an interrupted run. Check them manually.")
+
+    # Prompts left over from earlier runs go first, they have been waiting the longest
+    backlog = store.job_ids_in_state(STATE_PROMPTED)
+
+    while True:
+        job_id = backlog.pop(0) if backlog else automation_queue.get()
+        if job_id is _DONE:
+            break
+        if _stopping(stop_event):
+            continue
+        try:
+            job = store.claim_job(job_id, STATE_PROMPTED, STATE_AUTOMATING)
+            if job is None:
+                continue
+            ok = automate_job(store, job)
+        except Exception as e:
+            # Keep draining, otherwise the prompt workers block on a full queue. A claimed job stays in automating
+            print(f"Error automating job {job_id}: {e}")
+            ok = False
+        if ok:
+            stats['completed'] += 1
+            if first_booking_seconds is None:
+                first_booking_seconds = time.perf_counter() - started
+                print(f"First booking automated {first_booking_seconds:.1f}s after the run started.")
+        else:
+            stats['automation_failed'] += 1
+
+    stats['seconds'] = time.perf_counter() - started
+    stats['first_booking_seconds'] = first_booking_seconds
+    print(f"\nPipeline finished in {stats['seconds']:.1f}s. Fetched {stats['fetched']}, prompted {stats['prompted']} "
+          f"({stats['prompt_failed']} failed), automated {stats['completed']} ({stats['automation_failed']} failed).")
+    if screen_locator.stats:
+        print("Screen search timings:")
+        print(screen_locator.timing_report())
+    print("Latency summary:")
+    print(tracer.summary_report())
+    tracer.write_prometheus()
+    return stats
@@ -1,69 +1,343 @@
 import os
-import google.generativeai as genai
+import re
+import time
+import json
+import threading
 from dotenv import load_dotenv
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from jobstore import get_job_store, job_idempotency_key, STATE_FETCHED, STATE_PROMPTING, STATE_PROMPTED
+from ratelimit import TokenBucket, backoff_delay
+from llmcache import ResponseCache, make_cache_key
+from templateextractor import extract_robot_command
+from compaction import ContentCompactor
+from tracing import tracer, job_trace_id
 
 load_dotenv()
 
+GEMINI_MODEL_NAME = os.getenv('GEMINI_MODEL_NAME', 'gemini-2.5-flash')
+# Point this at fake_gemini.py (e.g. http://localhost:8089) to run the stage without the real API
+GEMINI_API_ENDPOINT = os.getenv('GEMINI_API_ENDPOINT')
 
+# Built on first use by get_model(), so importing this module doesn't touch the network or the Gemini SDK
+model = None
+_model_lock = threading.Lock()
 
-genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-model = genai.GenerativeModel('gemini-2.5-flash')
+# How many Gemini calls are in flight at once, and the per-minute budgets of our API tier (0 turns a limit off)
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', 4))
+GEMINI_REQUESTS_PER_MINUTE = int(os.getenv('GEMINI_REQUESTS_PER_MINUTE', 60))
+GEMINI_TOKENS_PER_MINUTE = int(os.getenv('GEMINI_TOKENS_PER_MINUTE', 0))
+GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', 5))
 
+_request_bucket = TokenBucket(GEMINI_REQUESTS_PER_MINUTE)
+_token_bucket = TokenBucket(GEMINI_TOKENS_PER_MINUTE)
 
+# Bump this whenever the instructions below change, so cached answers for the old wording are not reused
+PROMPT_TEMPLATE_VERSION = '1'
+
+PROMPT_INSTRUCTIONS = """
+    Extract the following information from the customer booking confirmation email content provided below:
+    - Bullet List of Information
+
+    Format this information into this text below, keeping the exact text: 
+    
+   (This here will be the prompt for the browser AI tool that mostly looks like: go to the given date, click on the given product etc.)
+    
+
+    That's it. Also please remeber some important formatting rules:
+    - Do not add any introductory or concluding remarks, explanations, or extra text. Provide ONLY the text I asked for.
+"""
+
+# Batch mode: K emails per request, so the instructions above are only paid for once. 1 turns batching off
+GEMINI_BATCH_SIZE = int(os.getenv('GEMINI_BATCH_SIZE', 1))
+
+BATCH_PROMPT_INSTRUCTIONS = """
+    Below are several emails, each one starts with a line "Email id: <id>". Handle every email on its own following the
+    instructions above and answer with a JSON array holding exactly one object per email:
+    {"id": "<the email id>", "command": "<the text for that email>"}
+"""
+
+BATCH_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {"id": {"type": "STRING"}, "command": {"type": "STRING"}},
+            "required": ["id", "command"]
+        }
+    }
+}
+
+# Cache of Gemini answers keyed by email content, template version and model. Set LLM_CACHE_PATH to an empty value to turn it off
+LLM_CACHE_PATH = os.getenv('LLM_CACHE_PATH', 'llm_cache.sqlite3')
+LLM_CACHE_MAX_MB = int(os.getenv('LLM_CACHE_MAX_MB', 50))
+LLM_CACHE_MAX_AGE_DAYS = int(os.getenv('LLM_CACHE_MAX_AGE_DAYS', 30))
+
+# Opened on first use by get_response_cache(), so importing this module doesn't create the file
+response_cache = None
+_response_cache_lock = threading.Lock()
+
+# The "Subject: ...\nDate: ...\n\n" lines mailfetcher puts in front of every saved email. A re-sent confirmation
+# only differs there, so they're left out of the cache key
+_SAVED_EMAIL_PREAMBLE = re.compile(r"\A(?:(?:Subject|Date):[^\n]*\n)+\n")
+
+# Upper bound for the email part of a Gemini prompt, after quotes, signatures and boilerplate are stripped. 0 = no cap
+MAX_PROMPT_TOKENS = int(os.getenv('MAX_PROMPT_TOKENS', 1500))
+
+content_compactor = ContentCompactor(MAX_PROMPT_TOKENS)
+
+# A job claimed for prompting longer ago than this belongs to a run that died, so it's handed back to the queue
+PROMPT_CLAIM_TIMEOUT = int(os.getenv('PROMPT_CLAIM_TIMEOUT', 900))
+
+
+def get_response_cache():
+    """
+    Returns the shared response cache, or None when LLM_CACHE_PATH is empty.
+    """
+    global response_cache
+    with _response_cache_lock:
+        if response_cache is None and LLM_CACHE_PATH:
+            response_cache = ResponseCache(LLM_CACHE_PATH, LLM_CACHE_MAX_MB * 1024 * 1024, LLM_CACHE_MAX_AGE_DAYS * 86400)
+    return response_cache
+
+
+def get_model():
+    """
+    Returns the shared Gemini model, configuring the SDK the first time it's needed.
+    """
+    global model
+    with _model_lock:
+        if model is None:
+            import google.generativeai as genai
+
+            if GEMINI_API_ENDPOINT:
+                genai.configure(api_key=os.getenv("GEMINI_API_KEY") or 'fake-key', transport='rest',
+                                client_options={'api_endpoint': GEMINI_API_ENDPOINT})
+            else:
+                genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+            model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    return model
+
+
+def _is_retryable_error(e: Exception) -> bool:
+    # google.api_core raises ResourceExhausted for 429 and ServiceUnavailable for 503, both carry .code
+    code = getattr(e, 'code', None)
+    return code in (429, 503) or type(e).__name__ in ('ResourceExhausted', 'ServiceUnavailable', 'TooManyRequests')
 
-def generate_robot_prompt_from_content(email_file_path: str):
 
+def generate_content_with_retry(prompt_text: str, generation_config: dict = None):
+    """
+    Calls the shared Gemini model within the request and token budgets. Rate limit (429) and overload (503)
+    answers are retried with jittered exponential backoff, anything else is raised straight away.
+    """
+    # Rough estimate, ~4 characters per token is close enough for budgeting
+    prompt_tokens = len(prompt_text) // 4 + 1
+
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        # Every attempt is billed against the quota, a retried prompt included
+        _token_bucket.acquire(prompt_tokens)
+        _request_bucket.acquire()
+        tracer.count('llm_requests')
+        try:
+            with tracer.span('llm.call', attempt=attempt):
+                return get_model().generate_content(prompt_text, generation_config=generation_config)
+        except Exception as e:
+            if attempt >= GEMINI_MAX_RETRIES or not _is_retryable_error(e):
+                raise
+            tracer.count('llm_retries')
+            delay = backoff_delay(attempt)
+            print(f"  Gemini is rate limiting us ({e}). Retrying in {delay:.1f}s (attempt {attempt + 1}/{GEMINI_MAX_RETRIES}).")
+            time.sleep(delay)
+
+
+def _resolve_without_gemini(email_content: str, sender_type: str = None):
+    """
+    Tries the local template and the response cache. Returns (robot_command or None, cache_key, content), where
+    content is the compacted email to send to Gemini if neither had an answer.
+    """
+    robot_command = extract_robot_command(sender_type, email_content) if sender_type else None
+    if robot_command:
+        tracer.count('template_renders')
+        print(f"Rendered prompt locally from the '{sender_type}' template, no Gemini call needed.")
+        return robot_command, None, email_content
+
+    # Compacted before the cache key, so the same booking with a different footer or reply chain still hits
+    email_content, tokens_before, tokens_after = content_compactor.compact(email_content, sender_type)
+    if tokens_after < tokens_before:
+        print(f"Compacted email from ~{tokens_before} to ~{tokens_after} tokens.")
+
+    cache = get_response_cache()
+    cache_key = None
+    robot_command = None
+    if cache:
+        cache_body = _SAVED_EMAIL_PREAMBLE.sub('', email_content, count=1)
+        cache_key = make_cache_key(cache_body, PROMPT_TEMPLATE_VERSION, GEMINI_MODEL_NAME)
+        robot_command = cache.get(cache_key)
+    if robot_command:
+        tracer.count('llm_cache_hits')
+        print("Using cached prompt for identical email content.")
+    else:
+        tracer.count('llm_cache_misses')
+    return robot_command, cache_key, email_content
+
+
+def _generate_robot_command(email_content: str, cache_key: str = None) -> str:
+    print("Generating prompt from email content...")
+    
+    gemini_prompt = f"""{PROMPT_INSTRUCTIONS}
+    Email Content:
+    ---
+    {email_content}
+    ---
+    """
+    response = generate_content_with_retry(gemini_prompt)
+    robot_command = response.text.strip()
+
+    if not robot_command:
+        raise ValueError("Gemini generated an empty or no response.")
+
+    if cache_key:
+        get_response_cache().put(cache_key, robot_command)
+    return robot_command
+
+
+def build_robot_prompt(email_content: str, sender_type: str = None) -> str:
+    """
+    Turns one email into the robot command. Known agency templates are filled in locally (see templateextractor.py),
+    everything else goes to Gemini. Raises on API errors or an empty answer.
+    """
+    CONSTANT_APPEND_LINE = os.getenv('CONSTANT_APPEND_LINE', '')
+
+    with tracer.span('prompt.build', sender_type=sender_type) as span_attrs:
+        robot_command, cache_key, email_content = _resolve_without_gemini(email_content, sender_type)
+        span_attrs['source'] = 'local' if robot_command else 'gemini'
+        if not robot_command:
+            robot_command = _generate_robot_command(email_content, cache_key)
+
+    """ This was a trick I used because I realised most of the prompt was constant and only a bit at the
+        beginning was going to change, so why send the whole thing to the API and increase my input tokens unnecessarily"""
+    return robot_command + "\n" + CONSTANT_APPEND_LINE
+
+
+def _parse_batch_response(response_text: str, expected_ids: set) -> dict:
+    """
+    Validates the JSON answer of a batched request. Returns {email_id: robot_command} for the items that look right,
+    anything missing, unknown, duplicated or empty is left out so the caller can redo it on its own.
+    """
     try:
-        with open(email_file_path, 'r', encoding='utf-8') as f:
-            email_content = f.read()
+        items = json.loads(response_text)
+    except ValueError:
+        return {}
+    if not isinstance(items, list):
+        return {}
 
-        SAVED_MAILS_DIR = os.getenv('SAVED_MAILS_DIR', 'savedmails')
-        SAVED_PROMPTS_DIR = os.getenv('SAVED_PROMPTS_DIR', 'savedprompts')
-        CONSTANT_APPEND_LINE = os.getenv('CONSTANT_APPEND_LINE')
+    commands = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        email_id = str(item.get('id', ''))
+        command = item.get('command')
+        if email_id in expected_ids and email_id not in commands and isinstance(command, str) and command.strip():
+            commands[email_id] = command.strip()
+    return commands
 
-        print(f"Generating prompt from email content...")
-        
-        gemini_prompt = f"""
-        Extract the following information from the customer booking confirmation email content provided below:
-        - Bullet List of Information
 
-        Format this information into this text below, keeping the exact text: 
-        
-       (This here will be the prompt for the browser AI tool that mostly looks like: go to the given date, click on the given product etc.)
-        
+def build_robot_prompts_batch(items: list, trace_ids: dict = None) -> dict:
+    """
+    Batched version of build_robot_prompt. items is a list of (item_id, email_content, sender_type).
+    Everything the templates and the cache can't answer goes to Gemini in ONE request, so the instruction block is
+    paid once per batch instead of once per email. Items missing from the answer or failing validation fall back to
+    single calls. Returns {item_id: final prompt text, or the exception that made it fail}.
+    trace_ids ({item_id: trace id}) puts the per-email work in each booking's own trace.
+    """
+    trace_ids = trace_ids or {}
+    with tracer.span('prompt.build', batch_size=len(items), trace_ids=list(trace_ids.values())) as span_attrs:
+        results = _build_robot_prompts_batch(items, trace_ids)
+        span_attrs['failed'] = sum(1 for outcome in results.values() if isinstance(outcome, Exception))
+    return results
 
-        That's it. Also please remeber some important formatting rules:
-        - Do not add any introductory or concluding remarks, explanations, or extra text. Provide ONLY the text I asked for.
 
-        Email Content:
-        ---
-        {email_content}
-        ---
-        """
-        genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(gemini_prompt)
-        robot_command = response.text.strip()
+def _build_robot_prompts_batch(items: list, trace_ids: dict) -> dict:
+    CONSTANT_APPEND_LINE = os.getenv('CONSTANT_APPEND_LINE', '')
+    batch_trace_id = tracer.current_trace_id()
+    commands = {}
+    pending = []
 
+    for item_id, email_content, sender_type in items:
+        with tracer.trace(trace_ids.get(item_id, batch_trace_id)):
+            robot_command, cache_key, email_content = _resolve_without_gemini(email_content, sender_type)
         if robot_command:
-            """ This was a trick I used because I realised most of the prompt was constant and only a bit at the
-                beginning was going to change, so why send the whole thing to the API and increase my input tokens unnecessarily"""
-            final_output_content = robot_command + "\n" + CONSTANT_APPEND_LINE
-
-            original_basename = os.path.basename(email_file_path)
-            name, ext = os.path.splitext(original_basename)
-            
-            new_email_filename = f"processed_{name}{ext}"
-
-            new_email_file_path = os.path.join(SAVED_MAILS_DIR, new_email_filename)
-            shutil.move(email_file_path, new_email_file_path)
-            print(f"  Archived original email: {original_basename} -> {os.path.basename(new_email_file_path)}")
-            return final_output_content
-            
+            commands[item_id] = robot_command
         else:
-            print("Gemini generated an empty or no response.")
-            return False # Indicate failure
+            pending.append((item_id, email_content, cache_key))
+
+    if len(pending) > 1:
+        print(f"Generating prompts for {len(pending)} emails in one batched request...")
+        emails_block = "\n".join(f"    Email id: {item_id}\n    ---\n    {email_content}\n    ---" for item_id, email_content, _ in pending)
+        gemini_prompt = f"""{PROMPT_INSTRUCTIONS}{BATCH_PROMPT_INSTRUCTIONS}
+{emails_block}
+    """
+        try:
+            response = generate_content_with_retry(gemini_prompt, generation_config=BATCH_GENERATION_CONFIG)
+            batch_commands = _parse_batch_response(response.text, {str(item_id) for item_id, _, _ in pending})
+        except Exception as e:
+            print(f"  Batched request failed ({e}). Falling back to one request per email.")
+            batch_commands = {}
+
+        for item_id, _, cache_key in pending:
+            robot_command = batch_commands.get(str(item_id))
+            if robot_command:
+                commands[item_id] = robot_command
+                if cache_key:
+                    get_response_cache().put(cache_key, robot_command)
+
+        if len(batch_commands) < len(pending):
+            print(f"  {len(pending) - len(batch_commands)} email(s) came back missing or malformed, retrying them one by one.")
+
+    results = {}
+    for item_id, email_content, cache_key in pending:
+        if item_id in commands:
+            continue
+        try:
+            with tracer.trace(trace_ids.get(item_id, batch_trace_id)):
+                commands[item_id] = _generate_robot_command(email_content, cache_key)
+        except Exception as e:
+            results[item_id] = e
+
+    for item_id, robot_command in commands.items():
+        results[item_id] = robot_command + "\n" + CONSTANT_APPEND_LINE
+    return results
+
+
+def archive_email_file(email_file_path: str) -> str:
+    """
+    Renames a handled email to processed_<name> so it's obvious in the folder which mails are done.
+    """
+    SAVED_MAILS_DIR = os.getenv('SAVED_MAILS_DIR', 'savedmails')
+
+    original_basename = os.path.basename(email_file_path)
+    name, ext = os.path.splitext(original_basename)
+    
+    new_email_filename = f"processed_{name}{ext}"
+
+    new_email_file_path = os.path.join(SAVED_MAILS_DIR, new_email_filename)
+    shutil.move(email_file_path, new_email_file_path)
+    print(f"  Archived original email: {original_basename} -> {os.path.basename(new_email_file_path)}")
+    return new_email_file_path
+
+
+def generate_robot_prompt_from_content(email_file_path: str):
+
+    try:
+        with open(email_file_path, 'r', encoding='utf-8') as f:
+            email_content = f.read()
+
+        # Saved emails are named <sender_type>_<YYYYMMDD>_<seq>.txt
+        sender_type = os.path.basename(email_file_path).rsplit('_', 2)[0]
+        final_output_content = build_robot_prompt(email_content, sender_type)
+        archive_email_file(email_file_path)
+        return final_output_content
 
     except Exception as e:
         print(f"Error generating prompt: {e}")
@@ -74,50 +348,134 @@ def process_all_emails_for_prompts():
     processed_count = 0
     failed_count = 0
     
-    SAVED_MAILS_DIR = os.getenv('SAVED_MAILS_DIR', 'savedmails')
-
     SAVED_PROMPTS_DIR = os.getenv('SAVED_PROMPTS_DIR', 'savedprompts') 
 
-    if not os.path.exists(SAVED_MAILS_DIR):
-        print(f"Saved mails directory '{SAVED_MAILS_DIR}' does not exist.")
-        return 0, 0
-    
     os.makedirs(SAVED_PROMPTS_DIR, exist_ok=True)
 
-    email_files_to_process = [f for f in os.listdir(SAVED_MAILS_DIR) if (f.startswith('agency 1') or f.startswith('agency 2')) and f.endswith('.txt')]
+    cache = get_response_cache()
+    cache_hits_before, cache_misses_before = cache.stats() if cache else (0, 0)
+    compacted_before, tokens_before_before, tokens_after_before = content_compactor.stats()
+
+    store = get_job_store()
+    requeued = store.requeue_stale(STATE_PROMPTING, STATE_FETCHED, PROMPT_CLAIM_TIMEOUT)
+    if requeued:
+        print(f"Re-queued {requeued} email(s) left half-done by an interrupted run.")
+
+    jobs = [job for job in store.claim_jobs(STATE_FETCHED, STATE_PROMPTING) if not _skip_duplicate_booking(store, job)]
 
-    if not email_files_to_process:
-        print(f"No new email files found in '{SAVED_MAILS_DIR}' to process for prompts.")
+    if not jobs:
+        print(f"No new emails waiting in '{store.db_path}' to process for prompts.")
         return 0, 0
 
-    print(f"Found {len(email_files_to_process)} email files in '{SAVED_MAILS_DIR}'.")
+    print(f"Found {len(jobs)} emails waiting for prompts in '{store.db_path}'. Generating with up to {GEMINI_MAX_CONCURRENCY} requests in flight.")
 
-    for filename in email_files_to_process:
-        email_file_path = os.path.join(SAVED_MAILS_DIR, filename)
-        
-        generated_prompt_content = generate_robot_prompt_from_content(email_file_path)
+    # Only the Gemini calls run in the pool. Results are handled here, one batch at a time, as they come back.
+    batch_size = max(1, GEMINI_BATCH_SIZE)
+    with ThreadPoolExecutor(max_workers=GEMINI_MAX_CONCURRENCY) as executor:
+        futures = {}
+        for start in range(0, len(jobs), batch_size):
+            batch = jobs[start:start + batch_size]
+            if batch_size > 1:
+                future = executor.submit(tracer.run_in_trace, job_trace_id(batch[0]), build_robot_prompts_batch,
+                                         [(job['id'], job['content'], job['sender_type']) for job in batch],
+                                         {job['id']: job_trace_id(job) for job in batch})
+            else:
+                future = executor.submit(tracer.run_in_trace, job_trace_id(batch[0]), build_robot_prompt,
+                                         batch[0]['content'], batch[0]['sender_type'])
+            futures[future] = batch
 
-        if generated_prompt_content:
+        for future in as_completed(futures):
+            batch = futures[future]
             try:
-                original_basename_no_ext = os.path.splitext(os.path.basename(email_file_path))[0]
-                prompt_filename = f"processed_{original_basename_no_ext}_robot_command.txt"
-                prompt_file_path = os.path.join(SAVED_PROMPTS_DIR, prompt_filename)
-
-                with open(prompt_file_path, 'w', encoding='utf-8') as f:
-                    f.write(generated_prompt_content)
-                
-                print(f"  Successfully generated and saved prompt for '{filename}' to '{prompt_filename}'")
-                processed_count += 1
+                outcome = future.result()
+                results = outcome if batch_size > 1 else {batch[0]['id']: outcome}
             except Exception as e:
-                failed_count += 1
-                print(f"  Error saving generated prompt for email '{filename}': {e}. The email might still be archived, but no prompt file was created.")
-        else:
-            failed_count += 1
-            print(f"  Failed to generate prompt for email: '{filename}'. It might have been archived by the generator if Gemini returned an empty response.")
+                results = {job['id']: e for job in batch}
+
+            for job in batch:
+                # Each booking's outcome lands in its own trace, batched or not
+                with tracer.trace(job_trace_id(job)), tracer.span('prompt.save', job_id=job['id']) as span_attrs:
+                    span_attrs['ok'] = _save_generated_prompt(store, job, results[job['id']], SAVED_PROMPTS_DIR)
+                if span_attrs['ok']:
+                    processed_count += 1
+                else:
+                    failed_count += 1
     
     print(f"Prompt generation complete. Successfully processed: {processed_count}, Failed: {failed_count}")
+    if cache:
+        cache_hits, cache_misses = cache.stats()
+        evicted = cache.evict()
+        print(f"Gemini response cache: {cache_hits - cache_hits_before} hit(s), {cache_misses - cache_misses_before} miss(es), {evicted} evicted.")
+    compacted, tokens_before, tokens_after = content_compactor.stats()
+    if compacted > compacted_before:
+        print(f"Email content sent for prompting: ~{tokens_before - tokens_before_before} tokens before compaction, "
+              f"~{tokens_after - tokens_after_before} after ({compacted - compacted_before} email(s)).")
     return processed_count, failed_count
 
+
+def _skip_duplicate_booking(store, job: dict) -> bool:
+    # One ledger lookup instead of a Gemini call for a booking another job already owns
+    ledger_entry = store.ledger_entry(job_idempotency_key(job))
+    if ledger_entry is None or ledger_entry['job_id'] == job['id']:
+        return False
+    store.mark_duplicate(job['id'], ledger_entry['job_id'])
+    tracer.count('duplicate_bookings')
+    return True
+
+
+def generate_prompt_for_job(store, job: dict) -> bool:
+    """
+    Generates and records the prompt for one job already claimed as prompting. Used by the pipelined orchestrator,
+    which hands over jobs one at a time instead of claiming the whole backlog. Returns True on success.
+    """
+    SAVED_PROMPTS_DIR = os.getenv('SAVED_PROMPTS_DIR', 'savedprompts')
+    os.makedirs(SAVED_PROMPTS_DIR, exist_ok=True)
+    with tracer.trace(job_trace_id(job)):
+        if _skip_duplicate_booking(store, job):
+            return False
+        try:
+            outcome = build_robot_prompt(job['content'], job['sender_type'])
+        except Exception as e:
+            outcome = e
+        return _save_generated_prompt(store, job, outcome, SAVED_PROMPTS_DIR)
+
+
+def _save_generated_prompt(store, job: dict, outcome, SAVED_PROMPTS_DIR: str) -> bool:
+    """
+    Records the outcome of one generation (the prompt text or the exception it failed with) in the job store and
+    writes the prompt file. Returns True on success.
+    """
+    email_file_path = job['email_path']
+    filename = os.path.basename(email_file_path)
+
+    if isinstance(outcome, Exception):
+        state, next_attempt_at = store.record_failure(job['id'], STATE_FETCHED, str(outcome))
+        if next_attempt_at:
+            print(f"  Failed to generate prompt for email: '{filename}': {outcome}. Retrying after {next_attempt_at}.")
+        return False
+    generated_prompt_content = outcome
+
+    # The job row is the source of truth, so record the prompt before touching any files.
+    # The robot stage starts with a fresh set of attempts
+    store.update_job(job['id'], STATE_PROMPTED, prompt=generated_prompt_content, attempts=0, next_attempt_at=None)
+    store.record_stage(job_idempotency_key(job), 'prompted', job['id'])
+
+    try:
+        original_basename_no_ext = os.path.splitext(filename)[0]
+        prompt_filename = f"processed_{original_basename_no_ext}_robot_command.txt"
+        prompt_file_path = os.path.join(SAVED_PROMPTS_DIR, prompt_filename)
+
+        with open(prompt_file_path, 'w', encoding='utf-8') as f:
+            f.write(generated_prompt_content)
+
+        archived_email_path = archive_email_file(email_file_path) if os.path.exists(email_file_path) else email_file_path
+        store.update_job(job['id'], STATE_PROMPTED, prompt_path=prompt_file_path, email_path=archived_email_path)
+        
+        print(f"  Successfully generated and saved prompt for '{filename}' to '{prompt_filename}'")
+    except Exception as e:
+        print(f"  Error saving prompt file for email '{filename}': {e}. The prompt is stored in the job queue, so automation is unaffected.")
+    return True
+
 if __name__ == "__main__":
     # For testing this script independently
     processed, failed = process_all_emails_for_prompts()
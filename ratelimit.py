@@ -0,0 +1,46 @@
+# ratelimit.py
+
+import time
+import random
+import threading
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket for per-minute budgets (requests per minute, tokens per minute).
+    acquire() blocks until the budget allows the call. A rate of 0 or less disables the limit.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+
+    def acquire(self, amount: float = 1):
+        if self.rate_per_second <= 0:
+            return
+        # A single call bigger than the whole bucket would wait forever, so it just takes everything
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait_seconds = (amount - self.tokens) / self.rate_per_second
+            time.sleep(wait_seconds)
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """
+    Exponential backoff with full jitter: a random delay between 0 and base * 2^attempt, capped.
+    Spreads retries out so parallel workers don't hammer the API in lockstep after a 429.
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
@@ -1,11 +1,15 @@
 # robot_desktop_automator.py
 
-import pyautogui
 import time
 import os
-import pyperclip
 import shutil 
+import sys
+import threading
+from contextlib import nullcontext
 from dotenv import load_dotenv
+from screenlocator import ScreenLocator
+from tracing import tracer, job_trace_id
+from jobstore import get_job_store, job_idempotency_key, STATE_PROMPTED, STATE_AUTOMATING, STATE_COMPLETED
 
 load_dotenv()
 """This is my way of interacting with the browser plugin that is the AI agent. This may not work for you
@@ -13,142 +17,418 @@ because the tool you use might be designed otherwise. I'm still leaving it here
 """
 ROBOT_NEW_CHAT_BUTTON_IMAGE = 'filename.png'
 ROBOT_ACTUAL_INPUT_AREA_IMAGE = 'filename.png'
+# Something only a freshly reset chat shows, e.g. the empty input with its placeholder under the welcome text.
+# Waited for after "New Chat" so the paste can't land in the old conversation while it's still being cleared
+ROBOT_EMPTY_CHAT_IMAGE = 'filename.png'
 ROBOT_SUBMIT_BUTTON_IMAGE = 'filename.png'
 BOOKING_CONFIRMATION_IMAGE = 'filename.png'
 
-def click_image_on_screen(image_path: str, confidence=0.9, attempts=3, interval=5) -> tuple:
+# How long each step may wait for its button, and how long the robot gets to show the booking confirmation
+ROBOT_STEP_TIMEOUT = float(os.getenv('ROBOT_STEP_TIMEOUT', 15))
+BOOKING_CONFIRMATION_TIMEOUT = float(os.getenv('BOOKING_CONFIRMATION_TIMEOUT', 60))
+WAIT_POLL_INTERVAL = float(os.getenv('WAIT_POLL_INTERVAL', 0.1))
+# Only used when there is no BOOKING_CONFIRMATION_IMAGE to wait for
+ROBOT_UNCONFIRMED_WAIT = float(os.getenv('ROBOT_UNCONFIRMED_WAIT', 7))
+# 'gui' clicks through the screen, 'cdp' types straight into the extension page over DevTools (see cdp_driver.py)
+# and only falls back to the screen when the page can't be reached
+ROBOT_DRIVER = os.getenv('ROBOT_DRIVER', 'gui').strip().lower()
+
+# The module that moves the mouse and presses keys, plus the clipboard module. Both are imported on first use so
+# importing this file works on headless hosts. set_gui_backend() swaps in anything exposing the same functions
+_gui_backend = None
+_clipboard_backend = None
+
+def set_gui_backend(gui_backend, clipboard_backend=None):
+    """
+    Replaces pyautogui (and optionally pyperclip) for the robot, e.g. with a shim that serves saved screenshots.
+    The screen locator takes its screenshots from the new backend too.
+    """
+    global _gui_backend, _clipboard_backend
+    _gui_backend = gui_backend
+    if clipboard_backend is not None:
+        _clipboard_backend = clipboard_backend
+    screen_locator.screenshot_fn = gui_backend.screenshot
+
+# Where this process's part of the screen starts, and the lock held while pasting. Only changed by automation
+# workers (see automationpool.py); a single robot keeps the whole screen and a lock nobody else shares
+_screen_origin = (0, 0)
+_input_lock = threading.RLock()
+_shared_display = False
+
+def set_screen_region(region: tuple):
+    """
+    Confines the robot to region=(left, top, width, height) of the screen, for a worker driving one of several
+    browser windows laid out side by side. Searches only look inside it and clicks are shifted to match.
+    """
+    global _screen_origin
+    left, top, width, height = region
+    full_screenshot = get_gui_backend().screenshot
+
+    def region_screenshot(region: tuple = None):
+        if region is None:
+            return full_screenshot(region=(left, top, width, height))
+        x, y, w, h = region
+        return full_screenshot(region=(left + x, top + y, w, h))
+
+    screen_locator.screenshot_fn = region_screenshot
+    _screen_origin = (left, top)
+
+def set_input_lock(lock, shared_display: bool = False):
+    """
+    Shares lock with the other automation workers. It's always held around the clipboard paste. With shared_display
+    (several windows on one screen, one mouse and keyboard) it's held from the first click to the submit as well.
+    """
+    global _input_lock, _shared_display
+    _input_lock = lock
+    _shared_display = shared_display
+
+def get_gui_backend():
+    global _gui_backend
+    if _gui_backend is None:
+        import pyautogui
+        _gui_backend = pyautogui
+    return _gui_backend
+
+def get_clipboard_backend():
+    global _clipboard_backend
+    if _clipboard_backend is None:
+        import pyperclip
+        _clipboard_backend = pyperclip
+    return _clipboard_backend
+
+# Keeps the button images in memory and remembers where each one was last seen, see screenlocator.py
+screen_locator = ScreenLocator()
+screen_locator.preload([path for path in (ROBOT_NEW_CHAT_BUTTON_IMAGE, ROBOT_ACTUAL_INPUT_AREA_IMAGE, ROBOT_EMPTY_CHAT_IMAGE,
+                                          ROBOT_SUBMIT_BUTTON_IMAGE, BOOKING_CONFIRMATION_IMAGE) if os.path.exists(path)])
+
+def wait_until(condition, timeout: float, interval: float = None, description: str = "the UI"):
+    """
+    Polls condition() every interval seconds until it returns something truthy, then returns that value straight away.
+    Returns None once timeout seconds have passed. Replaces fixed sleeps, so we wait exactly as long as the UI needs.
+    """
+    interval = interval or WAIT_POLL_INTERVAL
+    deadline = time.monotonic() + timeout
+    while True:
+        result = condition()
+        if result:
+            return result
+        if time.monotonic() >= deadline:
+            print(f"Timed out after {timeout}s waiting for {description}.")
+            return None
+        time.sleep(interval)
+
+def _locate_image(image_path: str, confidence: float):
+    tracer.count('locate_attempts')
+    try:
+        return screen_locator.locate(image_path, confidence=confidence)
+    except getattr(get_gui_backend(), 'PyAutoGUIException', Exception) as e:
+        print(f"PyAutoGUI error while searching for '{image_path}': {e}")
+        return None
+
+def wait_for_image(image_path: str, confidence=0.9, timeout: float = None):
+    """
+    Waits until image_path is visible on screen and returns its location, or None on timeout.
+    """
+    return wait_until(lambda: _locate_image(image_path, confidence), timeout or ROBOT_STEP_TIMEOUT,
+                      description=f"'{image_path}' to appear")
+
+def click_image_on_screen(image_path: str, confidence=0.9, timeout: float = None) -> tuple:
     if not os.path.exists(image_path):
         print(f"Error: Image file not found at '{image_path}'")
         return None
 
     print(f"Looking for '{image_path}' on screen...")
-    for i in range(attempts):
-        try:
-            location = pyautogui.locateOnScreen(image_path, confidence=confidence, grayscale=False)
-            if location:
-                center_x = location.left + location.width // 2
-                center_y = location.top + location.height // 2
-                pyautogui.click(center_x, center_y)
-                print(f"Clicked '{image_path}' at ({center_x}, {center_y}).")
-                return (center_x, center_y)
-            else:
-                print(f"'{image_path}' not found (attempt {i+1}/{attempts}). Retrying...")
-                time.sleep(interval)
-        except pyautogui.PyAutoGUIException as e:
-            print(f"PyAutoGUI error while searching for '{image_path}': {e}")
-            time.sleep(interval)
-    print(f"Failed to find '{image_path}' after {attempts} attempts.")
+    with tracer.span('robot.click', image=os.path.basename(image_path)) as span_attrs:
+        location = wait_for_image(image_path, confidence, timeout)
+        span_attrs['found'] = bool(location)
+        if location:
+            center_x = _screen_origin[0] + location.left + location.width // 2
+            center_y = _screen_origin[1] + location.top + location.height // 2
+            get_gui_backend().click(center_x, center_y)
+            print(f"Clicked '{image_path}' at ({center_x}, {center_y}).")
+            return (center_x, center_y)
+    print(f"Failed to find '{image_path}'.")
     return None
 
 def type_text_into_active_field(text: str):
 
-    pyperclip.copy(text)
-    time.sleep(0.5)
-    pyautogui.hotkey('ctrl', 'v')
+    clipboard = get_clipboard_backend()
+    # Another worker copying in between would get its booking pasted here
+    with _input_lock, tracer.span('robot.paste', chars=len(text)):
+        clipboard.copy(text)
+        # Paste as soon as the clipboard actually holds the text instead of sleeping a fixed half second
+        wait_until(lambda: clipboard.paste() == text, timeout=2, interval=0.02, description="the clipboard")
+        get_gui_backend().hotkey('ctrl', 'v')
     print(f"Pasted text: '{text[:50]}...'")
 
-def automate_robot_with_command(robot_command: str) -> bool:
+def _submit_robot_command(robot_command: str, on_submit=None) -> bool:
     """
-    Automates inputting a single natural language command into the extension.
-    Returns True on success, False on failure.
+    Steps 1-4: clears the chat, pastes the command and submits it. Returns False if it couldn't be submitted.
+    on_submit is called as soon as the submit button has been clicked.
     """
-    print(f"Attempting to automate robot with command: \n{robot_command[:100]}...")
-
-
     # Step 1: Click "New Chat" button
     if 'ROBOT_NEW_CHAT_BUTTON_IMAGE' in globals() and os.path.exists(ROBOT_NEW_CHAT_BUTTON_IMAGE):
         new_chat_clicked = click_image_on_screen(ROBOT_NEW_CHAT_BUTTON_IMAGE, confidence=0.9)
         if not new_chat_clicked:
             print("Could not click 'New Chat' button. Continuing, but input area might not be clear.")
-        else:
-            time.sleep(1) # Give time for UI to reset
+        elif os.path.exists(ROBOT_EMPTY_CHAT_IMAGE) and not wait_for_image(ROBOT_EMPTY_CHAT_IMAGE, confidence=0.9):
+            # Nothing is pasted yet, so giving up here is safe and the job gets retried
+            print("The chat didn't reset after 'New Chat'. Automation step aborted.")
+            return False
 
     # Step 2: Click on the actual input text area to activate it
     input_area_clicked = click_image_on_screen(ROBOT_ACTUAL_INPUT_AREA_IMAGE, confidence=0.9)
     if not input_area_clicked:
         print("Failed to activate input area. Automation step aborted.")
         return False
-    
-    time.sleep(0.5) # Small delay for cursor to appear
 
     # Step 3: Type (paste) the command into the now-active input field
     type_text_into_active_field(robot_command)
 
-    time.sleep(1) # Small delay before clicking submit button
-
-    # Step 4: Locate and click the submit button
+    # Step 4: Locate and click the submit button, as soon as it shows up enabled
     submit_button_clicked = click_image_on_screen(ROBOT_SUBMIT_BUTTON_IMAGE, confidence=0.9)
     if not submit_button_clicked:
         print("Failed to click submit button. Automation step aborted.")
         return False
+    if on_submit:
+        on_submit()
+    return True
+
+def _automate_with_cdp(robot_command: str, on_submit=None):
+    """
+    The ROBOT_DRIVER=cdp path. Returns True/False like automate_robot_with_command, or None when the page can't
+    be used and nothing was sent, so the screen path can take over.
+    """
+    from cdp_driver import get_cdp_driver, CDPUnavailable
+
+    driver = get_cdp_driver()
+    try:
+        confirmations_before = driver.submit_command(robot_command, ROBOT_STEP_TIMEOUT)
+    except CDPUnavailable as e:
+        tracer.count('cdp_fallbacks')
+        print(f"DevTools driver unavailable ({e}). Falling back to the screen.")
+        return None
+    except Exception as e:
+        # The command may already be on the page, trying again on the screen could book it twice
+        print(f"DevTools driver failed while submitting: {e}")
+        driver.close()
+        if on_submit:
+            on_submit()
+        return False
+    if on_submit:
+        on_submit()
+
+    print("Command submitted over DevTools. Waiting for robot.ai action.")
+    if not driver.can_confirm():
+        print(f"No CDP_CONFIRMATION_SELECTOR or CDP_CONFIRMATION_TEXT set, can't verify the booking. Waiting {ROBOT_UNCONFIRMED_WAIT}s instead.")
+        time.sleep(ROBOT_UNCONFIRMED_WAIT)
+        return True
+    try:
+        confirmed = driver.wait_for_confirmation(confirmations_before, BOOKING_CONFIRMATION_TIMEOUT)
+    except Exception as e:
+        print(f"Lost the DevTools connection while waiting for the confirmation: {e}")
+        driver.close()
+        return False
+    if not confirmed:
+        print("Booking confirmation did not appear. Marking this command as failed.")
+        return False
+    print("Booking confirmed.")
+    return True
+
+def automate_robot_with_command(robot_command: str, on_submit=None) -> bool:
+    """
+    Automates inputting a single natural language command into the extension.
+    Every step waits for the UI element it needs instead of sleeping, and after submitting we wait for
+    BOOKING_CONFIRMATION_IMAGE so success actually means the booking went through.
+    on_submit is called once the command may have reached the robot, so a failure after that point can be told
+    apart from one where nothing was sent.
+    Returns True on success, False on failure.
+    """
+    print(f"Attempting to automate robot with command: \n{robot_command[:100]}...")
+
+    if ROBOT_DRIVER == 'cdp':
+        result = _automate_with_cdp(robot_command, on_submit)
+        if result is not None:
+            return result
+
+    # Workers sharing one display take turns until the command is submitted, the wait for the robot is where they overlap
+    with _input_lock if _shared_display else nullcontext():
+        if not _submit_robot_command(robot_command, on_submit):
+            return False
 
     print("Command submitted. Waiting for robot.ai action.")
-    time.sleep(7) # Wait to observe the result of the command
 
-    
+    # Step 5: Wait for the booking confirmation
+    if not os.path.exists(BOOKING_CONFIRMATION_IMAGE):
+        print(f"No confirmation image at '{BOOKING_CONFIRMATION_IMAGE}', can't verify the booking. Waiting {ROBOT_UNCONFIRMED_WAIT}s instead.")
+        time.sleep(ROBOT_UNCONFIRMED_WAIT)
+        return True
+
+    with tracer.span('robot.confirmation_wait') as span_attrs:
+        confirmed = wait_for_image(BOOKING_CONFIRMATION_IMAGE, confidence=0.9, timeout=BOOKING_CONFIRMATION_TIMEOUT)
+        span_attrs['confirmed'] = bool(confirmed)
+    if not confirmed:
+        print("Booking confirmation did not appear. Marking this command as failed.")
+        return False
+
+    print("Booking confirmed.")
+    return True
+
+def automate_job(store, job: dict, COMPLETED_PROMPTS_DIR: str = None) -> bool:
+    """
+    Runs the robot for one job already claimed as automating and records the outcome. Returns True on success.
+    """
+    with tracer.trace(job_trace_id(job)), tracer.span('robot.automate', job_id=job['id']) as span_attrs:
+        span_attrs['ok'] = _automate_job(store, job, COMPLETED_PROMPTS_DIR)
+        return span_attrs['ok']
+
+def _automate_job(store, job: dict, COMPLETED_PROMPTS_DIR: str = None) -> bool:
+    COMPLETED_PROMPTS_DIR = COMPLETED_PROMPTS_DIR or os.getenv('COMPLETED_PROMPTS_DIR', 'complete')
+    prompt_file_path = job['prompt_path']
+    filename = os.path.basename(prompt_file_path) if prompt_file_path else f"job {job['id']}"
+    idempotency_key = job_idempotency_key(job)
+    submitted = []
+
+    def record_submitted():
+        store.record_stage(idempotency_key, 'submitted', job['id'])
+        submitted.append(True)
+
+    try:
+        robot_command_content = (job['prompt'] or '').strip()
+
+        if not robot_command_content:
+            # Retrying won't make it any less empty
+            print(f"  Warning: Prompt for {filename} is empty. Skipping it.")
+            store.dead_letter(job['id'], "Empty robot command")
+            return False
+
+        # The ledger knows if this booking already reached the robot, e.g. before a crash or from another copy of the email
+        ledger_entry = store.ledger_entry(idempotency_key)
+        if ledger_entry and ledger_entry['job_id'] != job['id']:
+            store.mark_duplicate(job['id'], ledger_entry['job_id'])
+            return False
+        if ledger_entry and ledger_entry['confirmed_at']:
+            print(f"  {filename} was already booked at {ledger_entry['confirmed_at']}. Not sending it again.")
+            store.update_job(job['id'], STATE_COMPLETED)
+            return True
+        if ledger_entry and ledger_entry['submitted_at']:
+            store.dead_letter(job['id'], f"Sent to the robot at {ledger_entry['submitted_at']} but never confirmed. "
+                                         "Check whether it booked before re-queueing it.")
+            return False
+
+        # Attempt to automate the command
+        if not automate_robot_with_command(robot_command_content, on_submit=record_submitted):
+            if submitted:
+                # It may have booked anyway, sending it again could book it twice
+                store.dead_letter(job['id'], "Robot automation failed after the command was submitted")
+                return False
+            state, next_attempt_at = store.record_failure(job['id'], STATE_PROMPTED, "Robot automation failed")
+            if next_attempt_at:
+                print(f"  Failed to automate prompt for: {filename}. Retrying after {next_attempt_at}.")
+            return False
+
+        store.record_stage(idempotency_key, 'confirmed', job['id'])
+        store.update_job(job['id'], STATE_COMPLETED)
+
+    except Exception as e:
+        if submitted:
+            store.dead_letter(job['id'], f"Error after the command was submitted: {e}")
+            return False
+        state, next_attempt_at = store.record_failure(job['id'], STATE_PROMPTED, str(e))
+        if next_attempt_at:
+            print(f"Error processing {filename}: {e}. Retrying after {next_attempt_at}.")
+        return False
+
+    # Keep the completed_ archive folder for humans. The booking is done whatever happens here
+    try:
+        if prompt_file_path and os.path.exists(prompt_file_path):
+            os.makedirs(COMPLETED_PROMPTS_DIR, exist_ok=True)
+            new_filename = filename.replace('processed_', 'completed_', 1)
+            shutil.move(prompt_file_path, os.path.join(COMPLETED_PROMPTS_DIR, new_filename))
+            store.update_job(job['id'], STATE_COMPLETED, prompt_path=os.path.join(COMPLETED_PROMPTS_DIR, new_filename))
+            print(f"  Archived processed prompt: {filename} -> {new_filename}")
+    except Exception as e:
+        print(f"  Booked {filename}, but couldn't archive the prompt file: {e}")
     return True
 
+
 def process_all_pending_robot_prompts():
 
     processed_count = 0
     failed_count = 0
-    SAVED_MAILS_DIR = os.getenv('SAVED_MAILS_DIR', 'savedmails')
-    SAVED_PROMPTS_DIR = os.getenv('SAVED_PROMPTS_DIR', 'savedprompts')
     COMPLETED_PROMPTS_DIR = os.getenv('COMPLETED_PROMPTS_DIR', 'complete')
-    if not os.path.exists(SAVED_PROMPTS_DIR):
-        print(f"Saved prompts directory '{SAVED_PROMPTS_DIR}' does not exist.")
-        return 0, 0
 
-    pending_prompt_files = [f for f in os.listdir(SAVED_PROMPTS_DIR) if f.startswith('processed_') and f.endswith('.txt')]
+    store = get_job_store()
+
+    # Jobs stuck mid-automation may or may not have been submitted, so they are never picked up again automatically
+    in_flight = store.count_by_state().get(STATE_AUTOMATING, 0)
+    if in_flight:
+        print(f"  Note: {in_flight} job(s) are marked as being automated by another or an interrupted run. Check them manually.")
 
-    if not pending_prompt_files:
-        print(f"No new pending robot.ai prompt files found in '{SAVED_PROMPTS_DIR}' to process.")
+    pending_jobs = store.claim_jobs(STATE_PROMPTED, STATE_AUTOMATING)
+
+    if not pending_jobs:
+        print(f"No new pending robot.ai prompts found in '{store.db_path}' to process.")
         return 0, 0
 
-    print(f"Found {len(pending_prompt_files)} pending robot.ai prompt files in '{SAVED_PROMPTS_DIR}'.")
+    print(f"Found {len(pending_jobs)} pending robot.ai prompts in '{store.db_path}'.")
 
-    for filename in pending_prompt_files:
-        prompt_file_path = os.path.join(SAVED_PROMPTS_DIR, filename)
-        try:
-            with open(prompt_file_path, 'r', encoding='utf-8') as f:
-                robot_command_content = f.read().strip() # Corrected: Added () to .strip()
-
-            if not robot_command_content:
-                print(f"  Warning: Prompt file {filename} is empty. Skipping and marking as empty_failed.")
-                failed_count += 1
-                # Rename empty files so they don't block future runs
-                # Replace 'processed_' with 'empty_robot_command_' for clarity
-                empty_filename = filename.replace('processed_', 'empty_robot_command_', 1)
-                shutil.move(prompt_file_path, os.path.join(SAVED_PROMPTS_DIR, empty_filename))
-                continue
-
-            # Attempt to automate the command
-            if automate_robot_with_command(robot_command_content):
-                # On success, rename from 'processed_' to 'completed_robot_command_'
-                new_filename = filename.replace('processed_', 'completed_', 1)
-                shutil.move(prompt_file_path, os.path.join(COMPLETED_PROMPTS_DIR, new_filename))
-                print(f"  Archived processed prompt: {filename} -> {new_filename}")
-                processed_count += 1
-            else:
-                # On failure, rename from 'processed_' to 'failed_robot_command_'
-                failed_count += 1
-                print(f"  Failed to automate prompt for: {filename}. Renaming to indicate failure.")
-                failed_filename = filename.replace('processed_', 'failed_robot_command_', 1)
-                shutil.move(prompt_file_path, os.path.join(SAVED_PROMPTS_DIR, failed_filename))
-
-        except Exception as e:
+    for job in pending_jobs:
+        if automate_job(store, job, COMPLETED_PROMPTS_DIR):
+            processed_count += 1
+        else:
             failed_count += 1
-            print(f"Error processing file {filename}: {e}. It remains in its current state ('processed_') for manual review/retry.")
 
     print(f"\nautomation complete. Successfully processed: {processed_count}, Failed: {failed_count}")
+    if screen_locator.stats:
+        print("Screen search timings:")
+        print(screen_locator.timing_report())
     return processed_count, failed_count
 
+def activate_chrome_window():
+    """
+    Brings Chrome to the front for the robot. Returns False if it couldn't be found or activated.
+    """
+    if ROBOT_DRIVER == 'cdp':
+        from cdp_driver import get_cdp_driver, CDPUnavailable
+
+        try:
+            # The DevTools driver works on the page itself, the window doesn't have to be in front
+            get_cdp_driver().connect()
+            return True
+        except CDPUnavailable as e:
+            print(f"DevTools driver unavailable ({e}), using the screen instead.")
+
+    try:
+
+        all_windows = get_gui_backend().getWindowsWithTitle('')
+        
+        
+        chrome_windows = [
+            win for win in all_windows
+            if "Chrome" in win.title
+        ]
+
+        if chrome_windows:
+
+            chrome_windows[0].activate()
+            print(f"Activated Chrome window: '{chrome_windows[0].title}'")
+            wait_until(lambda: chrome_windows[0].isActive, timeout=5, description="Chrome to come to the front")
+        else:
+            print("Error: Chrome window not found. Please ensure Chrome is open and active before running the workflow.")
+            return False
+    except Exception as e:
+        print(f"An error occurred while trying to activate Chrome: {e}")
+        return False
+    return True
+
+
 if __name__ == "__main__":
-    print(f"Starting robot automation. Reading from: {SAVED_PROMPTS_DIR}")
+    print(f"Starting robot automation. Reading from: {get_job_store().db_path}")
 
 
     try:
-        all_windows = pyautogui.getWindowsWithTitle('')
+        all_windows = get_gui_backend().getWindowsWithTitle('')
         chrome_windows = [
             win for win in all_windows
             if "Chrome" in win.title and win.is_visible
@@ -157,7 +437,7 @@ if __name__ == "__main__":
         if chrome_windows:
             chrome_windows[0].activate()
             print(f"Activated Chrome window: '{chrome_windows[0].title}'")
-            time.sleep(1)
+            wait_until(lambda: chrome_windows[0].isActive, timeout=5, description="Chrome to come to the front")
         else:
             print("Chrome window not found. Please ensure Chrome is open and active.")
             sys.exit(1) # Exit the script if Chrome is not found
@@ -0,0 +1,172 @@
+# screenlocator.py
+
+import sys
+import time
+import pyscreeze
+from PIL import Image
+
+
+class ScreenLocator:
+    """
+    Finds button images on screen quickly enough to not be the slow part of a booking.
+
+    - Template PNGs are loaded from disk once and kept in memory (plus a downscaled copy).
+    - The last place each template was found is remembered, and the next search first looks in a small
+      region of interest around it. UI buttons rarely move, so this is normally the only search needed.
+    - On a miss it searches a downscaled copy of the full screen, then confirms the hit at full resolution.
+    - Timing and hit statistics per template are kept for the end of run report.
+
+    screenshot_fn(region=None) returns a PIL image of the screen (or of region=(left, top, width, height)).
+    It defaults to pyautogui.screenshot, pass screenshot_from_file(...) to run against saved screenshots without a display.
+    """
+
+    def __init__(self, screenshot_fn=None, roi_margin: int = 150, downscale: float = 0.5, grayscale: bool = False):
+        self.screenshot_fn = screenshot_fn
+        self.roi_margin = roi_margin
+        self.downscale = downscale
+        self.grayscale = grayscale
+        self._templates = {}
+        self._last_hits = {}
+        self._size = None
+        self.stats = {}
+
+    def _screenshot(self, region: tuple = None) -> Image.Image:
+        if self.screenshot_fn is None:
+            # Imported here so the locator can be used (and tested) on machines without a display
+            import pyautogui
+            self.screenshot_fn = pyautogui.screenshot
+        return self.screenshot_fn(region=region)
+
+    def preload(self, image_paths: list):
+        for image_path in image_paths:
+            self._template(image_path)
+
+    def _template(self, image_path: str) -> tuple:
+        template = self._templates.get(image_path)
+        if template is None:
+            full = Image.open(image_path).convert('RGB')
+            small = full.resize((max(1, int(full.width * self.downscale)), max(1, int(full.height * self.downscale))))
+            template = (full, small)
+            self._templates[image_path] = template
+        return template
+
+    def _match(self, needle: Image.Image, haystack: Image.Image, confidence: float):
+        if needle.width > haystack.width or needle.height > haystack.height:
+            return None
+        try:
+            return pyscreeze.locate(needle, haystack, confidence=confidence, grayscale=self.grayscale)
+        except pyscreeze.ImageNotFoundException:
+            return None
+
+    def _search_region(self, needle: Image.Image, region: tuple, confidence: float, screen: Image.Image = None):
+        """
+        Searches region=(left, top, right, bottom) at full resolution and returns the match in screen coordinates.
+        """
+        left, top, right, bottom = region
+        if screen is not None:
+            haystack = screen.crop(region)
+        else:
+            haystack = self._screenshot(region=(left, top, right - left, bottom - top))
+        box = self._match(needle, haystack, confidence)
+        if box is None:
+            return None
+        return pyscreeze.Box(box.left + left, box.top + top, box.width, box.height)
+
+    def _around(self, box, screen_size: tuple) -> tuple:
+        screen_width, screen_height = screen_size
+        return (
+            max(0, box.left - self.roi_margin),
+            max(0, box.top - self.roi_margin),
+            min(screen_width, box.left + box.width + self.roi_margin),
+            min(screen_height, box.top + box.height + self.roi_margin)
+        )
+
+    def locate(self, image_path: str, confidence: float = 0.9, screen: Image.Image = None):
+        """
+        Returns the Box(left, top, width, height) of image_path on screen, or None.
+        Pass screen to search an image you already have instead of taking a new screenshot.
+        """
+        started = time.perf_counter()
+        stats = self.stats.setdefault(image_path, {'calls': 0, 'roi_hits': 0, 'full_hits': 0, 'misses': 0, 'seconds': 0.0})
+        stats['calls'] += 1
+
+        full_template, small_template = self._template(image_path)
+        box = None
+
+        # 1. Where it was last time
+        last_hit = self._last_hits.get(image_path)
+        if last_hit is not None:
+            screen_size = screen.size if screen is not None else self._screen_size()
+            box = self._search_region(full_template, self._around(last_hit, screen_size), confidence, screen)
+            if box is not None:
+                stats['roi_hits'] += 1
+
+        # 2. Coarse search on a downscaled screen, confirmed at full resolution around the candidate
+        if box is None:
+            if screen is None:
+                screen = self._screenshot()
+            small_screen = screen.resize((int(screen.width * self.downscale), int(screen.height * self.downscale)))
+            coarse = self._match(small_template, small_screen, confidence)
+            if coarse is not None:
+                candidate = pyscreeze.Box(int(coarse.left / self.downscale), int(coarse.top / self.downscale),
+                                          full_template.width, full_template.height)
+                box = self._search_region(full_template, self._around(candidate, screen.size), confidence, screen)
+            if box is None:
+                # Thin lines and small text can get lost when downscaling, so give the full image one go
+                box = self._match(full_template, screen, confidence)
+            if box is not None:
+                stats['full_hits'] += 1
+
+        if box is None:
+            stats['misses'] += 1
+        else:
+            self._last_hits[image_path] = box
+        stats['seconds'] += time.perf_counter() - started
+        return box
+
+    def _screen_size(self) -> tuple:
+        # Resolution changes are rare enough to ask only once
+        if self._size is None:
+            if self.screenshot_fn is None:
+                import pyautogui
+                self._size = tuple(pyautogui.size())
+            else:
+                self._size = self._screenshot().size
+        return self._size
+
+    def timing_report(self) -> str:
+        lines = []
+        for image_path, stats in self.stats.items():
+            average_ms = stats['seconds'] / stats['calls'] * 1000 if stats['calls'] else 0
+            lines.append(f"  {image_path}: {stats['calls']} searches, avg {average_ms:.1f} ms, "
+                         f"{stats['roi_hits']} near last hit, {stats['full_hits']} full screen, {stats['misses']} misses")
+        return "\n".join(lines)
+
+
+def screenshot_from_file(screenshot_path: str):
+    """
+    A screenshot_fn that serves a saved screenshot, for running the locator with no display attached.
+    """
+    screen = Image.open(screenshot_path).convert('RGB')
+
+    def screenshot(region: tuple = None) -> Image.Image:
+        if region is None:
+            return screen
+        left, top, width, height = region
+        return screen.crop((left, top, left + width, top + height))
+
+    return screenshot
+
+
+if __name__ == "__main__":
+    # Try templates against a saved screenshot: python screenlocator.py screenshot.png button1.png [button2.png ...]
+    if len(sys.argv) < 3:
+        print("Usage: python screenlocator.py <screenshot.png> <template.png> [<template.png> ...]")
+        sys.exit(1)
+
+    locator = ScreenLocator(screenshot_fn=screenshot_from_file(sys.argv[1]))
+    locator.preload(sys.argv[2:])
+    for _ in range(3):
+        for template_path in sys.argv[2:]:
+            print(f"{template_path}: {locator.locate(template_path)}")
+    print(locator.timing_report())
@@ -0,0 +1,99 @@
+# sequencestore.py
+
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime
+
+# Matches everything the pipeline writes for an email: the saved mail, its processed_ archive and the robot command
+ARCHIVE_FILENAME_PATTERN = re.compile(r"^(?:processed_)?(?P<sender_type>.+)_(?P<day>\d{8})_(?P<seq>\d+)(?:_robot_command)?\.txt$")
+
+
+class DailySequenceStore:
+    """
+    Hands out the per (sender_type, day) sequence numbers used in saved email filenames.
+
+    Counters live in a small SQLite file, so allocating a number is one indexed read and write instead of
+    listing and parsing the whole archive directory. BEGIN IMMEDIATE takes the write lock up front, which makes
+    allocation safe when several fetchers run at the same time. The first time a store is opened it is
+    seeded from the files already in archive_dir so numbering carries on where the old directory scan left off.
+    """
+
+    def __init__(self, db_path: str, archive_dir: str = None):
+        self.db_path = db_path
+        self.archive_dir = archive_dir
+        self._local = threading.local()
+
+        conn = self._connection()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS daily_sequence (
+                sender_type TEXT NOT NULL,
+                day TEXT NOT NULL,
+                last_seq INTEGER NOT NULL,
+                PRIMARY KEY (sender_type, day)
+            )
+        """)
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._seed_from_archive(conn)
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread, sqlite3 connections can't be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            db_dir = os.path.dirname(os.path.abspath(self.db_path))
+            os.makedirs(db_dir, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _seed_from_archive(self, conn: sqlite3.Connection):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'seeded'").fetchone():
+                conn.execute("COMMIT")
+                return
+
+            highest = {}
+            if self.archive_dir and os.path.isdir(self.archive_dir):
+                for filename in os.listdir(self.archive_dir):
+                    match = ARCHIVE_FILENAME_PATTERN.match(filename)
+                    if not match:
+                        continue
+                    key = (match.group('sender_type'), match.group('day'))
+                    highest[key] = max(highest.get(key, 0), int(match.group('seq')))
+
+            for (sender_type, day), last_seq in highest.items():
+                conn.execute("""
+                    INSERT INTO daily_sequence (sender_type, day, last_seq) VALUES (?, ?, ?)
+                    ON CONFLICT (sender_type, day) DO UPDATE SET last_seq = MAX(last_seq, excluded.last_seq)
+                """, (sender_type, day, last_seq))
+            conn.execute("INSERT INTO meta (key, value) VALUES ('seeded', ?)", (datetime.now().isoformat(),))
+            conn.execute("COMMIT")
+            if highest:
+                print(f"Seeded sequence store '{self.db_path}' from {len(highest)} existing sender/day combinations.")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def next_sequence(self, sender_type: str, email_date: datetime) -> int:
+        """
+        Atomically reserves and returns the next sequence number for sender_type on the email's day.
+        """
+        day = email_date.strftime('%Y%m%d')
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT last_seq FROM daily_sequence WHERE sender_type = ? AND day = ?", (sender_type, day)
+            ).fetchone()
+            sequence = (row[0] if row else 0) + 1
+            conn.execute(
+                "INSERT OR REPLACE INTO daily_sequence (sender_type, day, last_seq) VALUES (?, ?, ?)",
+                (sender_type, day, sequence)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return sequence
@@ -0,0 +1,234 @@
+# service.py
+#
+# Resident mode: start once, keep the IMAP session, the Gemini model and the screen locator warm, and run the
+# pipeline every time new mail arrives or the schedule fires. Stop it with Ctrl+C or SIGTERM, it finishes the
+# booking it's on first.
+# Usage: python service.py
+
+import os
+import json
+import time
+import signal
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from main_workflow import (activate_chrome_window, IMAP_HOST, IMAP_PORT, IMAP_USER, IMAP_PASS,
+                           EMAIL_OUTPUT_BASE_DIR, IMAP_SYNC_STATE_FILE, IMAP_ACCOUNTS_FILE)
+from mailfetcher import (connect_imap, open_folder_sync_state, iter_new_emails, process_new_emails, _idle_until_new_mail,
+                         IMAP_RECONNECT_MAX_BACKOFF)
+from promptwriter import process_all_emails_for_prompts, get_model
+from robot_desktop_automator import get_gui_backend
+from pipeline import run_pipeline
+from fetchcoordinator import load_mailbox_specs, fetch_all_mailboxes, iter_all_mailboxes, IMAPConnectionPool
+from automationpool import load_worker_slots, run_automation_pool
+from jobstore import get_job_store
+
+# Seconds between runs when no new mail has been announced. Failed prompts get retried on these runs as well
+SERVICE_INTERVAL = int(os.getenv('SERVICE_INTERVAL', 300))
+# 'idle' wakes up as soon as the server announces new mail, 'schedule' only runs every SERVICE_INTERVAL seconds
+SERVICE_TRIGGER = os.getenv('SERVICE_TRIGGER', 'idle')
+SERVICE_HEALTH_FILE = os.getenv('SERVICE_HEALTH_FILE', 'service_health.json')
+# Port for GET /health, 0 leaves the HTTP endpoint off and only the file is written
+SERVICE_HEALTH_PORT = int(os.getenv('SERVICE_HEALTH_PORT', 0))
+# A run taking longer than this is hung (an IMAP read, Gemini, the robot) and the health check starts failing
+SERVICE_MAX_CYCLE_SECONDS = int(os.getenv('SERVICE_MAX_CYCLE_SECONDS', 3600))
+
+
+class WorkflowService:
+    """
+    Runs the booking pipeline inside one long-lived process. Health is written to health_file after every state
+    change and, with health_port set, served as JSON on http://127.0.0.1:<port>/health (503 once it looks stuck).
+    """
+
+    def __init__(self, folder: str = 'INBOX', interval: int = None, trigger: str = None, health_file: str = None,
+                 health_port: int = None, max_cycle_seconds: int = None):
+        self.folder = folder
+        self.interval = interval or SERVICE_INTERVAL
+        self.trigger = trigger or SERVICE_TRIGGER
+        self.health_file = health_file if health_file is not None else SERVICE_HEALTH_FILE
+        self.health_port = health_port if health_port is not None else SERVICE_HEALTH_PORT
+        self.max_cycle_seconds = max_cycle_seconds or SERVICE_MAX_CYCLE_SECONDS
+        self.stop_event = threading.Event()
+        # With IMAP_ACCOUNTS_FILE every run fetches all mailboxes through one pool that lives as long as the service
+        self.accounts = load_mailbox_specs(IMAP_ACCOUNTS_FILE) if IMAP_ACCOUNTS_FILE else None
+        self.pool = IMAPConnectionPool() if self.accounts else None
+        self._health_lock = threading.Lock()
+        self.health = {
+            'status': 'starting',
+            'pid': os.getpid(),
+            'started_at': datetime.now().isoformat(),
+            'updated_at': None,
+            'cycles': 0,
+            'last_cycle_finished_at': None,
+            'last_cycle_seconds': None,
+            'last_stats': None,
+            'last_error': None,
+            'jobs': None
+        }
+
+    def _set_health(self, **fields):
+        with self._health_lock:
+            self.health.update(fields)
+            self.health['updated_at'] = datetime.now().isoformat()
+            snapshot = dict(self.health)
+        if self.health_file:
+            # Same write-then-rename as the sync state, so a monitor never reads half a file
+            tmp_path = f"{self.health_file}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, indent=2)
+            os.replace(tmp_path, self.health_file)
+
+    def is_healthy(self) -> bool:
+        with self._health_lock:
+            status = self.health['status']
+            updated_at = self.health['updated_at']
+        if status in ('stopped', 'reconnecting') or updated_at is None:
+            return False
+        silent_for = (datetime.now() - datetime.fromisoformat(updated_at)).total_seconds()
+        if status == 'running':
+            # updated_at is when the run started
+            return silent_for < self.max_cycle_seconds
+        # The longest legit silence is one trigger wait plus a long run, anything much beyond that means we're stuck
+        return silent_for < self.interval * 2 + 60
+
+    def _start_health_server(self):
+        service = self
+
+        class HealthHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/health':
+                    self.send_error(404)
+                    return
+                with service._health_lock:
+                    body = json.dumps(service.health).encode('utf-8')
+                self.send_response(200 if service.is_healthy() else 503)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', self.health_port), HealthHandler)
+        threading.Thread(target=server.serve_forever, name='service-health', daemon=True).start()
+        print(f"Health endpoint listening on http://127.0.0.1:{server.server_address[1]}/health")
+        return server
+
+    def stop(self, *args):
+        if not self.stop_event.is_set():
+            print("\nShutdown requested, finishing the current step...")
+        self.stop_event.set()
+
+    def _fetch_new(self, client, sync_state) -> list:
+        if self.accounts:
+            return fetch_all_mailboxes(self.accounts, EMAIL_OUTPUT_BASE_DIR, mark_as_read=True,
+                                       sync_state_file=IMAP_SYNC_STATE_FILE, pool=self.pool)
+        return process_new_emails(client, EMAIL_OUTPUT_BASE_DIR, mark_as_read=True, sync_state=sync_state)
+
+    def _iter_new(self, client, sync_state):
+        if self.accounts:
+            return iter_all_mailboxes(self.accounts, EMAIL_OUTPUT_BASE_DIR, mark_as_read=True,
+                                      sync_state_file=IMAP_SYNC_STATE_FILE, pool=self.pool)
+        return iter_new_emails(client, EMAIL_OUTPUT_BASE_DIR, mark_as_read=True, sync_state=sync_state)
+
+    def _run_cycle(self, client, sync_state):
+        started = time.perf_counter()
+        self._set_health(status='running')
+        print(f"\n--- Service run started at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---")
+
+        worker_slots = load_worker_slots()
+        if worker_slots:
+            # The pool's workers claim from the job store themselves, so the stages run one after another here
+            saved = self._fetch_new(client, sync_state)
+            prompted, prompt_failed = process_all_emails_for_prompts()
+            completed, automation_failed = run_automation_pool(worker_slots, stop_event=self.stop_event)
+            stats = {'fetched': len(saved), 'prompted': prompted, 'prompt_failed': prompt_failed,
+                     'completed': completed, 'automation_failed': automation_failed}
+        elif activate_chrome_window():
+            stats = run_pipeline(
+                host=IMAP_HOST, port=IMAP_PORT, username=IMAP_USER, password=IMAP_PASS,
+                output_base_dir=EMAIL_OUTPUT_BASE_DIR,
+                email_paths=self._iter_new(client, sync_state),
+                stop_event=self.stop_event
+            )
+        else:
+            # No desktop to drive right now, at least get the mail in and the prompts ready for the next run
+            print("Chrome isn't available, only fetching emails and generating prompts this time.")
+            saved = self._fetch_new(client, sync_state)
+            prompted, prompt_failed = process_all_emails_for_prompts()
+            stats = {'fetched': len(saved), 'prompted': prompted, 'prompt_failed': prompt_failed}
+
+        self._set_health(status='idle', cycles=self.health['cycles'] + 1, last_stats=stats, last_error=None,
+                         last_cycle_finished_at=datetime.now().isoformat(),
+                         last_cycle_seconds=round(time.perf_counter() - started, 3),
+                         jobs=get_job_store().count_by_state())
+
+    @contextmanager
+    def _mailbox_session(self):
+        # Yields (client, sync_state) for the single EMAIL_* mailbox, (None, None) when the pool does the fetching
+        if self.accounts:
+            yield None, None
+            return
+        with connect_imap(IMAP_HOST, IMAP_PORT, IMAP_USER, IMAP_PASS) as client:
+            select_info = client.select_folder(self.folder)
+            yield client, open_folder_sync_state(IMAP_SYNC_STATE_FILE, IMAP_HOST, IMAP_USER, self.folder, select_info)
+
+    def _wait_for_trigger(self, client):
+        if client is None:
+            # IDLE can't watch several mailboxes on one connection, the pool's logins are checked on the next run
+            self.stop_event.wait(self.interval)
+        elif self.trigger == 'idle':
+            # Wakes up on new mail, otherwise runs anyway once the interval is over
+            _idle_until_new_mail(client, self.interval, self.stop_event)
+        else:
+            self.stop_event.wait(self.interval)
+            client.noop()
+
+    def run(self):
+        # Signals can only be hooked from the main thread, run() is expected to be called from there
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        health_server = self._start_health_server() if self.health_port else None
+
+        os.makedirs(EMAIL_OUTPUT_BASE_DIR, exist_ok=True)
+        # Pay for the heavy imports and the Gemini client once, up front, instead of on the first booking
+        get_model()
+        get_gui_backend()
+        if self.accounts:
+            print(f"Service started (fetching {len(self.accounts)} account(s) every {self.interval}s).")
+        else:
+            print(f"Service started (trigger: {self.trigger}, interval: {self.interval}s).")
+
+        backoff = 1
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    with self._mailbox_session() as (client, sync_state):
+                        backoff = 1
+
+                        while not self.stop_event.is_set():
+                            self._run_cycle(client, sync_state)
+                            if self.stop_event.is_set():
+                                break
+                            self._wait_for_trigger(client)
+                except Exception as e:
+                    if self.stop_event.is_set():
+                        break
+                    print(f"Service run failed: {e}. Reconnecting in {backoff}s...")
+                    self._set_health(status='reconnecting', last_error=str(e))
+                    self.stop_event.wait(backoff)
+                    backoff = min(backoff * 2, IMAP_RECONNECT_MAX_BACKOFF)
+        finally:
+            self._set_health(status='stopped')
+            if self.pool:
+                self.pool.close_all()
+            if health_server:
+                health_server.shutdown()
+                health_server.server_close()
+            print("Service stopped.")
+
+
+if __name__ == "__main__":
+    WorkflowService().run()
@@ -0,0 +1,75 @@
+# syncstate.py
+
+import os
+import json
+import threading
+
+# Folders fetched in parallel share one state file, so their read-modify-write cycles take turns
+_state_file_lock = threading.Lock()
+
+
+def load_sync_state(state_file: str) -> dict:
+    """
+    Reads the whole sync state file. Returns an empty dict if it doesn't exist yet or can't be parsed.
+    """
+    if not state_file or not os.path.exists(state_file):
+        return {}
+    try:
+        with open(state_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (ValueError, OSError) as e:
+        print(f"Warning: Could not read sync state '{state_file}': {e}. Starting from scratch.")
+        return {}
+
+
+def save_sync_state(state_file: str, state: dict):
+    """
+    Writes the sync state atomically, so a crash mid-write never leaves a half written file behind.
+    """
+    state_dir = os.path.dirname(os.path.abspath(state_file))
+    os.makedirs(state_dir, exist_ok=True)
+    tmp_path = state_file + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, state_file)
+
+
+class FolderSyncState:
+    """
+    Tracks UIDVALIDITY and the highest processed UID for one account/folder pair.
+    If the server reports a different UIDVALIDITY the stored UIDs mean nothing anymore and the watermark is dropped.
+    """
+
+    def __init__(self, state_file: str, host: str, username: str, folder: str, uidvalidity: int, uidnext: int = None):
+        self.state_file = state_file
+        self.key = f"{username}@{host}/{folder}"
+        self.uidvalidity = uidvalidity
+        self.uidnext = uidnext
+
+        entry = load_sync_state(state_file).get(self.key)
+        if entry and entry.get('uidvalidity') == uidvalidity:
+            self.last_uid = entry.get('last_uid')
+        else:
+            if entry:
+                print(f"UIDVALIDITY changed for '{self.key}' ({entry.get('uidvalidity')} -> {uidvalidity}). Resetting sync state.")
+            self.last_uid = None
+
+    @property
+    def has_watermark(self) -> bool:
+        return self.last_uid is not None
+
+    def advance(self, uid: int):
+        """
+        Moves the watermark forward to uid and persists it straight away.
+        """
+        if self.last_uid is not None and uid <= self.last_uid:
+            return
+        self.last_uid = uid
+
+        # Re-read before writing so other folders/accounts sharing the file aren't clobbered
+        with _state_file_lock:
+            state = load_sync_state(self.state_file)
+            state[self.key] = {'uidvalidity': self.uidvalidity, 'last_uid': uid}
+            save_sync_state(self.state_file, state)
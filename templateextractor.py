@@ -0,0 +1,98 @@
+# templateextractor.py
+
+import re
+from datetime import datetime
+
+# The agency emails are fixed templates (see CONTENT_MARKERS in mailfetcher.py), so for most of them we can pull the
+# booking details out with plain regexes and skip Gemini. Each field pattern needs one named group called 'value'.
+# A field left as "" means the agency isn't set up yet, and its mails just keep going to Gemini.
+EXTRACTION_RULES = {
+    "tag": {
+        "fields": {
+            "date": "",     # e.g. r"^Tour date:\s*(?P<value>\d{2}\.\d{2}\.\d{4})"
+            "product": "",  # e.g. r"^Product:\s*(?P<value>.+?)\s*$"
+            "pax": "",      # e.g. r"^Participants:\s*(?P<value>\d+)"
+            "name": ""      # e.g. r"^Lead traveller:\s*(?P<value>.+?)\s*$"
+        },
+        "checks": {"date": "date", "pax": "count"},
+        # Same text you'd ask Gemini to produce, with {field} placeholders
+        "template": ""
+    },
+    "tag2": {
+        "fields": {
+            "date": "",
+            "product": "",
+            "pax": "",
+            "name": ""
+        },
+        "checks": {"date": "date", "pax": "count"},
+        "template": ""
+    }
+}
+
+# Date formats the 'date' check accepts
+DATE_FORMATS = ('%d.%m.%Y', '%d/%m/%Y', '%Y-%m-%d', '%d %B %Y', '%d %b %Y')
+
+
+def _compile_rules(rules: dict) -> dict:
+    compiled = {}
+    for sender_type, rule in rules.items():
+        fields = rule.get("fields", {})
+        if not rule.get("template") or not fields or not all(fields.values()):
+            continue
+        compiled[sender_type] = {
+            "fields": {name: re.compile(pattern, re.MULTILINE | re.IGNORECASE) for name, pattern in fields.items()},
+            "checks": rule.get("checks", {}),
+            "template": rule["template"]
+        }
+    return compiled
+
+
+_COMPILED_RULES = _compile_rules(EXTRACTION_RULES)
+
+
+def _passes_check(check: str, value: str) -> bool:
+    if check == "date":
+        for date_format in DATE_FORMATS:
+            try:
+                datetime.strptime(value, date_format)
+                return True
+            except ValueError:
+                continue
+        return False
+    if check == "count":
+        return value.isdigit() and 0 < int(value) < 100
+    return True
+
+
+def extract_fields(sender_type: str, content: str):
+    """
+    Pulls every configured field out of content. Returns a dict of field values, or None when the agency has no
+    complete rule set or the extraction isn't trustworthy: a field is missing, appears with two different values,
+    or fails its sanity check.
+    """
+    rule = _COMPILED_RULES.get(sender_type)
+    if not rule:
+        return None
+
+    values = {}
+    for name, pattern in rule["fields"].items():
+        found = {match.group('value').strip() for match in pattern.finditer(content)}
+        found.discard('')
+        if len(found) != 1:
+            return None
+        value = found.pop()
+        if not _passes_check(rule["checks"].get(name, ""), value):
+            return None
+        values[name] = value
+    return values
+
+
+def extract_robot_command(sender_type: str, content: str):
+    """
+    Renders the robot command locally from the agency template. Returns None when Gemini is needed instead.
+    """
+    values = extract_fields(sender_type, content)
+    if values is None:
+        return None
+    return _COMPILED_RULES[sender_type]["template"].format(**values)
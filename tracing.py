@@ -0,0 +1,218 @@
+# tracing.py
+
+import os
+import json
+import math
+import time
+import uuid
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+# Where spans are appended as JSON lines (off unless set, e.g. TRACE_LOG_PATH=traces.jsonl) and where the
+# Prometheus text snapshot goes (empty turns it off)
+TRACE_LOG_PATH = os.getenv('TRACE_LOG_PATH', '')
+METRICS_PATH = os.getenv('METRICS_PATH', 'metrics.prom')
+# The span log is moved to <path>.1 once it grows past this, so a resident service keeps at most twice that on disk
+TRACE_LOG_MAX_MB = int(os.getenv('TRACE_LOG_MAX_MB', 50))
+# Durations kept per span name for the percentiles, so a service running for weeks doesn't grow without bound
+TRACE_SAMPLES_PER_SPAN = int(os.getenv('TRACE_SAMPLES_PER_SPAN', 10000))
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def job_trace_id(job: dict) -> str:
+    # Jobs queued before tracing existed have no trace id of their own
+    return job.get('trace_id') or f"job-{job['id']}"
+
+
+def _percentile(sorted_values: list, fraction: float) -> float:
+    # Nearest rank, good enough for a few thousand samples
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Tracer:
+    """
+    Minimal tracing for the pipeline. span() times a block with the monotonic clock and writes it as one JSON line
+    tagged with the current booking's trace id (set with trace()). count() bumps named counters such as retries
+    or cache hits. summary_report() and write_prometheus() turn what was collected into p50/p95/p99 per span.
+    """
+
+    def __init__(self, log_path: str = None, metrics_path: str = None, samples_per_span: int = None,
+                 max_log_bytes: int = None):
+        self.log_path = log_path
+        self.metrics_path = metrics_path
+        self.samples_per_span = samples_per_span or TRACE_SAMPLES_PER_SPAN
+        self.max_log_bytes = max_log_bytes or TRACE_LOG_MAX_MB * 1024 * 1024
+        self._log_file = None
+        self._durations = {}
+        self._totals = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+
+    def current_trace_id(self):
+        return getattr(self._local, 'trace_id', None)
+
+    @contextmanager
+    def trace(self, trace_id: str):
+        """
+        Makes trace_id the current trace on this thread, every span inside is tagged with it.
+        """
+        previous = self.current_trace_id()
+        self._local.trace_id = trace_id
+        try:
+            yield trace_id
+        finally:
+            self._local.trace_id = previous
+
+    def run_in_trace(self, trace_id: str, fn, *args, **kwargs):
+        """
+        Calls fn inside trace_id, for handing work to a thread pool without losing the booking's trace.
+        """
+        with self.trace(trace_id):
+            return fn(*args, **kwargs)
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """
+        Times the block. The yielded dict can be used to add attributes once they're known (e.g. a result count).
+        """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        parent = stack[-1] if stack else None
+        stack.append(name)
+        started_at = time.time()
+        started = time.perf_counter()
+        error = None
+        try:
+            yield attrs
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            stack.pop()
+            self._record(name, parent, started_at, seconds, attrs, error)
+
+    def _record(self, name: str, parent: str, started_at: float, seconds: float, attrs: dict, error: str):
+        with self._lock:
+            samples = self._durations.get(name)
+            if samples is None:
+                samples = self._durations[name] = deque(maxlen=self.samples_per_span)
+            samples.append(seconds)
+            total = self._totals.setdefault(name, [0, 0.0])
+            total[0] += 1
+            total[1] += seconds
+
+        if not self.log_path:
+            return
+        entry = {
+            'ts': datetime.fromtimestamp(started_at).isoformat(timespec='milliseconds'),
+            'trace_id': self.current_trace_id(),
+            'span': name,
+            'parent': parent,
+            'duration_ms': round(seconds * 1000, 3),
+        }
+        if error:
+            entry['error'] = error
+        entry.update({key: value for key, value in attrs.items() if key not in entry})
+        line = json.dumps(entry, default=str)
+        with self._write_lock:
+            self._write_line(line)
+
+    def _write_line(self, line: str):
+        # Kept open between spans. log_path may be changed at any time (the benchmark does), which reopens it
+        log_file = self._log_file
+        if log_file is not None and log_file.name != self.log_path:
+            log_file.close()
+            log_file = self._log_file = None
+        if log_file is None:
+            log_file = self._log_file = open(self.log_path, 'a', encoding='utf-8')
+        log_file.write(line + "\n")
+        log_file.flush()
+        if log_file.tell() >= self.max_log_bytes:
+            log_file.close()
+            self._log_file = None
+            os.replace(self.log_path, f"{self.log_path}.1")
+
+    def close(self):
+        with self._write_lock:
+            if self._log_file is not None:
+                self._log_file.close()
+                self._log_file = None
+
+    def reset(self):
+        """
+        Forgets the collected durations and counters, e.g. between benchmark runs in one process.
+        """
+        with self._lock:
+            self._durations.clear()
+            self._totals.clear()
+            self._counters.clear()
+
+    def count(self, name: str, amount: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def snapshot(self) -> tuple:
+        """
+        Returns ({span: (count, total_seconds, p50, p95, p99)}, {counter: value}).
+        """
+        with self._lock:
+            durations = {name: sorted(samples) for name, samples in self._durations.items()}
+            totals = {name: tuple(total) for name, total in self._totals.items()}
+            counters = dict(self._counters)
+        spans = {}
+        for name, values in durations.items():
+            count, total_seconds = totals[name]
+            spans[name] = (count, total_seconds, _percentile(values, 0.50), _percentile(values, 0.95), _percentile(values, 0.99))
+        return spans, counters
+
+    def summary_report(self) -> str:
+        spans, counters = self.snapshot()
+        if not spans and not counters:
+            return "  Nothing was traced."
+        lines = [f"  {'span':<28} {'count':>6} {'total s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"]
+        for name, (count, total_seconds, p50, p95, p99) in sorted(spans.items()):
+            lines.append(f"  {name:<28} {count:>6} {total_seconds:>9.2f} {p50 * 1000:>9.1f} {p95 * 1000:>9.1f} {p99 * 1000:>9.1f}")
+        for name, value in sorted(counters.items()):
+            lines.append(f"  {name}: {value}")
+        return "\n".join(lines)
+
+    def write_prometheus(self, path: str = None):
+        """
+        Writes the current numbers in the Prometheus text format, for node_exporter's textfile collector or a quick look.
+        """
+        path = path or self.metrics_path
+        if not path:
+            return
+        spans, counters = self.snapshot()
+        lines = [
+            "# HELP booking_span_seconds Duration of pipeline stages and steps.",
+            "# TYPE booking_span_seconds summary",
+        ]
+        for name, (count, total_seconds, p50, p95, p99) in sorted(spans.items()):
+            for quantile, value in (("0.5", p50), ("0.95", p95), ("0.99", p99)):
+                lines.append(f'booking_span_seconds{{span="{name}",quantile="{quantile}"}} {value:.6f}')
+            lines.append(f'booking_span_seconds_sum{{span="{name}"}} {total_seconds:.6f}')
+            lines.append(f'booking_span_seconds_count{{span="{name}"}} {count}')
+        lines.append("# HELP booking_events_total Pipeline events such as retries, cache hits and screen searches.")
+        lines.append("# TYPE booking_events_total counter")
+        for name, value in sorted(counters.items()):
+            lines.append(f'booking_events_total{{event="{name}"}} {value}')
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+
+# Shared by every stage in the process
+tracer = Tracer(TRACE_LOG_PATH, METRICS_PATH)